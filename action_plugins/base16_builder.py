@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+from ansible.utils.vars import merge_hash
+
+
+def load_base16_builder():
+    """
+    Loads the base16_builder module from this role's library dir, so its
+    builder can run on the controller. The base16 lookup uses this too.
+    """
+    module_name = "base16_builder_ansible_library"
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            module_name,
+            os.path.join(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                "library",
+                "base16_builder.py",
+            ),
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[module_name] = module
+
+    return sys.modules[module_name]
+
+
+def playbook_run_id():
+    """
+    Identifies the playbook run by the pid of the main ansible-playbook
+    process. Tasks run in workers forked from it, but lookups can also be
+    templated in the main process itself.
+    """
+    if multiprocessing.current_process().name == "MainProcess":
+        return str(os.getpid())
+
+    return str(os.getppid())
+
+
+def _process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+
+    return True
+
+
+# Args naming files written on the target host. A controller build would write
+# them on the controller instead, and only once per playbook run.
+HOST_PATH_ARGS = ["metrics_path", "export_path", "lockfile"]
+
+
+def host_path_args(args):
+    """Returns the args that name files the build would write on the host"""
+    host_paths = [name for name in HOST_PATH_ARGS if args.get(name) is not None]
+    if args.get("artifact_path") is not None and args.get("artifact_mode") == "create":
+        host_paths.append("artifact_path")
+
+    return host_paths
+
+
+def memoized_build(base16_builder, args, check_mode, run_id):
+    """
+    Builds on the controller once per playbook run for each distinct set of
+    module args. Every host's task runs in its own forked worker, so the
+    result is memoized in the controller's cache dir, and a lock makes hosts
+    with the same args wait for the first of them to finish building instead
+    of all building at once.
+    """
+    host_paths = host_path_args(args)
+    if host_paths:
+        return dict(
+            failed=True,
+            msg="{} can't be used with build_on_controller, since the files would be written on the controller instead of the hosts".format(
+                ", ".join(host_paths)
+            ),
+        )
+
+    # The cache_dir arg refers to the target host, so the controller always
+    # uses its own default cache
+    args = dict(args, cache_dir=None, build_on_controller=None)
+    return memoized(
+        base16_builder,
+        os.path.join(
+            base16_builder.argument_spec()["cache_dir"]["default"],
+            "base16-builder-ansible",
+            "controller-builds",
+        ),
+        [args, check_mode],
+        run_id,
+        lambda: base16_builder.run_on_controller(args, check_mode),
+        keep=lambda result: not result.get("failed"),
+    )
+
+
+def memoized(base16_builder, memo_dir, key, run_id, compute, keep=None):
+    """
+    Returns compute's JSON result, memoized in memo_dir by key for the rest
+    of the playbook run. A lock makes processes after the same key wait for
+    the first of them to compute it. Results for which keep returns False
+    aren't memoized.
+    """
+    os.makedirs(memo_dir, exist_ok=True)
+    memo_key = hashlib.sha256(
+        json.dumps(key, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    memo_path = os.path.join(memo_dir, "{}-{}.json".format(run_id, memo_key))
+
+    with base16_builder.RepoLock(memo_path).exclusive():
+        if os.path.exists(memo_path):
+            with open(memo_path) as memo_file:
+                return json.load(memo_file)
+
+        # Results memoized by earlier playbook runs are no longer needed
+        for memo_file_name in os.listdir(memo_dir):
+            memo_run_id = memo_file_name.lstrip(".").split("-")[0]
+            if memo_run_id.isdigit() and not _process_running(int(memo_run_id)):
+                os.remove(os.path.join(memo_dir, memo_file_name))
+
+        result = compute()
+        if keep is None or keep(result):
+            with open(memo_path, "w") as memo_file:
+                json.dump(result, memo_file)
+
+        return result
+
+
+class ActionModule(ActionBase):
+    """
+    Runs the base16_builder module on each host the same way Ansible's normal
+    action does, unless build_on_controller is set. Then the build runs once on
+    the controller for each distinct set of args across the whole playbook
+    run, and every host gets a copy of the result without cloning or rendering
+    anything itself.
+    """
+
+    _supports_check_mode = True
+    _supports_async = True
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        if not boolean(self._task.args.get("build_on_controller", False)):
+            wrap_async = self._task.async_val and not self._connection.has_native_async
+            result = merge_hash(
+                result,
+                self._execute_module(task_vars=task_vars, wrap_async=wrap_async),
+            )
+            if not wrap_async:
+                # Removes the remote tmp dir the module was copied to
+                self._remove_tmp_path(self._connection._shell.tmpdir)
+
+            return result
+
+        # A controller build returns its result straight away, and there's no
+        # job on the host to poll
+        if self._task.async_val:
+            result.update(
+                failed=True,
+                msg="async can't be used with build_on_controller, since the build runs on the controller",
+            )
+            return result
+
+        result.update(
+            memoized_build(
+                load_base16_builder(),
+                self._task.args.copy(),
+                self._play_context.check_mode,
+                playbook_run_id(),
+            )
+        )
+        return result
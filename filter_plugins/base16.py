@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import json
+import zlib
+
+
+def base16_expand(schemes):
+    """
+    Expands schemes returned by the base16_builder module with a
+    result_format of "compressed" or "deduplicated" back into the plain
+    nested dict. Plain results are returned untouched.
+    """
+    if not isinstance(schemes, dict):
+        return schemes
+
+    encoding = schemes.get("base16-encoding")
+    if encoding == "zlib":
+        return json.loads(
+            zlib.decompress(base64.b64decode(schemes["data"])).decode("utf-8")
+        )
+
+    if encoding == "deduplicated":
+        strings = schemes["strings"]
+
+        def expand(entries):
+            node = {}
+            for position in range(0, len(entries), 2):
+                value = entries[position + 1]
+                if isinstance(value, list):
+                    value = expand(value)
+                else:
+                    value = strings[value]
+
+                node[strings[entries[position]]] = value
+
+            return node
+
+        return expand(schemes["schemes"])
+
+    return schemes
+
+
+class FilterModule(object):
+    def filters(self):
+        return {"base16_expand": base16_expand}
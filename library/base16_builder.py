@@ -39,6 +39,9 @@ options:
     description:
       - Set this to the name of a template or a list of template names to only build them instead of building all, which is the default
       - Only building a few templates is much faster then building all
+      - Use the form "template:file" to only build some of the files a template repo lists in its templates/config.yaml, e.g. "i3:colors"
+      - Template and file names can be glob patterns, e.g. "i3:*colors" or "vim*"
+      - Set this to an empty list to only build the scheme-variables of each scheme. Then the template sources aren't cloned, updated, pruned or read at all.
     required: false
     type: list
     default: Build all templates
@@ -52,23 +55,26 @@ options:
     default: First available of $XDG_CACHE_DIR, $HOME/.cache, or platform derived temp dir
   schemes_source:
     description:
-      - Git repo URL or local directory path used to find schemes
-      - The source must include a list.yaml file that maps scheme names to scheme repo Git URLs or local directory paths
+      - Git repo URL or local directory path used to find schemes, or an ordered list of them
+      - Each source must include a list.yaml file that maps scheme names to scheme repo Git URLs or local directory paths
+      - The lists are merged, with a name in a later list overriding the same name in earlier ones, so extra schemes can be added without forking the master list. A repo listed more than once is only cloned once.
     required: false
-    type: string
+    type: list
     default: https://github.com/chriskempson/base16-schemes-source
   templates_source:
     description:
-      - Git repo URL or local directory path used to find templates
-      - The source must include a list.yaml file that maps template names to template repo Git URLs or local directory paths
+      - Git repo URL or local directory path used to find templates, or an ordered list of them
+      - Each source must include a list.yaml file that maps template names to template repo Git URLs or local directory paths
+      - The lists are merged, with a name in a later list overriding the same name in earlier ones, so extra templates can be added without forking the master list. A repo listed more than once is only cloned once.
     required: false
-    type: string
+    type: list
     default: https://github.com/chriskempson/base16-templates-source
   update:
     description:
       - Clone or pull color scheme and template sources
       - By default will update all schemes and templates, but will repect scheme and template args
       - Build will donwload any missing data, so you never _need_ to call update
+      - Templates are compiled into the cache as they're updated, so builds don't need to parse them again
     required: false
     type: bool
     default: no
@@ -79,6 +85,170 @@ options:
     required: false
     type: bool
     default: yes
+  result_format:
+    description:
+      - How the returned schemes are encoded
+      - "plain" returns schemes as nested dicts, as shown in the examples
+      - "compressed" returns them as zlib compressed, base64 encoded JSON
+      - "deduplicated" returns every distinct string once, with the nested dicts referencing them by index
+      - Encoded results are much smaller to send back to the controller when building many schemes, and can be expanded back to the plain shape with the base16_expand filter this role provides
+    required: false
+    type: string
+    choices: [plain, compressed, deduplicated]
+    default: plain
+  delta:
+    description:
+      - Return only the outputs that are new or changed since the last build with the same scheme, scheme_family, template, source and palette_variables args, and list the outputs that build returned but this one doesn't in removed
+      - A scheme is returned with its scheme-variables when any of its outputs or its variables changed, and schemes with no changes are left out
+      - Builds are compared using a manifest of output hashes kept in the cache_dir, and changed is set when anything was returned or removed
+    required: false
+    type: bool
+    default: no
+  build_on_controller:
+    description:
+      - Build on the Ansible controller instead of on every host
+      - The build runs once for each distinct set of module args over the whole playbook run, and every host with those args is handed a copy of the result, so hosts don't clone or render anything
+      - The controller keeps its own cache in its default cache dir, and the cache_dir arg is ignored
+      - Can't be used with metrics_path, export_path, lockfile, or artifact_path when artifact_mode is create, since those files would be written once on the controller instead of on every host
+      - Can't be used with async, since there's no job on the host to poll
+      - Requires Pystache on the controller
+    required: false
+    type: bool
+    default: no
+  git_backend:
+    description:
+      - How scheme and template repos are cloned and pulled
+      - "subprocess" runs the git CLI for every repo
+      - "dulwich" clones and pulls inside the module process with L(Dulwich,https://www.dulwich.io/), which avoids starting a git process per repo and reuses HTTP connections across repos. It requires the dulwich Python package on the host running the module
+    required: false
+    type: string
+    choices: [subprocess, dulwich]
+    default: subprocess
+  archive_url:
+    description:
+      - Download a snapshot archive of each scheme, template and source repo from this URL instead of cloning it with git
+      - "{url} is replaced with the repo's Git URL, minus any trailing .git, and {name} with the last part of that URL. E.g. \"{url}/archive/HEAD.tar.gz\" downloads GitHub's archive of each repo's default branch"
+      - Can also be a local path, e.g. "/srv/base16-mirror/{name}.tar.gz"
+      - Archives can be tarballs, optionally compressed, or zip files if the URL ends with .zip. If everything in an archive is inside a single top level directory, like in GitHub's archives, that directory is treated as the root of the repo
+      - Archives are only downloaded again by update if they've changed since they were last fetched
+    required: false
+    type: string
+  prune:
+    description:
+      - Remove cached scheme and template repos that are no longer in the source lists, along with their compiled templates, and run git's housekeeping on the rest
+      - Paths that were removed are returned in pruned
+    required: false
+    type: bool
+    default: no
+  max_cache_size:
+    description:
+      - When pruning, also remove the least recently used scheme and template repos until the cache is no bigger than this many megabytes
+      - Removed repos are cloned again the next time they're needed
+    required: false
+    type: int
+  workers:
+    description:
+      - Number of worker processes that scan and parse scheme files and template configs while building
+      - Speeds up builds of many schemes on a cold cache by parsing on every core, instead of one file at a time
+      - Set to 0 to use one worker per CPU core, or 1 to parse everything in the module's own process
+    required: false
+    type: int
+    default: 1
+  concurrency:
+    description:
+      - Runs updates and builds as a pipeline of stages, with up to this many scheme or template repos cloned, pulled or parsed at once
+      - Scheme repos are fetched and parsed ahead of rendering, but no more than this many wait to be rendered, and they're rendered in order, so results are the same as a sequential build's
+      - Parsing uses the worker processes when workers isn't 1. concurrency bounds the git commands and repos waiting to be rendered, while workers bounds the processes parsing them, so the two are set separately
+      - Leave unset to clone, pull and build one repo at a time
+    required: false
+    type: int
+  query:
+    description:
+      - Instead of building, return the slugs of schemes matching this query in matches
+      - Queries use an index of scheme metadata kept in the cache_dir, so no schemes are loaded or rendered, and the index is only rebuilt for scheme repos that changed since they were last indexed
+      - The family, name and author keys are case insensitive glob patterns, e.g. "*Kempson*"
+      - The dark key selects dark or light schemes, and min_luminance and max_luminance bound the relative luminance of the background color (base00), from 0 for black to 1 for white
+      - The scheme and scheme_family args still limit which schemes are queried
+    required: false
+    type: dict
+  lockfile:
+    description:
+      - Path to a lockfile of the commit every source list, scheme repo and template repo is at
+      - Update checks out the latest commits and writes them to the lockfile. Otherwise, every repo is checked out at the commit the lockfile pins, fetching just the commits that aren't cached yet, so every host sharing the lockfile builds the same revisions without pulling
+      - A build without an existing lockfile writes one with the revisions it used
+      - Can't be used with archive_url
+    required: false
+    type: path
+  git_timeout:
+    description:
+      - Seconds each clone, pull or fetch of a repo may take before it's stopped and counts as failed
+      - By default git commands can run for as long as they need
+    required: false
+    type: int
+  git_retries:
+    description:
+      - Number of times a failed clone, pull or fetch is retried before the module fails, waiting 1 second before the first retry and twice as long before each one after it
+      - Only applies to the subprocess git_backend
+    required: false
+    default: 0
+    type: int
+  stale_on_timeout:
+    description:
+      - When pulling a cached repo runs past git_timeout on every try, carry on with the cached repo as it was instead of failing. Its path is returned in stale.
+      - Only applies to the subprocess git_backend
+    required: false
+    default: false
+    type: bool
+  palette_variables:
+    description:
+      - Add variables to each scheme approximating its colors for terminals, for templates and the scheme-variables result
+      - For each base, e.g. base0D, base0D-xterm256 and base0D-ansi16 are the indexes of the nearest xterm-256 color, not counting the first 16, and the nearest of xterm's default 16 colors
+      - base0D-luminance is the base's WCAG relative luminance and base0D-contrast its contrast ratio with base00
+    required: false
+    default: false
+    type: bool
+  export_path:
+    description:
+      - Instead of building templates, write the variables of every selected scheme to this file, with one row per scheme, and don't return them in schemes
+      - The file is only written again if its contents would change
+    required: false
+    type: path
+  export_format:
+    description:
+      - Format of the export_path file. jsonl writes a JSON object of each scheme's variables per line, and csv a header of variable names and a row per scheme.
+      - packed writes each scheme's 16 colors in a fixed size binary row after a small JSON header of scheme names, authors and slugs. The read_scheme_export function in this module reads any of the formats back.
+    required: false
+    default: jsonl
+    choices: [jsonl, csv, packed]
+    type: string
+  artifact_path:
+    description:
+      - Path to a zip archive of prebuilt outputs, laid out as scheme/template/output_dir/file, along with every built scheme's variables and a manifest of the revisions they were built from
+      - When artifact_mode is create, the build writes every output it renders to this archive. "{hash}" in the path is replaced with the start of the archive's content hash, and the archive is only written again if its contents would change.
+      - When artifact_mode is consume, the selected schemes and template outputs are read from the archive instead of being built, and nothing is cloned, updated or rendered. Only the outputs that are needed are read from the archive.
+    required: false
+    type: path
+  artifact_mode:
+    description:
+      - Whether to create the artifact_path archive or to consume it
+    required: false
+    default: consume
+    choices: [create, consume]
+    type: string
+  metrics_path:
+    description:
+      - Write metrics about the run to this file when it finishes, e.g. into the directory of node_exporter's textfile collector
+      - Metrics cover each repo's clones, pulls and checkouts and their durations, schemes built, templates rendered and bytes rendered, render durations, repos parsed, hits and misses of the parsed source, compiled template and scheme index caches, and how long each phase of the run took
+      - Counters and histograms add up across runs, using totals kept in the cache_dir, while gauges describe the last run
+    required: false
+    type: path
+  metrics_format:
+    description:
+      - prometheus writes the Prometheus text format. json writes a summary of the last run's metrics and the totals across runs.
+    required: false
+    default: prometheus
+    choices: [prometheus, json]
+    type: string
 """
 
 EXAMPLES = """
@@ -183,11 +353,196 @@ EXAMPLES = """
     template: shell
     schemes_source: http://github.com/my-user/my-schemes-source-fork
     templates_source: http://github.com/my-user/my-templates-source-fork
+
+# Extra scheme and template lists can be layered over the master lists instead
+# of forking them. Each list's list.yaml is merged in order, and a name in a
+# later list replaces the same name from earlier ones. For example a local dir
+# whose list.yaml maps "unclaimed" to
+# https://github.com/chriskempson/base16-unclaimed-schemes adds the unclaimed
+# schemes too.
+- base16_builder:
+    scheme: my-brand-new-color-scheme
+    template: shell
+    schemes_source:
+      - https://github.com/chriskempson/base16-schemes-source
+      - /home/user/my-extra-schemes-source
+
+# Building lots of schemes returns a lot of repetitive data to the controller.
+# Compress it for the trip and expand it again with the base16_expand filter
+- base16_builder:
+    template: shell
+    result_format: compressed
+  register: base16_compressed_schemes
+
+- copy:
+    content: "{{ (base16_compressed_schemes.schemes | base16_expand)['tomorrow-night']['shell']['scripts']['base16-tomorrow-night.sh'] }}"
+    dest: /my/bash/profile/dir/tomorrow-night-shell.sh
+
+# Only write the outputs that changed since the last run, and delete the
+# ones that are no longer built
+- base16_builder:
+    template: vim
+    delta: yes
+  register: base16_delta
+
+- copy:
+    content: "{{ item.value.vim.colors | dict2items | map(attribute='value') | first }}"
+    dest: "/my/vim/colors/base16-{{ item.key }}.vim"
+  loop: "{{ base16_delta.schemes | dict2items | selectattr('value.vim', 'defined') | list }}"
+
+- file:
+    path: "/my/vim/colors/{{ item.file_name }}"
+    state: absent
+  loop: "{{ base16_delta.removed }}"
+
+# Build once on the controller and share the result with every host, instead
+# of every host cloning and rendering the same themes
+- base16_builder:
+    scheme: tomorrow-night
+    template: shell
+    build_on_controller: yes
+  register: base16_schemes
+
+# Build only some of the files a template repo provides
+- base16_builder:
+    scheme: tomorrow-night
+    template:
+      - i3:colors
+      - i3:*-properties
+  register: base16_schemes
+
+# Download GitHub's snapshot archives of repos instead of cloning them, which
+# is quicker and smaller when you don't need their Git history
+- base16_builder:
+    scheme: tomorrow-night
+    template: shell
+    archive_url: "{url}/archive/HEAD.tar.gz"
+  register: base16_schemes
+
+# Clean up repos that were dropped from the source lists and keep the cache
+# under 500MB
+- base16_builder:
+    prune: yes
+    max_cache_size: 500
+    build: no
+
+# Find dark schemes by a given author without building anything
+- name: Find dark schemes
+  base16_builder:
+    query:
+      author: "*Kempson*"
+      dark: yes
+  register: dark_schemes
+
+- name: Build the first one
+  base16_builder:
+    scheme: "{{ dark_schemes.matches | first }}"
+    template: vim
+  register: base16_schemes
+
+# Check mode doesn't clone, pull or render anything. Instead plan lists the
+# repos that would be cloned or pulled, and the outputs that would be created
+# or changed since the last build with the same args
+- base16_builder:
+    update: yes
+    scheme: tomorrow-night
+    template: shell
+  check_mode: yes
+  register: base16_plan
+
+# Build the revisions pinned by a lockfile kept with your dotfiles, so every
+# host renders the same output. Running with update: yes moves the pins to
+# the latest commits.
+- base16_builder:
+    scheme: tomorrow-night
+    template: shell
+    lockfile: ~/dotfiles/base16.lock
+  register: base16_schemes
+
+# Export the variables of every scheme to a single file for other tools
+- base16_builder:
+    export_path: /srv/base16/schemes.csv
+    export_format: csv
+
+# Render every scheme and template once, e.g. in CI, into an archive
+- base16_builder:
+    update: yes
+    artifact_path: /srv/base16/base16-{hash}.zip
+    artifact_mode: create
+  register: base16_artifact
+
+# Then extract just the outputs a host needs from it, without building them
+- base16_builder:
+    scheme: tomorrow-night
+    template: shell
+    artifact_path: /srv/base16/base16-1a2b3c4d5e6f7a8b.zip
+  register: base16_schemes
 """
 
 RETURN = """
+plan:
+  description: What the run would change, in check mode. Outputs are named by their path through the schemes dict. Outputs of repos that aren't cached yet can't be listed until they're cloned.
+  returned: in check mode, unless query is set
+  type: dict
+  sample:
+    clone:
+      - /home/user/.cache/base16-builder-ansible/templates/vim
+    pull:
+      - /home/user/.cache/base16-builder-ansible/schemes/tomorrow
+    create: []
+    modify:
+      - tomorrow-night/shell/scripts/base16-tomorrow-night.sh
+durations:
+  description: Seconds spent cloning, pulling or checking out each repo, by its path in the cache
+  returned: when any repo was cloned, pulled or checked out
+  type: dict
+  sample:
+    /home/user/.cache/base16-builder-ansible/schemes/tomorrow: 0.412
+stale:
+  description: Paths of cached repos that were used as they were because pulling them timed out
+  returned: when stale_on_timeout is set and a pull timed out
+  type: list
+  sample:
+    - /home/user/.cache/base16-builder-ansible/schemes/tomorrow
+export:
+  description: Where the scheme variables were exported to and how many schemes were exported
+  returned: when export_path is set
+  type: dict
+  sample:
+    path: /srv/base16/schemes.csv
+    format: csv
+    schemes: 212
+artifact:
+  description: Path and content hash of the artifact_path archive, and when it was created, how many outputs it holds
+  returned: when artifact_path is set
+  type: dict
+  sample:
+    path: /srv/base16/base16-1a2b3c4d5e6f7a8b.zip
+    hash: 1a2b3c4d5e6f7a8b9c0d1e2f3a4b5c6d7e8f9a0b1c2d3e4f5a6b7c8d9e0f1a2b
+    outputs: 12840
+removed:
+  description: Outputs that the last build with the same scheme, template, source and palette_variables args returned, but that this build no longer does
+  returned: when delta is set
+  type: list
+  sample:
+    - scheme: tomorrow-night
+      template: vim
+      output_dir: colors
+      file_name: base16-tomorrow-night.vim
+matches:
+  description: Slugs of the schemes matching the query
+  returned: when query is set
+  type: list
+  sample:
+    - tomorrow-night
+pruned:
+  description: Paths of cached repos that were removed when prune is set
+  returned: when prune is set
+  type: list
+  sample:
+    - /home/user/.cache/base16-builder-ansible/schemes/old-family
 schemes:
-  description: A dict of color schemes mapped to nested dicts of rendered templates. One special template is also rendered for every color scheme called "scheme-variables". This contains the raw base16 color variables used for that scheme. These can be useful for rendering Ansible templates with individual color codes.
+  description: A dict of color schemes mapped to nested dicts of rendered templates. One special template is also rendered for every color scheme called "scheme-variables". This contains the raw base16 color variables used for that scheme. These can be useful for rendering Ansible templates with individual color codes. If result_format is set to "compressed" or "deduplicated" this is an encoded form of the same dict, which the base16_expand filter expands.
   type: dict
   sample:
     schemes:
@@ -234,12 +589,43 @@ schemes:
             base16-gruvbox-dark-medium.colors: "\" vi:syntax=vim\n\n\" base16-vim ..."
 """
 
+import asyncio
+import base64
+import bisect
+import collections
+import concurrent.futures
+import csv
+import fcntl
+import fnmatch
+import hashlib
+import html
+import io
+import json
+import multiprocessing
 import os
+import re
 import shutil
+import signal
+import struct
+import subprocess
+import tarfile
 import tempfile
+import threading
+import time
 import yaml
+import zipfile
+import zlib
+from contextlib import contextmanager
+from urllib.error import HTTPError
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.module_utils.urls import open_url
 
 PYSTACHE_ERR = None
 try:
@@ -247,213 +633,1848 @@ try:
 except (ImportError, ModuleNotFoundError) as err:
     PYSTACHE_ERR = err
 
+DULWICH_ERR = None
+try:
+    from dulwich import porcelain
+    from dulwich.client import default_urllib3_manager, get_transport_and_path
+except (ImportError, ModuleNotFoundError) as err:
+    DULWICH_ERR = err
+
 
 def open_yaml(path):
     with open(path) as yaml_file:
         return yaml.safe_load(yaml_file)
 
 
-class GitRepo(object):
-    def __init__(self, builder, url_or_local_path, clone_dest):
-        self.builder = builder
-        self.module = builder.module
-        self.git_path = self.module.get_bin_path("git", True)
+def read_json_file(path):
+    """Reads a JSON file from the cache, or returns None if it's missing or corrupt"""
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
 
-        if os.path.exists(url_or_local_path):
-            self.path = url_or_local_path
-            self.local_repo = True
-        else:
-            self.local_repo = False
-            self.url = url_or_local_path
-            self.path = clone_dest
 
-        self.git_config_path = os.path.join(self.path, ".git", "config")
+def write_json_file(path, data):
+    # Written to a temp file and renamed into place, so concurrent runs never
+    # read a partially written file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+    with os.fdopen(fd, "w") as json_file:
+        json.dump(data, json_file)
 
-    def clone_or_pull(self):
-        if self.local_repo:
-            return
+    os.replace(tmp_path, path)
 
-        if not self.clone_if_missing():
-            self.builder.result["changed"] = True
-            if self.module.check_mode:
-                return
 
-            self.module.run_command(
-                [self.git_path, "pull"], cwd=self.path, check_rc=True
-            )
+def write_file(path, contents):
+    """
+    Writes bytes or text to a temp file beside path and renames it into
+    place, so readers never see a partially written file
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".")
+    with os.fdopen(fd, "wb" if isinstance(contents, bytes) else "w") as new_file:
+        new_file.write(contents)
 
-    def clone_if_missing(self):
-        if self.local_repo:
-            return
+    os.replace(tmp_path, path)
 
-        if not os.path.exists(os.path.dirname(self.path)):
-            self.builder.result["changed"] = True
-            if self.module.check_mode:
-                return
 
-            os.makedirs(os.path.dirname(self.path))
+# Every metric written to metrics_path, minus the base16_builder_ prefix, with
+# its type and help text
+METRICS = collections.OrderedDict(
+    [
+        (
+            "git_operations_total",
+            ("counter", "Clones, pulls and checkouts of each cached repo"),
+        ),
+        (
+            "git_operation_seconds_total",
+            ("counter", "Seconds spent cloning, pulling and checking out each repo"),
+        ),
+        (
+            "git_operation_duration_seconds",
+            ("histogram", "Seconds taken by each clone, pull and checkout"),
+        ),
+        ("schemes_total", ("counter", "Schemes built or exported")),
+        (
+            "template_renders_total",
+            ("counter", "Templates rendered, by template repo"),
+        ),
+        ("rendered_bytes_total", ("counter", "Bytes of output rendered")),
+        (
+            "render_duration_seconds",
+            ("histogram", "Seconds taken to render each template"),
+        ),
+        (
+            "source_parses_total",
+            ("counter", "Scheme and template repos whose files were parsed"),
+        ),
+        (
+            "cache_lookups_total",
+            ("counter", "Lookups in the module's caches, by whether they hit"),
+        ),
+        (
+            "phase_duration_seconds",
+            ("gauge", "Seconds the last run spent in each phase"),
+        ),
+        (
+            "last_run_timestamp_seconds",
+            ("gauge", "When the last run finished, in seconds since the epoch"),
+        ),
+    ]
+)
 
-        if self._repo_at_path():
-            return False
+# Upper bounds of each histogram's buckets, not counting +Inf
+METRIC_BUCKETS = {
+    "git_operation_duration_seconds": [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120],
+    "render_duration_seconds": [
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.1,
+    ],
+}
 
-        self.builder.result["changed"] = True
-        if self.module.check_mode:
-            return
 
-        # If a different repo is at the given path, replace it
-        if os.path.exists(self.git_config_path):
-            shutil.rmtree(self.path)
+class RunMetrics(object):
+    """
+    Counts and times what a run does, for metrics_path. Counters and
+    histograms keep adding up across runs in the cache, so they behave like
+    a long running process's would, while gauges only describe the last run.
+    Git operations are timed from concurrent fetch threads, so samples are
+    only changed under a lock.
+    """
 
-        self.module.run_command(
-            [self.git_path, "clone", self.url, self.path], check_rc=True
+    def __init__(self, module):
+        self.module = module
+        self.path = os.path.join(
+            module.params["cache_dir"], "base16-builder-ansible", "metrics.json"
         )
+        # (name, labels) to a value, or to [bucket counts, sum] for histograms
+        self.samples = {}
+        self.lock = threading.Lock()
 
-        return True
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + value
 
-    def _repo_at_path(self):
-        """
-        This is a very rough heuristic to tell if there's a git repo at the
-        path that points to the same repo URL we were given. It would be better
-        to parse the file, but that would pull in another dependency :/
-        """
-        if not os.path.exists(self.git_config_path):
-            return False
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRIC_BUCKETS[name]
+        with self.lock:
+            if key not in self.samples:
+                self.samples[key] = [[0] * (len(buckets) + 1), 0]
 
-        with open(self.git_config_path) as git_config:
-            if "url = {}".format(self.url) in git_config.read():
-                return True
+            self.samples[key][0][bisect.bisect_left(buckets, value)] += 1
+            self.samples[key][1] += value
 
-        return False
+    @contextmanager
+    def phase(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.inc("phase_duration_seconds", time.monotonic() - start, phase=phase)
 
+    def cache_lookup(self, cache, hit):
+        self.inc("cache_lookups_total", cache=cache, result="hit" if hit else "miss")
 
-class Base16SourceRepo(object):
-    def __init__(self, builder, source_repo_class):
-        self.builder = builder
-        self.module = builder.module
-        self.source_repo_class = source_repo_class
-        self.source_type = source_repo_class.source_type
-        self.git_repo = GitRepo(
-            builder,
-            self.module.params["{}_source".format(self.source_type)],
-            os.path.join(
-                self.module.params["cache_dir"],
-                "base16-builder-ansible",
-                "sources",
-                self.source_type,
-            ),
-        )
+    def write(self):
+        if self.module.check_mode:
+            return
 
-    def _source_repos(self):
-        for (source_family, source_url) in open_yaml(
-            os.path.join(self.git_repo.path, "list.yaml")
-        ).items():
-            # Not sure if caching this value would be good or not
-            yield self.source_repo_class(
-                self.builder,
-                source_family,
-                source_url,
-                os.path.join(
-                    self.module.params["cache_dir"],
-                    "base16-builder-ansible",
-                    self.source_type,
-                    source_family,
-                ),
+        self.inc("last_run_timestamp_seconds", time.time())
+        # Runs sharing the cache would otherwise lose each other's counts
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with RepoLock(self.path).exclusive():
+            totals = self._totals()
+            write_json_file(
+                self.path,
+                {
+                    "samples": [
+                        [name, dict(labels), value]
+                        for ((name, labels), value) in sorted(totals.items())
+                    ]
+                },
             )
 
-    def sources(self):
-        self.git_repo.clone_if_missing()
-        for source_repo in self._source_repos():
-            for source in source_repo.sources():
-                yield source
+        if self.module.params["metrics_format"] == "json":
+            contents = json.dumps(
+                {"run": self._summary(self.samples), "totals": self._summary(totals)},
+                sort_keys=True,
+            )
+        else:
+            contents = self._text_format(totals)
 
-    def update(self):
-        self.git_repo.clone_or_pull()
-        for source_repo in self._source_repos():
-            source_repo.clone_or_pull()
+        write_file(self.module.params["metrics_path"], contents)
 
+    def _totals(self):
+        """Adds this run's counters and histograms to the earlier runs' totals"""
+        totals = {}
+        saved_totals = read_json_file(self.path) or {}
+        for (name, labels, value) in saved_totals.get("samples", []):
+            if name in METRICS and METRICS[name][0] != "gauge":
+                totals[(name, tuple(sorted(labels.items())))] = value
 
-class Scheme(object):
-    def __init__(self, path):
-        self.path = path
-        self.data = {}
-        self._slug = None
+        for ((name, labels), value) in self.samples.items():
+            total = totals.get((name, labels))
+            if METRICS[name][0] == "gauge" or total is None:
+                totals[(name, labels)] = value
+            elif METRICS[name][0] == "histogram" and len(total[0]) == len(value[0]):
+                totals[(name, labels)] = [
+                    [
+                        total_count + count
+                        for (total_count, count) in zip(total[0], value[0])
+                    ],
+                    total[1] + value[1],
+                ]
+            elif METRICS[name][0] == "histogram":
+                # The buckets changed, so earlier runs can't be added up
+                totals[(name, labels)] = value
+            else:
+                totals[(name, labels)] = total + value
 
-        self.base16_vars = {
-            "scheme-author": self._data()["author"],
-            "scheme-name": self._data()["scheme"],
-            "scheme-slug": self.slug(),
-            "scheme-slug-underscored": self.slug().replace("-", "_"),
-        }
-        self.computed_bases = False
+        return totals
 
-    def _data(self):
-        if self.data:
-            return self.data
+    def _summary(self, samples):
+        summary = {}
+        for ((name, labels), value) in sorted(samples.items()):
+            sample = {"labels": dict(labels)}
+            if METRICS[name][0] == "histogram":
+                sample["buckets"] = dict(
+                    zip(
+                        [str(bound) for bound in METRIC_BUCKETS[name]] + ["+Inf"],
+                        self._cumulative(value[0]),
+                    )
+                )
+                sample["sum"] = value[1]
+                sample["count"] = sum(value[0])
+            else:
+                sample["value"] = value
 
-        self.data = open_yaml(self.path)
-        return self.data
+            summary.setdefault(name, []).append(sample)
 
-    def slug(self):
-        if self._slug:
-            return self._slug
+        return summary
 
-        self._slug = (
-            os.path.splitext(os.path.basename(self.path))[0].lower().replace(" ", " ")
-        )
+    def _text_format(self, samples):
+        """Renders samples in the Prometheus text format"""
+        lines = []
+        for (name, (metric_type, help_text)) in METRICS.items():
+            metric_samples = sorted(
+                (labels, value)
+                for ((sample_name, labels), value) in samples.items()
+                if sample_name == name
+            )
+            if not metric_samples:
+                continue
 
-        return self._slug
+            full_name = "base16_builder_{}".format(name)
+            lines.append("# HELP {} {}".format(full_name, help_text))
+            lines.append("# TYPE {} {}".format(full_name, metric_type))
+            for (labels, value) in metric_samples:
+                if metric_type != "histogram":
+                    lines.append(
+                        "{}{} {}".format(full_name, self._labels(labels), value)
+                    )
+                    continue
 
-    def base16_variables(self):
-        if self.computed_bases:
-            return self.base16_vars
-
-        for base in ["{:02X}".format(i) for i in range(16)]:
-            base_key = "base{}".format(base)
-            base_hex_key = "{}-hex".format(base_key)
-            base_hex_r = self._data()[base_key][0:2]
-            base_hex_g = self._data()[base_key][2:4]
-            base_hex_b = self._data()[base_key][4:6]
-            self.base16_vars.update(
-                {
-                    base_hex_key: self._data()[base_key],
-                    "{}-r".format(base_hex_key): base_hex_r,
-                    "{}-g".format(base_hex_key): base_hex_g,
-                    "{}-b".format(base_hex_key): base_hex_b,
-                    "{}-hex-bgr".format(base_key): "{}{}{}".format(
-                        base_hex_b,
-                        base_hex_g,
-                        base_hex_r,
-                    ),
-                }
-            )
-            self.base16_vars.update(
-                {
-                    "{}-rgb-r".format(base_key): str(
-                        int(self.base16_vars[base_hex_key + "-r"], 16)
-                    ),
-                    "{}-rgb-g".format(base_key): str(
-                        int(self.base16_vars[base_hex_key + "-g"], 16)
-                    ),
-                    "{}-rgb-b".format(base_key): str(
-                        int(self.base16_vars[base_hex_key + "-b"], 16)
-                    ),
-                    "{}-dec-r".format(base_key): str(
-                        int(self.base16_vars[base_hex_key + "-r"], 16) / 255
-                    ),
-                    "{}-dec-g".format(base_key): str(
-                        int(self.base16_vars[base_hex_key + "-g"], 16) / 255
-                    ),
-                    "{}-dec-b".format(base_key): str(
-                        int(self.base16_vars[base_hex_key + "-b"], 16) / 255
-                    ),
-                }
-            )
+                bounds = [str(bound) for bound in METRIC_BUCKETS[name]] + ["+Inf"]
+                for (bound, count) in zip(bounds, self._cumulative(value[0])):
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            full_name, self._labels(labels + (("le", bound),)), count
+                        )
+                    )
+                lines.append(
+                    "{}_sum{} {}".format(full_name, self._labels(labels), value[1])
+                )
+                lines.append(
+                    "{}_count{} {}".format(
+                        full_name, self._labels(labels), sum(value[0])
+                    )
+                )
 
-        self.computed_bases = True
-        return self.base16_vars
+        return "\n".join(lines) + "\n"
 
+    def _labels(self, labels):
+        if not labels:
+            return ""
 
-class SchemeRepo(object):
+        return "{{{}}}".format(
+            ",".join(
+                '{}="{}"'.format(
+                    name,
+                    str(value)
+                    .replace("\\", "\\\\")
+                    .replace('"', '\\"')
+                    .replace("\n", "\\n"),
+                )
+                for (name, value) in labels
+            )
+        )
+
+    def _cumulative(self, bucket_counts):
+        cumulative = []
+        for count in bucket_counts:
+            cumulative.append(count + (cumulative[-1] if cumulative else 0))
+
+        return cumulative
+
+
+class RepoLock(object):
+    """
+    Advisory lock guarding a single cached repo against concurrent module
+    runs sharing a cache_dir. Anything reading a repo's files holds a shared
+    lock, and anything cloning, pulling or removing it holds an exclusive one.
+    The lock file lives beside the repo, so it survives the repo being
+    replaced, and its modification time records when the repo was last used.
+    Locks that don't touch, as in check mode, only use lock files that already
+    exist and leave their modification times alone.
+    """
+
+    def __init__(self, repo_path, enabled=True, touch=True):
+        self.enabled = enabled
+        self.touch = touch
+        self.path = os.path.join(
+            os.path.dirname(repo_path), ".{}.lock".format(os.path.basename(repo_path))
+        )
+
+    def shared(self):
+        return self._locked(fcntl.LOCK_SH)
+
+    def exclusive(self):
+        return self._locked(fcntl.LOCK_EX)
+
+    @contextmanager
+    def _locked(self, operation):
+        # Nothing to guard if the cache doesn't exist yet, e.g. in check mode
+        if not self.enabled or not os.path.isdir(os.path.dirname(self.path)):
+            yield
+            return
+
+        if not self.touch and not os.path.exists(self.path):
+            yield
+            return
+
+        with open(self.path, "a" if self.touch else "r") as lock_file:
+            fcntl.flock(lock_file.fileno(), operation)
+            if self.touch:
+                os.utime(self.path, None)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def run_in_session(args, cwd=None, timeout=None):
+    """
+    Runs a command in a session of its own, killing the whole session if it
+    runs for longer than timeout. Git talks to remotes through helpers like
+    git-remote-https and ssh, which would otherwise keep the command's output
+    open after git itself was killed. Returns the rc, stdout and stderr, with
+    an rc of None if the command timed out.
+    """
+    process = subprocess.Popen(
+        args,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+    )
+    try:
+        (stdout, stderr) = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_session(process)
+        process.communicate()
+        return (None, "", "")
+
+    return (
+        process.returncode,
+        stdout.decode("utf-8", "replace"),
+        stderr.decode("utf-8", "replace"),
+    )
+
+
+def kill_session(process):
+    # The session's id is the pid of the process that started it
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+async def run_in_session_async(args, cwd=None, timeout=None):
+    """The same as run_in_session, but with one of asyncio's subprocesses"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    communicated = False
+    try:
+        (stdout, stderr) = await asyncio.wait_for(process.communicate(), timeout)
+        communicated = True
+    except asyncio.TimeoutError:
+        return (None, "", "")
+    finally:
+        # Also kills commands cancelled after a stage failed
+        if not communicated:
+            kill_session(process)
+            await process.wait()
+
+    return (
+        process.returncode,
+        stdout.decode("utf-8", "replace"),
+        stderr.decode("utf-8", "replace"),
+    )
+
+
+class CommandRunner(object):
+    """
+    Runs the git commands of the git backends, and reports the backends'
+    failures. Commands go through the module's run_command, or run_in_session
+    when they have a timeout, and failures go straight to fail_json.
+    """
+
+    def __init__(self, module):
+        self.module = module
+
+    def run(self, args, cwd=None, check_rc=False, timeout=None):
+        """
+        Returns the command's rc, stdout and stderr, with an rc of None if it
+        timed out. With check_rc, commands that fail also fail the module.
+        """
+        if timeout:
+            return self._checked(args, run_in_session(args, cwd, timeout), check_rc)
+
+        kwargs = {}
+        if cwd is not None:
+            kwargs["cwd"] = cwd
+        if check_rc:
+            kwargs["check_rc"] = True
+
+        return self.module.run_command(args, **kwargs)
+
+    def fail(self, **result):
+        self.module.fail_json(**result)
+
+    def _checked(self, args, command_result, check_rc):
+        (rc, stdout, stderr) = command_result
+        if rc != 0 and check_rc:
+            self.fail(
+                cmd=args, rc=rc, stdout=stdout, stderr=stderr, msg=stderr.rstrip()
+            )
+
+        return command_result
+
+
+class DeferredFailure(Exception):
+    """Raised by AsyncCommandRunner in place of failing the module"""
+
+    def __init__(self, result):
+        super(DeferredFailure, self).__init__(result.get("msg"))
+        self.result = result
+
+
+class AsyncCommandRunner(CommandRunner):
+    """
+    The CommandRunner used with concurrency. AnsibleModule isn't thread safe:
+    run_command keeps state on the module and can change the working dir of
+    the whole process, and fail_json prints a result before exiting. While
+    BuildOrchestrator's stages run, commands from its threads are run on its
+    event loop as asyncio subprocesses instead, and failures raise
+    DeferredFailure for the orchestrator to report once, from the main
+    thread, after its threads have stopped.
+    """
+
+    def __init__(self, module):
+        super(AsyncCommandRunner, self).__init__(module)
+        self.loop = None
+        self.main_thread = None
+        self.stopped = False
+        self.running = set()
+        self.lock = threading.Lock()
+
+    def start(self, loop):
+        self.loop = loop
+        self.main_thread = threading.current_thread()
+        self.stopped = False
+
+    def stop(self):
+        """Kills the commands that are still running, and refuses new ones"""
+        with self.lock:
+            self.stopped = True
+            for command in self.running:
+                command.cancel()
+
+    def finish(self):
+        self.loop = None
+
+    def run(self, args, cwd=None, check_rc=False, timeout=None):
+        if self.loop is None:
+            return super(AsyncCommandRunner, self).run(args, cwd, check_rc, timeout)
+
+        if threading.current_thread() is self.main_thread:
+            # Source lists are cloned from the loop itself, which can't wait
+            # on its own subprocesses
+            return self._checked(args, run_in_session(args, cwd, timeout), check_rc)
+
+        with self.lock:
+            if self.stopped:
+                raise concurrent.futures.CancelledError()
+
+            command = asyncio.run_coroutine_threadsafe(
+                run_in_session_async(args, cwd, timeout), self.loop
+            )
+            self.running.add(command)
+
+        try:
+            command_result = command.result()
+        finally:
+            with self.lock:
+                self.running.discard(command)
+
+        return self._checked(args, command_result, check_rc)
+
+    def fail(self, **result):
+        if self.loop is None:
+            super(AsyncCommandRunner, self).fail(**result)
+
+        raise DeferredFailure(result)
+
+
+# Seconds to wait before the first retry of a failed git command, doubled for
+# each retry after it
+RETRY_BACKOFF = 1
+
+
+def encode_schemes(schemes, result_format):
+    """
+    Encodes the built schemes for the trip back to the controller. The
+    base16_expand filter plugin reverses this.
+    """
+    if result_format == "compressed":
+        return {
+            "base16-encoding": "zlib",
+            "data": base64.b64encode(
+                zlib.compress(json.dumps(schemes).encode("utf-8"), 9)
+            ).decode("ascii"),
+        }
+
+    if result_format == "deduplicated":
+        # Every distinct key and value is stored once, and each dict becomes a
+        # flat list of alternating key indexes and values. Values are either
+        # string indexes or nested lists for nested dicts.
+        strings = []
+        string_indexes = {}
+
+        def string_index(string):
+            if string not in string_indexes:
+                string_indexes[string] = len(strings)
+                strings.append(string)
+
+            return string_indexes[string]
+
+        def deduplicate(node):
+            entries = []
+            for (key, value) in node.items():
+                entries.append(string_index(key))
+                if isinstance(value, dict):
+                    entries.append(deduplicate(value))
+                else:
+                    entries.append(string_index(value))
+
+            return entries
+
+        return {
+            "base16-encoding": "deduplicated",
+            "schemes": deduplicate(schemes),
+            "strings": strings,
+        }
+
+    return schemes
+
+
+# Packed exports start with this, a format version and the length of a JSON
+# header holding each scheme's slug, name and author. A fixed size row of each
+# scheme's packed colors and upper case hex digits follows it.
+PACKED_EXPORT_MAGIC = b"B16P"
+PACKED_EXPORT_VERSION = 1
+PACKED_EXPORT_ROW = struct.Struct("<48s12s")
+
+
+def export_schemes(schemes, export_format, palette=False):
+    """
+    Encodes every scheme's variables into a single file's contents, with one
+    row per scheme. Packed exports only hold the schemes' parsed records, and
+    read_scheme_export derives their variables again.
+    """
+    if export_format == "packed":
+        header = dict(palette=palette, slugs=[], names=[], authors=[])
+        rows = []
+        for scheme in schemes:
+            header["slugs"].append(scheme.slug())
+            header["names"].append(scheme.name)
+            header["authors"].append(scheme.author)
+            rows.append(
+                PACKED_EXPORT_ROW.pack(
+                    scheme.colors, scheme._uppercase_digits.to_bytes(12, "little")
+                )
+            )
+
+        encoded_header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        return b"".join(
+            [
+                PACKED_EXPORT_MAGIC,
+                struct.pack("<BI", PACKED_EXPORT_VERSION, len(encoded_header)),
+                encoded_header,
+            ]
+            + rows
+        )
+
+    export = io.StringIO()
+    if export_format == "csv":
+        writer = None
+        for scheme in schemes:
+            variables = scheme.base16_variables(palette)
+            if writer is None:
+                writer = csv.DictWriter(export, list(variables), lineterminator="\n")
+                writer.writeheader()
+            writer.writerow(variables.materialize())
+    else:
+        for scheme in schemes:
+            export.write(
+                json.dumps(
+                    scheme.base16_variables(palette).materialize(),
+                    sort_keys=True,
+                    separators=(",", ":"),
+                )
+            )
+            export.write("\n")
+
+    return export.getvalue().encode("utf-8")
+
+
+def read_scheme_export(path):
+    """
+    Reads a file written by export_path in any format, returning a list of
+    each scheme's variables in the order they were exported
+    """
+    with open(path, "rb") as export_file:
+        return decode_scheme_export(export_file.read())
+
+
+def decode_scheme_export(data):
+    if data.startswith(PACKED_EXPORT_MAGIC):
+        offset = len(PACKED_EXPORT_MAGIC)
+        (version, header_length) = struct.unpack_from("<BI", data, offset)
+        if version != PACKED_EXPORT_VERSION:
+            raise ValueError("Unknown packed export version {}".format(version))
+
+        offset += struct.calcsize("<BI")
+        header = json.loads(data[offset : offset + header_length].decode("utf-8"))
+        offset += header_length
+
+        exported = []
+        for (row_index, slug) in enumerate(header["slugs"]):
+            (colors, uppercase_digits) = PACKED_EXPORT_ROW.unpack_from(
+                data, offset + row_index * PACKED_EXPORT_ROW.size
+            )
+            scheme = Scheme.from_record(
+                (
+                    "{}.yaml".format(slug),
+                    header["authors"][row_index],
+                    header["names"][row_index],
+                    colors,
+                    int.from_bytes(uppercase_digits, "little"),
+                )
+            )
+            exported.append(scheme.base16_variables(header["palette"]).materialize())
+
+        return exported
+
+    text = data.decode("utf-8")
+    if text.startswith("{"):
+        return [json.loads(line) for line in text.splitlines() if line]
+
+    return [dict(row) for row in csv.DictReader(io.StringIO(text))]
+
+
+class GitBackend(object):
+    def gc(self, path):
+        pass
+
+    def remote_revision(self, url):
+        return None
+
+    def pull_needed(self, url, path):
+        """
+        Returns whether pulling the repo at path would change it, or None if
+        that can't be told without pulling
+        """
+        remote_revision = self.remote_revision(url)
+        if remote_revision is None:
+            return None
+
+        return remote_revision != repo_revision(path)
+
+    def checkout(self, url, path, revision):
+        """
+        Resets the repo at path to the given commit, fetching just that commit
+        if it isn't in the repo yet. Returns whether the checkout changed.
+        """
+        if repo_revision(path) == revision:
+            return False
+
+        if not self.has_revision(path, revision):
+            self.fetch_revision(url, path, revision)
+
+        self.reset(path, revision)
+        return True
+
+    def repo_at_path(self, url, path):
+        """
+        This is a very rough heuristic to tell if there's a git repo at the
+        path that points to the same repo URL we were given. It would be better
+        to parse the file, but that would pull in another dependency :/
+        """
+        git_config_path = os.path.join(path, ".git", "config")
+        if not os.path.exists(git_config_path):
+            return False
+
+        with open(git_config_path) as git_config:
+            if "url = {}".format(url) in git_config.read():
+                return True
+
+        return False
+
+
+class SubprocessGitBackend(GitBackend):
+    """Runs the git CLI for every clone and pull"""
+
+    def __init__(self, module, commands):
+        self.module = module
+        self.commands = commands
+        self._git_path = None
+
+    def git_path(self):
+        if self._git_path is None:
+            self._git_path = self.module.get_bin_path("git")
+            if self._git_path is None:
+                self.commands.fail(msg="Failed to find required executable git")
+
+        return self._git_path
+
+    def clone(self, url, path):
+        # A clone killed by git_timeout leaves a partial checkout behind, which
+        # git would refuse to clone over
+        self._run_remote(
+            [self.git_path(), "clone", url, path],
+            before_retry=lambda: shutil.rmtree(path, ignore_errors=True),
+        )
+
+    def pull(self, url, path):
+        """
+        Returns False if the pull timed out and stale_on_timeout kept the
+        cached repo as it was
+        """
+        return (
+            self._run_remote(
+                [self.git_path(), "pull"],
+                cwd=path,
+                stale_on_timeout=self.module.params["stale_on_timeout"],
+            )
+            is not None
+        )
+
+    def gc(self, path):
+        # Only does anything if enough loose objects have piled up
+        self.commands.run([self.git_path(), "gc", "--auto", "--quiet"], cwd=path)
+
+    def remote_revision(self, url):
+        (rc, stdout, _) = self._run_remote(
+            [self.git_path(), "ls-remote", url, "HEAD"], check_rc=False
+        )
+        if rc != 0 or not stdout.split():
+            return None
+
+        return stdout.split()[0]
+
+    def has_revision(self, path, revision):
+        (rc, _, _) = self.commands.run(
+            [self.git_path(), "cat-file", "-e", "{}^{{commit}}".format(revision)],
+            cwd=path,
+        )
+        return rc == 0
+
+    def fetch_revision(self, url, path, revision):
+        (rc, _, _) = self._run_remote(
+            [self.git_path(), "fetch", "--quiet", "origin", revision],
+            cwd=path,
+            check_rc=False,
+        )
+        # Some servers don't allow fetching commits by their sha, so fall back
+        # to fetching everything
+        if rc != 0:
+            self._run_remote([self.git_path(), "fetch", "--quiet", "origin"], cwd=path)
+
+    def reset(self, path, revision):
+        self.commands.run(
+            [self.git_path(), "reset", "--quiet", "--hard", revision],
+            cwd=path,
+            check_rc=True,
+        )
+
+    def _run_remote(
+        self, args, cwd=None, check_rc=True, stale_on_timeout=False, before_retry=None
+    ):
+        """
+        Runs a git command that talks to a remote, killing it if it runs for
+        longer than git_timeout and retrying failures up to git_retries times
+        with exponential backoff, calling before_retry first. Returns the last
+        attempt's rc, stdout and stderr, with an rc of None if it timed out,
+        or None if an attempt timed out and stale_on_timeout is set.
+        """
+        timeout = self.module.params["git_timeout"]
+        timed_out = False
+        retries = self.module.params["git_retries"]
+        for attempt in range(retries + 1):
+            # Without a timeout, the last attempt fails the same way git
+            # commands always have
+            (rc, stdout, stderr) = self.commands.run(
+                args,
+                cwd,
+                check_rc=check_rc and not timeout and attempt == retries,
+                timeout=timeout,
+            )
+
+            if rc == 0:
+                break
+
+            timed_out = timed_out or rc is None
+            if attempt < retries:
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+                if before_retry is not None:
+                    before_retry()
+
+        # A timeout is the reason for the failure even if a later attempt
+        # failed some other way
+        if rc != 0 and check_rc:
+            if timed_out:
+                if stale_on_timeout:
+                    return None
+
+                self.commands.fail(
+                    cmd=args,
+                    msg="{} timed out after {} seconds".format(" ".join(args), timeout),
+                )
+
+            self.commands.fail(
+                cmd=args, rc=rc, stdout=stdout, stderr=stderr, msg=stderr.rstrip()
+            )
+
+        return (rc, stdout, stderr)
+
+
+class DulwichGitBackend(GitBackend):
+    """
+    Clones and pulls in process with Dulwich, avoiding a git process per repo
+    and sharing one HTTP connection pool across every repo
+    """
+
+    def __init__(self, module, commands):
+        self.module = module
+        self.commands = commands
+        self._pool_manager = None
+
+    def clone(self, url, path):
+        try:
+            porcelain.clone(
+                url, path, errstream=io.BytesIO(), **self._transport_kwargs(url)
+            )
+        except Exception as err:
+            self.commands.fail(msg="Failed to clone {}: {}".format(url, err))
+
+    def pull(self, url, path):
+        try:
+            porcelain.pull(
+                path,
+                errstream=io.BytesIO(),
+                outstream=io.BytesIO(),
+                **self._transport_kwargs(url)
+            )
+        except Exception as err:
+            self.commands.fail(msg="Failed to pull {}: {}".format(url, err))
+
+    def remote_revision(self, url):
+        try:
+            refs = porcelain.ls_remote(url)
+        except Exception:
+            return None
+
+        # Older Dulwich versions return the refs dict itself
+        head = getattr(refs, "refs", refs).get(b"HEAD")
+        return head.decode("ascii") if head else None
+
+    def has_revision(self, path, revision):
+        with porcelain.open_repo_closing(path) as repo:
+            return revision.encode("ascii") in repo.object_store
+
+    def fetch_revision(self, url, path, revision):
+        # Dulwich can't ask for a single commit, so this fetches everything the
+        # remote has. Porcelain's fetch can't share the connection pool, so the
+        # client is made here.
+        try:
+            (client, remote_path) = get_transport_and_path(
+                url, **self._transport_kwargs(url)
+            )
+            with porcelain.open_repo_closing(path) as repo:
+                client.fetch(remote_path, repo)
+        except Exception as err:
+            self.commands.fail(msg="Failed to fetch {}: {}".format(url, err))
+
+    def reset(self, path, revision):
+        try:
+            porcelain.reset(path, "hard", revision.encode("ascii"))
+        except Exception as err:
+            self.commands.fail(
+                msg="Failed to check out {} in {}: {}".format(revision, path, err)
+            )
+
+    def _transport_kwargs(self, url):
+        if not url.startswith(("http://", "https://")):
+            return {}
+
+        if self._pool_manager is None:
+            if self.module.params["git_timeout"]:
+                self._pool_manager = default_urllib3_manager(
+                    None, timeout=self.module.params["git_timeout"]
+                )
+            else:
+                self._pool_manager = default_urllib3_manager(None)
+
+        return {"pool_manager": self._pool_manager}
+
+
+GIT_BACKENDS = {
+    "subprocess": SubprocessGitBackend,
+    "dulwich": DulwichGitBackend,
+}
+
+
+class ArchiveBackend(object):
+    """
+    Fetches a snapshot archive of each repo's default branch instead of
+    cloning it, which is a single download with no git history. The archive
+    URL template's {url} is filled in with the repo's URL, minus any trailing
+    .git, and {name} with the last part of that URL. It can also be a local
+    path, e.g. to a mirror of archives.
+
+    The archive's ETag and Last-Modified headers, or a local archive's size
+    and modification time, are recorded beside the unpacked repo so that
+    pulling only downloads the archive again if it changed.
+    """
+
+    metadata_file_name = ".base16-archive.json"
+
+    def __init__(self, module, commands, archive_url):
+        self.module = module
+        self.commands = commands
+        self.archive_url = archive_url
+
+    def archive_url_for(self, url):
+        url = url.rstrip("/")
+        if url.endswith(".git"):
+            url = url[: -len(".git")]
+
+        return self.archive_url.format(url=url, name=url.rsplit("/", 1)[-1])
+
+    def repo_at_path(self, url, path):
+        return self._metadata(path).get("url") == url
+
+    def gc(self, path):
+        pass
+
+    def clone(self, url, path):
+        self._fetch(url, path, {})
+
+    def pull_needed(self, url, path):
+        archive_url = self.archive_url_for(url)
+        metadata = self._metadata(path)
+        if os.path.exists(archive_url):
+            return self._local_revision(archive_url) != metadata.get("revision")
+
+        try:
+            open_url(
+                archive_url,
+                method="HEAD",
+                headers=self._conditional_headers(metadata),
+                **self._timeout_kwargs()
+            )
+        except HTTPError as err:
+            if err.code == 304:
+                return False
+
+            return None
+        except Exception:
+            return None
+
+        return True
+
+    def pull(self, url, path):
+        self._fetch(url, path, self._metadata(path))
+
+    def _metadata(self, path):
+        metadata_path = os.path.join(path, self.metadata_file_name)
+        if not os.path.exists(metadata_path):
+            return {}
+
+        with open(metadata_path) as metadata_file:
+            return json.load(metadata_file)
+
+    def _fetch(self, url, path, metadata):
+        archive_url = self.archive_url_for(url)
+
+        if os.path.exists(archive_url):
+            revision = self._local_revision(archive_url)
+            if metadata.get("revision") == revision:
+                return
+
+            with open(archive_url, "rb") as archive:
+                self._unpack(archive, archive_url, path)
+
+            self._write_metadata(path, url=url, revision=revision)
+            return
+
+        try:
+            response = open_url(
+                archive_url,
+                headers=self._conditional_headers(metadata),
+                **self._timeout_kwargs()
+            )
+        except HTTPError as err:
+            if err.code == 304:
+                return
+
+            self.commands.fail(msg="Failed to download {}: {}".format(archive_url, err))
+        except Exception as err:
+            self.commands.fail(msg="Failed to download {}: {}".format(archive_url, err))
+
+        self._unpack(response, archive_url, path)
+        self._write_metadata(
+            path,
+            url=url,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+
+    def _local_revision(self, archive_url):
+        archive_stat = os.stat(archive_url)
+        return "{}-{}".format(archive_stat.st_size, archive_stat.st_mtime)
+
+    def _timeout_kwargs(self):
+        if not self.module.params["git_timeout"]:
+            return {}
+
+        return {"timeout": self.module.params["git_timeout"]}
+
+    def _conditional_headers(self, metadata):
+        headers = {}
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+        return headers
+
+    def _unpack(self, archive, archive_url, path):
+        unpack_dir = tempfile.mkdtemp(dir=os.path.dirname(path))
+        try:
+            if archive_url.endswith(".zip"):
+                # Zip archives can't be read as a stream
+                with tempfile.TemporaryFile() as spooled_archive:
+                    shutil.copyfileobj(archive, spooled_archive)
+                    with zipfile.ZipFile(spooled_archive) as zip_archive:
+                        for member in zip_archive.infolist():
+                            if member.filename.endswith("/"):
+                                continue
+
+                            with zip_archive.open(member) as member_file:
+                                self._unpack_file(
+                                    member_file, member.filename, unpack_dir
+                                )
+            else:
+                with tarfile.open(fileobj=archive, mode="r|*") as tar_archive:
+                    for member in tar_archive:
+                        # Links and special files are skipped, since they
+                        # could point outside of the repo
+                        if not member.isfile():
+                            continue
+
+                        self._unpack_file(
+                            tar_archive.extractfile(member), member.name, unpack_dir
+                        )
+        except (OSError, tarfile.TarError, zipfile.BadZipfile) as err:
+            shutil.rmtree(unpack_dir)
+            self.commands.fail(msg="Failed to unpack {}: {}".format(archive_url, err))
+
+        # Archives of a repo usually hold everything in one top level dir
+        repo_dir = unpack_dir
+        unpacked = os.listdir(unpack_dir)
+        if len(unpacked) == 1 and os.path.isdir(os.path.join(unpack_dir, unpacked[0])):
+            repo_dir = os.path.join(unpack_dir, unpacked[0])
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(repo_dir, path)
+        if os.path.exists(unpack_dir):
+            shutil.rmtree(unpack_dir)
+
+    def _unpack_file(self, member_file, member_name, unpack_dir):
+        member_path = os.path.normpath(os.path.join(unpack_dir, member_name))
+        if not member_path.startswith(unpack_dir + os.sep):
+            return
+
+        if not os.path.exists(os.path.dirname(member_path)):
+            os.makedirs(os.path.dirname(member_path))
+
+        with open(member_path, "wb") as unpacked_file:
+            shutil.copyfileobj(member_file, unpacked_file)
+
+    def _write_metadata(self, path, **metadata):
+        with open(os.path.join(path, self.metadata_file_name), "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+
+
+class GitRepo(object):
+    def __init__(self, builder, url_or_local_path, clone_dest):
+        self.builder = builder
+        self.module = builder.module
+        self.git_backend = builder.git_backend
+
+        if os.path.exists(url_or_local_path):
+            self.path = url_or_local_path
+            self.local_repo = True
+        else:
+            self.local_repo = False
+            self.url = url_or_local_path
+            self.path = clone_dest
+
+        self.lock = RepoLock(
+            self.path, enabled=not self.local_repo, touch=not builder.module.check_mode
+        )
+
+    def clone_or_pull(self):
+        if self.local_repo:
+            return
+
+        if not self.clone_if_missing():
+            self.builder.result["changed"] = True
+            if self.module.check_mode:
+                return
+
+            with self.lock.exclusive(), self.builder.timed(self.path, "pull"):
+                if self.git_backend.pull(self.url, self.path) is False:
+                    self.builder.result.setdefault("stale", []).append(self.path)
+
+    def clone_if_missing(self):
+        if self.local_repo:
+            return
+
+        if not os.path.exists(os.path.dirname(self.path)):
+            self.builder.result["changed"] = True
+            if self.module.check_mode:
+                return
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        if self._repo_at_path():
+            self.pin()
+            return False
+
+        self.builder.result["changed"] = True
+        if self.module.check_mode:
+            return
+
+        with self.lock.exclusive():
+            # Another run may have cloned the repo while we waited on the lock
+            cloned = not self._repo_at_path()
+            if cloned:
+                # If a different repo, or the remains of an interrupted clone,
+                # is at the given path, replace it
+                if os.path.exists(self.path):
+                    shutil.rmtree(self.path)
+
+                with self.builder.timed(self.path, "clone"):
+                    self.git_backend.clone(self.url, self.path)
+
+        self.pin()
+        return cloned
+
+    def pin(self):
+        """Checks out the commit the lockfile pins this repo to, if any"""
+        revision = self.builder.revision_lock.pinned_revision(self)
+        if revision is None:
+            return
+
+        if self.module.check_mode:
+            if repo_revision(self.path) != revision:
+                self.builder.result["changed"] = True
+            return
+
+        with self.lock.exclusive(), self.builder.timed(self.path, "checkout"):
+            if self.git_backend.checkout(self.url, self.path, revision):
+                self.builder.result["changed"] = True
+
+    def _repo_at_path(self):
+        return self.git_backend.repo_at_path(self.url, self.path)
+
+
+class RevisionLock(object):
+    """
+    A lockfile of the commit every source list and scheme and template repo
+    is at. Update writes it, and other runs check every repo out at the
+    commit it pins, so hosts sharing a lockfile all build from the same
+    revisions without pulling anything. Commits that aren't cached yet are
+    fetched on their own.
+    """
+
+    def __init__(self, builder):
+        self.builder = builder
+        self.module = builder.module
+        self.path = self.module.params["lockfile"]
+        # Update writes a new lockfile, and a missing one is written by the
+        # first build, so only an existing one is enforced
+        self.enforced = (
+            self.path is not None
+            and not self.module.params["update"]
+            and os.path.exists(self.path)
+        )
+        self.revisions = None
+        self.pinned_paths = set()
+
+    def load(self):
+        if self.revisions is None:
+            self.revisions = {}
+            lockfile = open_yaml(self.path) or {}
+            for source_type in ("schemes", "templates"):
+                for revisions in (lockfile.get(source_type) or {}).values():
+                    self.revisions.update(revisions or {})
+
+        return self.revisions
+
+    def pinned_revision(self, git_repo):
+        """
+        Returns the commit to check a repo out at, or None if the lockfile
+        isn't being enforced, doesn't list the repo, or it was already pinned
+        by this run
+        """
+        if not self.enforced or git_repo.path in self.pinned_paths:
+            return None
+
+        self.pinned_paths.add(git_repo.path)
+        return self.load().get(git_repo.url)
+
+    def save(self):
+        if self.path is None or self.module.check_mode:
+            return
+
+        # Runs that skip templates, or only have some repos cached, keep what
+        # the lockfile already pins for everything else
+        lockfile = {}
+        if os.path.exists(self.path):
+            lockfile = open_yaml(self.path) or {}
+
+        for base16_source_repo in self.builder.source_repos:
+            locked = lockfile.get(base16_source_repo.source_type) or {}
+            source_lists = locked.get("source_lists") or {}
+            source_lists.update(self._revisions(base16_source_repo.list_repos))
+            repos = locked.get("repos") or {}
+            repos.update(
+                self._revisions(
+                    source_repo.git_repo
+                    for source_repo in base16_source_repo.source_repos()
+                )
+            )
+            lockfile[base16_source_repo.source_type] = dict(
+                source_lists=source_lists, repos=repos
+            )
+
+        write_file(self.path, yaml.safe_dump(lockfile, default_flow_style=False))
+
+    def _revisions(self, git_repos):
+        revisions = {}
+        for git_repo in git_repos:
+            if not git_repo.local_repo and os.path.isdir(git_repo.path):
+                revisions[git_repo.url] = repo_revision(git_repo.path)
+
+        return revisions
+
+
+def remove_cached_repo(module, repo_path):
+    if module.check_mode:
+        return
+
+    with RepoLock(repo_path).exclusive():
+        shutil.rmtree(repo_path)
+
+
+def cached_repo_last_used(repo_path):
+    lock_path = RepoLock(repo_path).path
+    if os.path.exists(lock_path):
+        return os.path.getmtime(lock_path)
+
+    return os.path.getmtime(repo_path)
+
+
+def disk_usage(path):
+    usage = 0
+    for (dir_path, _, file_names) in os.walk(path):
+        for file_name in file_names:
+            usage += os.lstat(os.path.join(dir_path, file_name)).st_size
+
+    return usage
+
+
+class Base16SourceRepo(object):
+    def __init__(self, builder, source_repo_class):
+        self.builder = builder
+        self.module = builder.module
+        self.source_repo_class = source_repo_class
+        self.source_type = source_repo_class.source_type
+        self.list_repos = [
+            GitRepo(builder, source, self._list_repo_path(list_index, source))
+            for (list_index, source) in enumerate(
+                self.module.params["{}_source".format(self.source_type)]
+            )
+        ]
+        self.source_list = None
+        self.records = None
+
+    def _sources_dir(self):
+        return os.path.join(
+            self.module.params["cache_dir"], "base16-builder-ansible", "sources"
+        )
+
+    def _list_repo_path(self, list_index, source):
+        # The first list keeps the path a single source list has always used
+        if list_index == 0:
+            return os.path.join(self._sources_dir(), self.source_type)
+
+        return os.path.join(
+            self._sources_dir(),
+            "{}-{}".format(
+                self.source_type, hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]
+            ),
+        )
+
+    def _merged_source_list(self):
+        """
+        Merges every source list in order, so later lists override the repo
+        a family name maps to in earlier ones. A repo listed under more than
+        one family name is only kept under the first.
+        """
+        merged = collections.OrderedDict()
+        for list_repo in self.list_repos:
+            with list_repo.lock.shared():
+                merged.update(
+                    open_yaml(os.path.join(list_repo.path, "list.yaml")) or {}
+                )
+
+        source_list = collections.OrderedDict()
+        source_urls = set()
+        for (source_family, source_url) in merged.items():
+            if source_url not in source_urls:
+                source_urls.add(source_url)
+                source_list[source_family] = source_url
+
+        return source_list
+
+    def _clone_lists_if_missing(self):
+        for list_repo in self.list_repos:
+            list_repo.clone_if_missing()
+
+    def _source_repos(self):
+        # Template repos are listed once per scheme built, so the lists are
+        # only merged again after they've been updated
+        if self.source_list is None:
+            self.source_list = self._merged_source_list()
+
+        for (source_family, source_url) in self.source_list.items():
+            # Not sure if caching this value would be good or not
+            yield self.source_repo_class(
+                self.builder,
+                source_family,
+                source_url,
+                os.path.join(
+                    self.module.params["cache_dir"],
+                    "base16-builder-ansible",
+                    self.source_type,
+                    source_family,
+                ),
+            )
+
+    def sources(self):
+        self._clone_lists_if_missing()
+
+        source_repos = self._source_repos()
+        if self.builder.pool is not None or self.records is not None:
+            parsed_repos = self._parse_in_workers(source_repos)
+        else:
+            parsed_repos = ((source_repo, None) for source_repo in source_repos)
+
+        for (source_repo, records) in parsed_repos:
+            for source in source_repo.sources(records):
+                yield source
+
+    def _parse_in_workers(self, source_repos):
+        """
+        Parses source repos in the builder's worker pool, yielding each repo
+        in order along with its records as soon as it's been parsed. Repos are
+        only cloned and queued for parsing one worker's worth ahead of the one
+        being yielded, so cloning still overlaps with rendering. Records are
+        kept for the rest of the run, so only the first pass over the repos
+        needs the pool.
+        """
+        if self.records is None:
+            self.records = {}
+            pool = self.builder.pool
+            lookahead = self.module.params["workers"] or multiprocessing.cpu_count()
+        else:
+            pool = None
+            lookahead = 1
+
+        metrics = self.builder.metrics
+
+        source_repos = iter(source_repos)
+        pending = collections.deque()
+        while True:
+            while len(pending) < lookahead:
+                source_repo = next(source_repos, None)
+                if source_repo is None:
+                    break
+
+                parse_job = source_repo.parse_job()
+                if pool is None or parse_job is None:
+                    pending.append((source_repo, None))
+                    continue
+
+                source_repo.clone_if_missing()
+                pending.append((source_repo, pool.apply_async(*parse_job)))
+
+            if not pending:
+                return
+
+            (source_repo, parsed) = pending.popleft()
+            if parsed is not None:
+                self.records[source_repo.name] = parsed.get()
+                metrics.inc("source_parses_total", type=self.source_type)
+                metrics.cache_lookup("parsed_sources", False)
+            elif source_repo.name in self.records:
+                metrics.cache_lookup("parsed_sources", True)
+
+            yield (source_repo, self.records.get(source_repo.name))
+
+    def source_repos(self):
+        self._clone_lists_if_missing()
+        return self._source_repos()
+
+    def planned_source_repos(self):
+        """
+        Returns the source repos that a run with the module's params would
+        use, or none if any of the source lists aren't cached yet
+        """
+        if not all(
+            os.path.exists(os.path.join(list_repo.path, "list.yaml"))
+            for list_repo in self.list_repos
+        ):
+            return []
+
+        return [
+            source_repo
+            for source_repo in self._source_repos()
+            if source_repo._matches_params()
+        ]
+
+    def update(self):
+        self.update_lists()
+        for source_repo in self._source_repos():
+            source_repo.clone_or_pull()
+
+    def update_lists(self):
+        for list_repo in self.list_repos:
+            list_repo.clone_or_pull()
+
+        self.source_list = None
+
+    def cache_dir(self):
+        return os.path.join(
+            self.module.params["cache_dir"], "base16-builder-ansible", self.source_type
+        )
+
+    def cached_repo_paths(self):
+        if not os.path.isdir(self.cache_dir()):
+            return []
+
+        return [
+            os.path.join(self.cache_dir(), entry)
+            for entry in sorted(os.listdir(self.cache_dir()))
+            if not entry.startswith(".")
+            and os.path.isdir(os.path.join(self.cache_dir(), entry))
+        ]
+
+    def prune(self):
+        """
+        Removes cached repos for families that are no longer in the source
+        lists, along with their lock files, and cached source lists that are
+        no longer used. Returns the removed repos' paths.
+        """
+        if not all(
+            os.path.exists(os.path.join(list_repo.path, "list.yaml"))
+            for list_repo in self.list_repos
+        ):
+            return []
+
+        pruned = []
+        list_repo_paths = set(list_repo.path for list_repo in self.list_repos)
+        if os.path.isdir(self._sources_dir()):
+            for entry in sorted(os.listdir(self._sources_dir())):
+                list_repo_path = os.path.join(self._sources_dir(), entry)
+                if (
+                    entry.startswith("{}-".format(self.source_type))
+                    and os.path.isdir(list_repo_path)
+                    and list_repo_path not in list_repo_paths
+                ):
+                    pruned.append(list_repo_path)
+                    remove_cached_repo(self.module, list_repo_path)
+
+        families = set(source_repo.name for source_repo in self._source_repos())
+        for repo_path in self.cached_repo_paths():
+            if os.path.basename(repo_path) in families:
+                continue
+
+            pruned.append(repo_path)
+            remove_cached_repo(self.module, repo_path)
+
+        for entry in os.listdir(self.cache_dir()):
+            if (
+                entry.startswith(".")
+                and entry.endswith(".lock")
+                and entry[1 : -len(".lock")] not in families
+                and not os.path.exists(
+                    os.path.join(self.cache_dir(), entry[1 : -len(".lock")])
+                )
+                and not self.module.check_mode
+            ):
+                os.remove(os.path.join(self.cache_dir(), entry))
+
+        return pruned
+
+
+BASE16_BASES = ["base{:02X}".format(i) for i in range(16)]
+
+SCHEME_META_VARIABLES = [
+    "scheme-author",
+    "scheme-name",
+    "scheme-slug",
+    "scheme-slug-underscored",
+]
+
+# Every color variable is one channel (or all three) of one base, so it can be
+# derived from a scheme's packed colors when looked up instead of being stored
+BASE16_COLOR_VARIABLES = []
+for (_base_index, _base_key) in enumerate(BASE16_BASES):
+    for (_suffix, _channel, _format) in [
+        ("hex", 0, "hex"),
+        ("hex-r", 0, "hex-channel"),
+        ("hex-g", 1, "hex-channel"),
+        ("hex-b", 2, "hex-channel"),
+        ("hex-bgr", 0, "hex-bgr"),
+        ("rgb-r", 0, "rgb"),
+        ("rgb-g", 1, "rgb"),
+        ("rgb-b", 2, "rgb"),
+        ("dec-r", 0, "dec"),
+        ("dec-g", 1, "dec"),
+        ("dec-b", 2, "dec"),
+    ]:
+        BASE16_COLOR_VARIABLES.append(
+            ("{}-{}".format(_base_key, _suffix), _base_index * 3 + _channel, _format)
+        )
+
+BASE16_VARIABLE_NAMES = SCHEME_META_VARIABLES + [
+    name for (name, _, _) in BASE16_COLOR_VARIABLES
+]
+_COLOR_VARIABLE_SLOTS = dict(
+    (name, (offset, var_format))
+    for (name, offset, var_format) in BASE16_COLOR_VARIABLES
+)
+
+# Terminal palette approximations and contrast of each base, which are only
+# added when palette_variables is set
+PALETTE_VARIABLE_NAMES = [
+    "{}-{}".format(base_key, suffix)
+    for base_key in BASE16_BASES
+    for suffix in ["xterm256", "ansi16", "luminance", "contrast"]
+]
+
+# xterm's default 16 colors
+ANSI16_COLORS = [
+    (0x00, 0x00, 0x00),
+    (0xCD, 0x00, 0x00),
+    (0x00, 0xCD, 0x00),
+    (0xCD, 0xCD, 0x00),
+    (0x00, 0x00, 0xEE),
+    (0xCD, 0x00, 0xCD),
+    (0x00, 0xCD, 0xCD),
+    (0xE5, 0xE5, 0xE5),
+    (0x7F, 0x7F, 0x7F),
+    (0xFF, 0x00, 0x00),
+    (0x00, 0xFF, 0x00),
+    (0xFF, 0xFF, 0x00),
+    (0x5C, 0x5C, 0xFF),
+    (0xFF, 0x00, 0xFF),
+    (0x00, 0xFF, 0xFF),
+    (0xFF, 0xFF, 0xFF),
+]
+
+# The xterm-256 colors past the first 16, which terminals don't let themes
+# redefine: a 6x6x6 color cube followed by 24 grays
+XTERM256_COLORS = list(
+    enumerate(
+        [
+            (red, green, blue)
+            for red in [0, 95, 135, 175, 215, 255]
+            for green in [0, 95, 135, 175, 215, 255]
+            for blue in [0, 95, 135, 175, 215, 255]
+        ]
+        + [(8 + 10 * gray, 8 + 10 * gray, 8 + 10 * gray) for gray in range(24)],
+        16,
+    )
+)
+
+# The nearest terminal colors of every color seen so far. Schemes share most
+# of their colors, so most lookups across a build are hits.
+_NEAREST_TERMINAL_COLORS = {}
+
+
+def nearest_terminal_colors(rgb):
+    """
+    Returns the indexes of the xterm-256 and ANSI 16 colors nearest to an RGB
+    color, by their distance in RGB space
+    """
+    nearest = _NEAREST_TERMINAL_COLORS.get(rgb)
+    if nearest is None:
+
+        def distance(color):
+            return sum((channel - other) ** 2 for (channel, other) in zip(rgb, color))
+
+        nearest = (
+            min(XTERM256_COLORS, key=lambda indexed: distance(indexed[1]))[0],
+            min(range(16), key=lambda index: distance(ANSI16_COLORS[index])),
+        )
+        _NEAREST_TERMINAL_COLORS[rgb] = nearest
+
+    return nearest
+
+
+class SchemeVariables(Mapping):
+    """
+    Read only mapping of a scheme's Base16 template variables. Values are
+    derived from the scheme's packed colors on access, and materialize() turns
+    the view into a plain dict for places that need one, like the module
+    result.
+
+    Pystache doesn't treat non-dict mappings as hashes and looks names up as
+    attributes instead, so attribute access is routed through the mapping too.
+    """
+
+    __slots__ = ("_scheme", "_palette", "_names")
+
+    def __init__(self, scheme, palette=None):
+        self._scheme = scheme
+        self._palette = palette
+        if palette is None:
+            self._names = BASE16_VARIABLE_NAMES
+        else:
+            self._names = BASE16_VARIABLE_NAMES + PALETTE_VARIABLE_NAMES
+
+    def __getitem__(self, name):
+        if name in _COLOR_VARIABLE_SLOTS:
+            return self._scheme.color_variable(*_COLOR_VARIABLE_SLOTS[name])
+        if self._palette is not None and name in self._palette:
+            return self._palette[name]
+
+        if name == "scheme-author":
+            return self._scheme.author
+        if name == "scheme-name":
+            return self._scheme.name
+        if name == "scheme-slug":
+            return self._scheme.slug()
+        if name == "scheme-slug-underscored":
+            return self._scheme.slug().replace("-", "_")
+
+        raise KeyError(name)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return (
+            name in _COLOR_VARIABLE_SLOTS
+            or name in SCHEME_META_VARIABLES
+            or (self._palette is not None and name in self._palette)
+        )
+
+    def materialize(self):
+        return dict((name, self[name]) for name in self._names)
+
+
+def parse_scheme(path):
+    """
+    Parses a scheme file into a compact record, small enough to be cheaply
+    passed back from a worker process
+    """
+    data = open_yaml(path)
+
+    colors = bytearray()
+    for base_key in BASE16_BASES:
+        colors.extend(bytearray.fromhex(data[base_key]))
+
+    # Remember which hex digits were written in upper case so colors are
+    # rendered back out exactly as the scheme author wrote them
+    uppercase_digits = 0
+    for (digit_index, digit) in enumerate(
+        "".join(data[base_key] for base_key in BASE16_BASES)
+    ):
+        if digit.isupper():
+            uppercase_digits |= 1 << digit_index
+
+    return (path, data["author"], data["scheme"], bytes(colors), uppercase_digits)
+
+
+def parse_scheme_repo(repo_path, lock):
+    with lock.shared():
+        return [
+            parse_scheme(os.path.join(repo_path, path))
+            for path in os.listdir(repo_path)
+            if os.path.splitext(path)[1] in [".yaml", ".yml"]
+        ]
+
+
+class Scheme(object):
+    """
+    A single color scheme, holding its 16 colors packed into a 48 byte buffer
+    rather than the parsed YAML or its full set of template variables.
+    """
+
+    __slots__ = ("path", "author", "name", "colors", "_uppercase_digits", "_slug")
+
+    def __init__(self, path):
+        self._set_record(parse_scheme(path))
+
+    @classmethod
+    def from_record(cls, record):
+        scheme = cls.__new__(cls)
+        scheme._set_record(record)
+        return scheme
+
+    def _set_record(self, record):
+        (self.path, self.author, self.name, self.colors, self._uppercase_digits) = record
+        self._slug = None
+
+    def slug(self):
+        if self._slug:
+            return self._slug
+
+        self._slug = (
+            os.path.splitext(os.path.basename(self.path))[0].lower().replace(" ", " ")
+        )
+
+        return self._slug
+
+    def base16_variables(self, palette=False):
+        """
+        With palette, the variables also include each base's nearest xterm-256
+        and ANSI 16 colors, relative luminance and contrast ratio with base00
+        """
+        if not palette:
+            return SchemeVariables(self)
+
+        return SchemeVariables(self, self.palette_variables())
+
+    def palette_variables(self):
+        luminances = [
+            relative_luminance(self.colors, base_index) for base_index in range(16)
+        ]
+        palette = {}
+        for (base_index, base_key) in enumerate(BASE16_BASES):
+            (xterm256, ansi16) = nearest_terminal_colors(
+                tuple(self.colors[base_index * 3 : base_index * 3 + 3])
+            )
+            (lighter, darker) = sorted(
+                [luminances[base_index], luminances[0]], reverse=True
+            )
+            palette["{}-xterm256".format(base_key)] = str(xterm256)
+            palette["{}-ansi16".format(base_key)] = str(ansi16)
+            palette["{}-luminance".format(base_key)] = "{:.4f}".format(
+                luminances[base_index]
+            )
+            palette["{}-contrast".format(base_key)] = "{:.2f}".format(
+                (lighter + 0.05) / (darker + 0.05)
+            )
+
+        return palette
+
+    def color_variable(self, offset, var_format):
+        if var_format == "rgb":
+            return str(self.colors[offset])
+        if var_format == "dec":
+            return str(self.colors[offset] / 255)
+
+        if var_format == "hex-channel":
+            return self._hex_channel(offset)
+
+        offsets = range(offset, offset + 3)
+        if var_format == "hex-bgr":
+            offsets = reversed(offsets)
+
+        return "".join(self._hex_channel(channel_offset) for channel_offset in offsets)
+
+    def _hex_channel(self, offset):
+        """Formats a channel in hex, in the case each digit was written in"""
+        hex_channel = "{:02x}".format(self.colors[offset])
+        uppercase = (self._uppercase_digits >> (offset * 2)) & 3
+        if uppercase == 0:
+            return hex_channel
+        if uppercase == 3:
+            return hex_channel.upper()
+        if uppercase == 1:
+            return hex_channel[0].upper() + hex_channel[1]
+
+        return hex_channel[0] + hex_channel[1].upper()
+
+
+class SchemeRepo(object):
     source_type = "schemes"
 
     def __init__(self, builder, name, source_url_or_local_path, clone_dest):
@@ -462,7 +2483,7 @@ class SchemeRepo(object):
         self.name = name
         self.git_repo = GitRepo(self.builder, source_url_or_local_path, clone_dest)
 
-    def sources(self):
+    def sources(self, records=None):
         # Only clone and yield scheme repos that could contain the requested
         # scheme. We still need to do an exact comparison with the scheme slug
         # to only yield a single requested scheme though.
@@ -471,24 +2492,54 @@ class SchemeRepo(object):
 
         self.git_repo.clone_if_missing()
 
-        for path in os.listdir(self.git_repo.path):
-            if os.path.splitext(path)[1] in [".yaml", ".yml"]:
-                # Cache schemes here?
-                scheme = Scheme(os.path.join(self.git_repo.path, path))
-                module_scheme_arg = self.module.params.get("scheme")
-                if (
-                    module_scheme_arg is not None
-                    and module_scheme_arg not in scheme.slug()
-                ):
-                    continue
+        if records is None:
+            (parse, parse_args) = self.parse_job()
+            records = parse(*parse_args)
+            self.builder.metrics.inc("source_parses_total", type=self.source_type)
+            self.builder.metrics.cache_lookup("parsed_sources", False)
+
+        for record in records:
+            scheme = Scheme.from_record(record)
+            module_scheme_arg = self.module.params.get("scheme")
+            if module_scheme_arg is not None and module_scheme_arg not in scheme.slug():
+                continue
+
+            yield scheme
+
+    def parse_job(self):
+        """
+        Returns the function and args that parse this repo into records, or
+        None if nothing in the repo will be built
+        """
+        if not self._matches_params():
+            return None
 
-                yield scheme
+        return (parse_scheme_repo, (self.git_repo.path, self.git_repo.lock))
+
+    def clone_if_missing(self):
+        if not self._matches_params():
+            return
+
+        self.git_repo.clone_if_missing()
 
     def clone_or_pull(self):
         if not self._matches_params():
             return
 
         self.git_repo.clone_or_pull()
+        self.builder.scheme_index.refresh(self)
+
+    def index(self):
+        """
+        Refreshes this repo's schemes in the scheme index, cloning it first if
+        needed. Returns whether the repo matched the module's params.
+        """
+        if not self._matches_params():
+            return False
+
+        self.git_repo.clone_if_missing()
+        self.builder.scheme_index.refresh(self)
+        return True
 
     def _matches_params(self):
         module_scheme_arg = self.module.params.get("scheme")
@@ -501,14 +2552,526 @@ class SchemeRepo(object):
         return self.name in module_scheme_family_arg
 
 
+def relative_luminance(colors, base_index):
+    """WCAG relative luminance of one of a scheme's packed base colors"""
+    linear = []
+    for channel in colors[base_index * 3 : base_index * 3 + 3]:
+        value = channel / 255
+        if value <= 0.03928:
+            linear.append(value / 12.92)
+        else:
+            linear.append(((value + 0.055) / 1.055) ** 2.4)
+
+    return 0.2126 * linear[0] + 0.7152 * linear[1] + 0.0722 * linear[2]
+
+
+def repo_revision(repo_path):
+    """
+    Returns the commit a cached repo's checkout is at. Repos that aren't git
+    checkouts, like local repos and unpacked archives, get a fingerprint of
+    all their files' names, sizes and mtimes instead.
+    """
+    git_dir = os.path.join(repo_path, ".git")
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as head_file:
+            head = head_file.read().strip()
+    except OSError:
+        head = ""
+
+    if head and not head.startswith("ref: "):
+        return head
+
+    ref = head[len("ref: ") :]
+    if ref:
+        try:
+            with open(os.path.join(git_dir, ref)) as ref_file:
+                return ref_file.read().strip()
+        except OSError:
+            pass
+
+        try:
+            with open(os.path.join(git_dir, "packed-refs")) as packed_refs_file:
+                for line in packed_refs_file:
+                    if line.split()[1:] == [ref]:
+                        return line.split()[0]
+        except OSError:
+            pass
+
+    fingerprint = hashlib.sha1()
+    for (dir_path, dir_names, file_names) in os.walk(repo_path):
+        dir_names[:] = sorted(dir_name for dir_name in dir_names if dir_name != ".git")
+        for file_name in sorted(file_names):
+            file_path = os.path.join(dir_path, file_name)
+            stat = os.stat(file_path)
+            fingerprint.update(
+                "{} {} {}\n".format(
+                    os.path.relpath(file_path, repo_path),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ).encode("utf-8")
+            )
+
+    return fingerprint.hexdigest()
+
+
+# Backgrounds (base00) darker than this contrast more with white text than
+# with black text, which is what makes a scheme dark
+DARK_LUMINANCE = 0.179
+
+SCHEME_QUERY_KEYS = [
+    "family",
+    "name",
+    "author",
+    "dark",
+    "min_luminance",
+    "max_luminance",
+]
+
+
+class SchemeIndex(object):
+    """
+    A catalogue of every cached scheme's metadata, kept in the cache so that
+    schemes can be queried without loading or rendering them. A family's
+    entries are only rebuilt when its repo is at a new revision.
+    """
+
+    def __init__(self, builder):
+        self.builder = builder
+        self.module = builder.module
+        self.path = os.path.join(
+            self.module.params["cache_dir"],
+            "base16-builder-ansible",
+            "scheme-index.json",
+        )
+        self.families = None
+        self.dirty = False
+        # Scheme repos are refreshed from fetch threads when concurrency is set
+        self.lock = threading.Lock()
+
+    def _families(self):
+        with self.lock:
+            if self.families is None:
+                index = read_json_file(self.path) or {}
+                self.families = index.get("families", {})
+
+        return self.families
+
+    def refresh(self, scheme_repo):
+        """
+        Reindexes a scheme repo's schemes if the repo has changed since it
+        was last indexed
+        """
+        repo_path = scheme_repo.git_repo.path
+        if not os.path.isdir(repo_path):
+            return
+
+        families = self._families()
+        revision = repo_revision(repo_path)
+        indexed = families.get(scheme_repo.name, {}).get("revision") == revision
+        self.builder.metrics.cache_lookup("scheme_index", indexed)
+        if indexed:
+            return
+
+        entries = []
+        for record in parse_scheme_repo(repo_path, scheme_repo.git_repo.lock):
+            scheme = Scheme.from_record(record)
+            luminance = relative_luminance(scheme.colors, 0)
+            entries.append(
+                {
+                    "slug": scheme.slug(),
+                    "family": scheme_repo.name,
+                    "name": scheme.name,
+                    "author": scheme.author,
+                    "luminance": round(luminance, 4),
+                    "dark": luminance < DARK_LUMINANCE,
+                }
+            )
+
+        families[scheme_repo.name] = {
+            "revision": revision,
+            "schemes": sorted(entries, key=lambda entry: entry["slug"]),
+        }
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty or self.module.check_mode:
+            return
+
+        write_json_file(self.path, {"families": self.families})
+        self.dirty = False
+
+    def prune(self, family_names):
+        """Drops the entries for families that are no longer cached"""
+        families = self._families()
+        for family_name in list(families.keys()):
+            if family_name not in family_names:
+                del families[family_name]
+                self.dirty = True
+
+        self.save()
+
+    def query(self, query, family_names):
+        """
+        Returns the slugs of indexed schemes in the given families that match
+        every key of the query
+        """
+        matches = []
+        for family_name in sorted(family_names):
+            if query.get("family") is not None and not fnmatch.fnmatch(
+                family_name.lower(), query["family"].lower()
+            ):
+                continue
+
+            for entry in self._families().get(family_name, {}).get("schemes", []):
+                if self._matches(entry, query):
+                    matches.append(entry["slug"])
+
+        return matches
+
+    def _matches(self, entry, query):
+        module_scheme_arg = self.module.params.get("scheme")
+        if module_scheme_arg is not None and module_scheme_arg not in entry["slug"]:
+            return False
+
+        for key in ["name", "author"]:
+            if query.get(key) is not None and not fnmatch.fnmatch(
+                entry[key].lower(), query[key].lower()
+            ):
+                return False
+
+        if query.get("dark") is not None and entry["dark"] != boolean(query["dark"]):
+            return False
+
+        if query.get("min_luminance") is not None and entry["luminance"] < float(
+            query["min_luminance"]
+        ):
+            return False
+
+        if query.get("max_luminance") is not None and entry["luminance"] > float(
+            query["max_luminance"]
+        ):
+            return False
+
+        return True
+
+
+# Matches a single variable tag, triple mustache and "&" tags included. Any
+# other tag (sections, partials, comments, delimiter changes, dotted names)
+# leaves a "{{" behind in the literal text between matches.
+FLAT_TEMPLATE_TAG = re.compile(
+    r"\{\{\{\s*(?P<raw_name>[\w-]+)\s*\}\}\}"
+    r"|\{\{(?P<unescaped>&?)\s*(?P<name>[\w-]+)\s*\}\}"
+)
+
+_FLAT_TEMPLATES = {}
+
+
+def compile_flat_template(source):
+    """
+    Compiles a template made up of nothing but variable tags into a list of
+    alternating literal text and (variable name, escaped) slots. Returns None
+    if the template needs any other mustache feature.
+    """
+    segments = []
+    position = 0
+    for match in FLAT_TEMPLATE_TAG.finditer(source):
+        literal = source[position : match.start()]
+        if "{{" in literal:
+            return None
+
+        segments.append(literal)
+        if match.group("raw_name"):
+            segments.append((match.group("raw_name"), False))
+        else:
+            segments.append((match.group("name"), not match.group("unescaped")))
+        position = match.end()
+
+    if "{{" in source[position:]:
+        return None
+
+    segments.append(source[position:])
+    return segments
+
+
+def render_flat_template(segments, variables):
+    # Mirror pystache's defaults: missing variables render as empty strings,
+    # and double mustache tags are HTML escaped
+    parts = list(segments)
+    for slot in range(1, len(parts), 2):
+        (name, escaped) = parts[slot]
+        value = variables.get(name, "")
+        parts[slot] = html.escape(value, quote=True) if escaped else value
+
+    return "".join(parts)
+
+
+# Matches a partial tag. Like pystache, a partial tag on a line of its own
+# replaces the whole line, and the partial is indented to match the tag.
+PARTIAL_TAG = re.compile(
+    r"(?:(?<=[\r\n])|\A)(?P<indent>[ \t]*)"
+    r"\{\{>\s*(?P<standalone_name>[\w-]+)\s*\}\}(?:\r\n?|\n|\Z)"
+    r"|\{\{>\s*(?P<name>[\w-]+)\s*\}\}"
+)
+PARTIAL_INDENT = re.compile(r"^(.)", re.M)
+MAX_PARTIAL_DEPTH = 10
+
+
+def read_template_source(path):
+    # Read templates the same way pystache does, without newline translation
+    with open(path, "rb") as template_file:
+        return template_file.read().decode(pystache.defaults.FILE_ENCODING)
+
+
+def template_file_stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def compile_template_file(path):
+    """
+    Compiles a template file into flat segments, inlining the partials it
+    uses. Returns the segments, or None if the template needs pystache, along
+    with every path the result depends on and a hash of their contents.
+    """
+    search_dir = os.path.dirname(path)
+    input_paths = [path]
+    source_hash = hashlib.sha256()
+
+    def expand_partials(source, depth):
+        if depth >= MAX_PARTIAL_DEPTH:
+            # Leaves the partial tags in place, so the template isn't flat
+            return source
+
+        def expand_partial(match):
+            name = match.group("standalone_name") or match.group("name")
+            partial_path = os.path.join(search_dir, "{}.mustache".format(name))
+            if partial_path not in input_paths:
+                input_paths.append(partial_path)
+
+            source_hash.update(name.encode("utf-8") + b"\0")
+            if not os.path.exists(partial_path):
+                return ""
+
+            partial = read_template_source(partial_path)
+            source_hash.update(partial.encode("utf-8") + b"\0")
+            if match.group("standalone_name"):
+                partial = PARTIAL_INDENT.sub(match.group("indent") + r"\1", partial)
+
+            return expand_partials(partial, depth + 1)
+
+        return PARTIAL_TAG.sub(expand_partial, source)
+
+    source = read_template_source(path)
+    source_hash.update(source.encode("utf-8") + b"\0")
+    segments = compile_flat_template(expand_partials(source, 0))
+    return (segments, input_paths, source_hash.hexdigest())
+
+
+class CompiledTemplateStore(object):
+    """
+    Keeps compiled templates in the cache, so builds can skip reading and
+    compiling template sources. Each template family has an index from its
+    template files to the size and mtime of every file they were compiled
+    from, and the hash the compiled form is stored under.
+    """
+
+    def __init__(self, module, metrics=None):
+        self.module = module
+        self.metrics = metrics
+        self.path = os.path.join(
+            module.params["cache_dir"], "base16-builder-ansible", "compiled-templates"
+        )
+        self.indexes = {}
+        self.dirty_families = set()
+        self.compiled = {}
+        # Template repos can't change while they're locked for a build, so
+        # each template only needs its inputs checked once per run
+        self.verified = {}
+
+    def segments(self, family, path):
+        if path in self.verified:
+            return self.verified[path]
+
+        index = self._index(family, os.path.dirname(path))
+        entry = index.get(os.path.basename(path))
+        if (
+            entry is not None
+            and all(
+                template_file_stat(input_path) == stat
+                for (input_path, stat) in entry["inputs"]
+            )
+            and self._load(entry["hash"])
+        ):
+            segments = self.compiled[entry["hash"]]
+            hit = True
+        else:
+            segments = self.compile(family, path)
+            hit = False
+
+        if self.metrics is not None:
+            self.metrics.cache_lookup("compiled_templates", hit)
+
+        self.verified[path] = segments
+        return segments
+
+    def compile(self, family, path):
+        (segments, input_paths, source_hash) = compile_template_file(path)
+        self.compiled[source_hash] = segments
+        self.verified.pop(path, None)
+
+        index = self._index(family, os.path.dirname(path))
+        index[os.path.basename(path)] = {
+            "hash": source_hash,
+            "inputs": [
+                [input_path, template_file_stat(input_path)]
+                for input_path in input_paths
+            ],
+        }
+        self.dirty_families.add(family)
+        if not self.module.check_mode:
+            write_json_file(
+                os.path.join(self.path, "objects", "{}.json".format(source_hash)),
+                {"segments": segments},
+            )
+
+        return segments
+
+    def compile_templates(self, family, templates_dir):
+        """
+        Compiles every template in a template repo, and records them in the
+        family's index. Called whenever the repo is cloned or pulled.
+        """
+        self.indexes[family] = (templates_dir, {})
+        for file_name in sorted(os.listdir(templates_dir)):
+            if file_name.endswith(".mustache"):
+                self.compile(family, os.path.join(templates_dir, file_name))
+
+        self.save(family)
+
+    def save(self, family):
+        if family not in self.dirty_families:
+            return
+
+        self.dirty_families.discard(family)
+        if self.module.check_mode:
+            return
+
+        (templates_dir, index) = self.indexes[family]
+        write_json_file(
+            os.path.join(self.path, "{}.json".format(family)),
+            {"templates_dir": templates_dir, "templates": index},
+        )
+
+    def prune(self):
+        """
+        Removes the indexes of template repos that are no longer cached, and
+        any compiled templates that no remaining index refers to
+        """
+        if self.module.check_mode or not os.path.isdir(self.path):
+            return
+
+        referenced_hashes = set()
+        for file_name in os.listdir(self.path):
+            index_path = os.path.join(self.path, file_name)
+            if not file_name.endswith(".json"):
+                continue
+
+            index = read_json_file(index_path)
+            if index is None or not os.path.isdir(index.get("templates_dir", "")):
+                os.remove(index_path)
+                continue
+
+            for entry in index["templates"].values():
+                referenced_hashes.add(entry["hash"])
+
+        objects_dir = os.path.join(self.path, "objects")
+        if not os.path.isdir(objects_dir):
+            return
+
+        for file_name in os.listdir(objects_dir):
+            if os.path.splitext(file_name)[0] not in referenced_hashes:
+                os.remove(os.path.join(objects_dir, file_name))
+
+    def _index(self, family, templates_dir):
+        if family not in self.indexes:
+            index = read_json_file(os.path.join(self.path, "{}.json".format(family)))
+            if index is None or index.get("templates_dir") != templates_dir:
+                index = {"templates": {}}
+
+            self.indexes[family] = (templates_dir, index["templates"])
+
+        return self.indexes[family][1]
+
+    def _load(self, source_hash):
+        if source_hash not in self.compiled:
+            compiled = read_json_file(
+                os.path.join(self.path, "objects", "{}.json".format(source_hash))
+            )
+            if compiled is None:
+                return False
+
+            segments = compiled["segments"]
+            if segments is not None:
+                segments = [
+                    tuple(segment) if isinstance(segment, list) else segment
+                    for segment in segments
+                ]
+
+            self.compiled[source_hash] = segments
+
+        return True
+
+
 class Template(object):
-    def __init__(self, family, path, config):
+    def __init__(self, family, path, config, compiled_templates=None):
         self.family = family
         self.path = path
         self.config = config
+        self.compiled_templates = compiled_templates
         self.renderer = pystache.Renderer(search_dirs=os.path.dirname(self.path))
 
-    def build(self, scheme):
+    def flat_segments(self):
+        """
+        Most Base16 templates are plain variable substitution once their
+        partials are inlined, which can be rendered much more cheaply than
+        with pystache's general renderer. Compiled templates come from the
+        persistent store when there is one, and are otherwise shared by every
+        Template for the same unchanged file.
+        """
+        if self.compiled_templates is not None:
+            return self.compiled_templates.segments(self.family, self.path)
+
+        memo = _FLAT_TEMPLATES.get(self.path)
+        if memo is None or any(
+            template_file_stat(input_path) != stat for (input_path, stat) in memo[0]
+        ):
+            (segments, input_paths, _) = compile_template_file(self.path)
+            memo = (
+                [
+                    (input_path, template_file_stat(input_path))
+                    for input_path in input_paths
+                ],
+                segments,
+            )
+            _FLAT_TEMPLATES[self.path] = memo
+
+        return memo[1]
+
+    def render(self, variables):
+        segments = self.flat_segments()
+        if segments is None:
+            return self.renderer.render_path(self.path, variables)
+
+        return render_flat_template(segments, variables)
+
+    def build(self, scheme, variables=None):
+        if variables is None:
+            variables = scheme.base16_variables()
+
         # The base16 spec calls for the file to be written to
         # os.path.join(
         #     os.path.dirname(self.path),
@@ -517,12 +3080,325 @@ class Template(object):
         # )
         return {
             "output_dir": self.config["output"],
-            "output_file_name": "base16-{}{}".format(
-                scheme.slug(), self.config["extension"]
+            "output_file_name": output_file_name(scheme.slug(), self.config),
+            "output": self.render(variables),
+        }
+
+
+def output_file_name(scheme_slug, template_config):
+    return "base16-{}{}".format(scheme_slug, template_config["extension"])
+
+
+def output_key(scheme_slug, template_family, output_dir, file_name):
+    """Names an output by its path through the nested schemes result"""
+    return "/".join([scheme_slug, template_family, output_dir, file_name])
+
+
+def output_path(key):
+    """
+    Splits an output key back into the scheme, template, output_dir and
+    file_name it names. Only output dirs can contain a slash.
+    """
+    parts = key.split("/")
+    return collections.OrderedDict(
+        [
+            ("scheme", parts[0]),
+            ("template", parts[1]),
+            ("output_dir", "/".join(parts[2:-1])),
+            ("file_name", parts[-1]),
+        ]
+    )
+
+
+# Args that change which outputs are built, or what they contain
+OUTPUT_ARGS = [
+    "scheme",
+    "scheme_family",
+    "template",
+    "schemes_source",
+    "templates_source",
+    "palette_variables",
+]
+
+
+class OutputManifest(object):
+    """
+    Records a hash of every output a set of build args last built, along with
+    the revisions of the scheme and template repos it was built from, so that
+    later runs can tell which outputs would change without rendering them.
+    Each scheme's variables are hashed too, for delta results.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        output_args = json.dumps(
+            [module.params[name] for name in OUTPUT_ARGS], sort_keys=True
+        )
+        self.path = os.path.join(
+            module.params["cache_dir"],
+            "base16-builder-ansible",
+            "manifests",
+            "{}.json".format(
+                hashlib.sha256(output_args.encode("utf-8")).hexdigest()[:16]
             ),
-            "output": self.renderer.render_path(self.path, scheme.base16_variables()),
+        )
+        self.outputs = {}
+        self.schemes = {}
+
+    def load(self):
+        return self.load_previous()["outputs"]
+
+    def load_previous(self):
+        """Returns the output and scheme hashes of the last saved build"""
+        manifest = read_json_file(self.path) or {}
+        return {
+            "outputs": manifest.get("outputs", {}),
+            "schemes": manifest.get("schemes", {}),
+        }
+
+    def add(self, key, output, revisions):
+        self.outputs[key] = {
+            "hash": hashlib.sha256(output.encode("utf-8")).hexdigest(),
+            "revisions": revisions,
         }
 
+    def add_scheme(self, scheme_slug, variables):
+        self.schemes[scheme_slug] = hashlib.sha256(
+            json.dumps(variables, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def save(self):
+        if not self.module.check_mode:
+            write_json_file(
+                self.path, {"outputs": self.outputs, "schemes": self.schemes}
+            )
+
+
+ARTIFACT_FORMAT = 1
+ARTIFACT_MANIFEST = "manifest.json"
+ARTIFACT_SCHEMES = "schemes.packed"
+# Zip entries all get the earliest time zip can store, so building the same
+# outputs always produces the same archive
+ARTIFACT_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class OutputArtifact(object):
+    """
+    A zip archive of every output a build rendered, at
+    scheme/family/output_dir/file, along with the built schemes' variables as
+    a packed export and a manifest of the revisions they were built from.
+    Zip's central directory lets hosts read the manifest and just the outputs
+    they need without reading the rest of the archive.
+
+    The manifest's hash covers the schemes and outputs, but not revisions, so
+    it only changes when something in the archive would.
+    """
+
+    def __init__(self, builder):
+        self.builder = builder
+        self.module = builder.module
+        self.path = self.module.params["artifact_path"]
+        self.schemes = collections.OrderedDict()
+        self.outputs = {}
+        self.revisions = dict(schemes={}, templates={})
+
+    def add_scheme(self, scheme):
+        self.schemes[scheme.slug()] = scheme
+        scheme_repo_path = os.path.dirname(scheme.path)
+        revision = self.builder.revision(scheme_repo_path)
+        self.revisions["schemes"][os.path.basename(scheme_repo_path)] = revision
+
+    def add(self, scheme, template, build_result):
+        template_repo_path = os.path.dirname(os.path.dirname(template.path))
+        self.revisions["templates"][template.family] = self.builder.revision(
+            template_repo_path
+        )
+        key = output_key(
+            scheme.slug(),
+            template.family,
+            build_result["output_dir"],
+            build_result["output_file_name"],
+        )
+        output_hash = hashlib.sha256(build_result["output"].encode("utf-8"))
+        self.outputs[key] = (
+            dict(
+                scheme=scheme.slug(),
+                family=template.family,
+                entry=os.path.splitext(os.path.basename(template.path))[0],
+                output_dir=build_result["output_dir"],
+                file_name=build_result["output_file_name"],
+                hash=output_hash.hexdigest(),
+            ),
+            build_result["output"],
+        )
+
+    def write(self):
+        packed_schemes = export_schemes(
+            self.schemes.values(), "packed", self.module.params["palette_variables"]
+        )
+        manifest = dict(
+            format=ARTIFACT_FORMAT,
+            revisions=self.revisions,
+            schemes=dict(
+                (slug, os.path.basename(os.path.dirname(scheme.path)))
+                for (slug, scheme) in self.schemes.items()
+            ),
+            outputs=dict((key, entry) for (key, (entry, _)) in self.outputs.items()),
+        )
+        manifest["hash"] = hashlib.sha256(
+            json.dumps(
+                [
+                    hashlib.sha256(packed_schemes).hexdigest(),
+                    manifest["schemes"],
+                    manifest["outputs"],
+                ],
+                sort_keys=True,
+            ).encode("utf-8")
+        ).hexdigest()
+
+        path = self.path.replace("{hash}", manifest["hash"][:16])
+        self.builder.result["artifact"] = dict(
+            path=path, hash=manifest["hash"], outputs=len(self.outputs)
+        )
+        if self._manifest(path) == manifest:
+            return
+
+        self.builder.result["changed"] = True
+        if self.module.check_mode:
+            return
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".")
+        with os.fdopen(fd, "wb") as artifact_file:
+            with zipfile.ZipFile(artifact_file, "w", zipfile.ZIP_DEFLATED) as archive:
+                self._write_entry(
+                    archive,
+                    ARTIFACT_MANIFEST,
+                    json.dumps(manifest, sort_keys=True).encode("utf-8"),
+                )
+                self._write_entry(archive, ARTIFACT_SCHEMES, packed_schemes)
+                for key in sorted(self.outputs):
+                    self._write_entry(
+                        archive, key, self.outputs[key][1].encode("utf-8")
+                    )
+
+        os.replace(tmp_path, path)
+
+    def _write_entry(self, archive, name, data):
+        entry = zipfile.ZipInfo(name, date_time=ARTIFACT_DATE_TIME)
+        entry.compress_type = zipfile.ZIP_DEFLATED
+        entry.external_attr = 0o644 << 16
+        archive.writestr(entry, data)
+
+    def _manifest(self, path):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                return json.loads(archive.read(ARTIFACT_MANIFEST).decode("utf-8"))
+        except (OSError, KeyError, ValueError, zipfile.BadZipfile):
+            return None
+
+    def extract(self):
+        """
+        Fills in the result's schemes with the selected schemes and outputs
+        from the archive, the same as a build would have
+        """
+        try:
+            archive = zipfile.ZipFile(self.path)
+        except (OSError, zipfile.BadZipfile) as err:
+            self.module.fail_json(
+                msg="Failed to open artifact {}: {}".format(self.path, err),
+                **self.builder.result
+            )
+
+        with archive:
+            manifest = json.loads(archive.read(ARTIFACT_MANIFEST).decode("utf-8"))
+            if manifest.get("format") != ARTIFACT_FORMAT:
+                self.module.fail_json(
+                    msg="Artifact {} has unknown format {}".format(
+                        self.path, manifest.get("format")
+                    ),
+                    **self.builder.result
+                )
+
+            self.builder.result["artifact"] = dict(
+                path=self.path, hash=manifest["hash"]
+            )
+            scheme_results = self.builder.result["schemes"]
+            for variables in decode_scheme_export(archive.read(ARTIFACT_SCHEMES)):
+                slug = variables["scheme-slug"]
+                if self._scheme_selected(slug, manifest["schemes"][slug]):
+                    scheme_results[slug] = {"scheme-variables": variables}
+
+            selectors = template_selectors(self.module.params["template"] or ["*"])
+            if self.module.params["template"] == []:
+                selectors = []
+
+            for (key, entry) in sorted(manifest["outputs"].items()):
+                if entry["scheme"] not in scheme_results or not any(
+                    fnmatch.fnmatchcase(entry["family"], repo_pattern)
+                    and fnmatch.fnmatchcase(entry["entry"], entry_pattern)
+                    for (repo_pattern, entry_pattern) in selectors
+                ):
+                    continue
+
+                output = archive.read(key)
+                if hashlib.sha256(output).hexdigest() != entry["hash"]:
+                    self.module.fail_json(
+                        msg="Artifact {} is corrupt: {} doesn't match its hash".format(
+                            self.path, key
+                        ),
+                        **self.builder.result
+                    )
+
+                scheme_result = scheme_results[entry["scheme"]]
+                family_result = scheme_result.setdefault(entry["family"], {})
+                template_result = family_result.setdefault(entry["output_dir"], {})
+                template_result[entry["file_name"]] = output.decode("utf-8")
+
+    def _scheme_selected(self, slug, scheme_family):
+        module_scheme_arg = self.module.params["scheme"]
+        if module_scheme_arg is not None and module_scheme_arg not in slug:
+            return False
+
+        module_scheme_family_arg = (
+            self.module.params["scheme_family"] or module_scheme_arg
+        )
+        if module_scheme_family_arg is None:
+            return True
+
+        return scheme_family in module_scheme_family_arg
+
+
+def parse_template_repo(templates_dir, lock):
+    """
+    Parses a template repo's config files into a list of (template name,
+    template config) records
+    """
+    records = []
+    with lock.shared():
+        for path in os.listdir(templates_dir):
+            (file_name, file_ext) = os.path.splitext(path)
+            if file_name != "config" or file_ext not in [".yaml", ".yml"]:
+                continue
+
+            records.extend(open_yaml(os.path.join(templates_dir, path)).items())
+
+    return records
+
+
+def template_selectors(template_args):
+    """
+    Splits template args of the form "repo" or "repo:entry" into (repo, entry)
+    pairs of glob patterns. A bare repo selects every entry in it.
+    """
+    selectors = []
+    for template_arg in template_args:
+        (repo_pattern, _, entry_pattern) = template_arg.partition(":")
+        selectors.append((repo_pattern, entry_pattern or "*"))
+
+    return selectors
+
 
 class TemplateRepo(object):
     source_type = "templates"
@@ -534,100 +3410,583 @@ class TemplateRepo(object):
         self.git_repo = GitRepo(self.builder, url_or_local_path, clone_dest)
         self.templates_dir = os.path.join(self.git_repo.path, "templates")
 
-    def sources(self):
-        if not self._matches_params():
+    def sources(self, records=None):
+        entry_patterns = self._entry_patterns()
+        if not entry_patterns:
             return
 
-        self.git_repo.clone_if_missing()
+        if self.git_repo.clone_if_missing():
+            self.compile_templates()
 
-        for path in os.listdir(self.templates_dir):
-            (file_name, file_ext) = os.path.splitext(path)
-            if file_name != "config" or file_ext not in [".yaml", ".yml"]:
-                continue
+        if records is None:
+            (parse, parse_args) = self.parse_job()
+            records = parse(*parse_args)
+            self.builder.metrics.inc("source_parses_total", type=self.source_type)
+            self.builder.metrics.cache_lookup("parsed_sources", False)
 
-            for template_name, template_config in open_yaml(
-                os.path.join(self.templates_dir, path)
-            ).items():
-                # Cache here?
+        # Templates are rendered while this generator is suspended, so the
+        # shared lock also covers reading the mustache files
+        with self.git_repo.lock.shared():
+            for (template_name, template_config) in self.selected(records):
                 yield Template(
                     self.name,
                     os.path.join(
                         self.templates_dir, "{}.mustache".format(template_name)
                     ),
                     template_config,
+                    self.builder.compiled_templates,
                 )
 
+        self.builder.compiled_templates.save(self.name)
+
+    def clone_if_missing(self):
+        if not self._matches_params():
+            return
+
+        if self.git_repo.clone_if_missing():
+            self.compile_templates()
+
     def clone_or_pull(self):
         if not self._matches_params():
             return
 
         self.git_repo.clone_or_pull()
+        self.compile_templates()
+
+    def selected(self, records):
+        """Filters template config records down to the selected template files"""
+        entry_patterns = self._entry_patterns()
+        return [
+            (template_name, template_config)
+            for (template_name, template_config) in records
+            if any(
+                fnmatch.fnmatchcase(template_name, entry_pattern)
+                for entry_pattern in entry_patterns
+            )
+        ]
+
+    def parse_job(self):
+        """
+        Returns the function and args that parse this repo's template configs
+        into records, or None if nothing in the repo will be built
+        """
+        if not self._matches_params():
+            return None
+
+        return (parse_template_repo, (self.templates_dir, self.git_repo.lock))
+
+    def compile_templates(self):
+        if self.module.check_mode or not os.path.isdir(self.templates_dir):
+            return
+
+        with self.git_repo.lock.shared():
+            self.builder.compiled_templates.compile_templates(
+                self.name, self.templates_dir
+            )
 
     def _matches_params(self):
+        return bool(self._entry_patterns())
+
+    def _entry_patterns(self):
         module_template_arg = self.module.params.get("template")
         if module_template_arg is None:
-            return True
+            return ["*"]
+
+        return [
+            entry_pattern
+            for (repo_pattern, entry_pattern) in template_selectors(module_template_arg)
+            if fnmatch.fnmatchcase(self.name, repo_pattern)
+        ]
+
+
+class BuildOrchestrator(object):
+    """
+    Runs updates and builds as asyncio stages when concurrency is set. Up to
+    concurrency repos are cloned, pulled or parsed at once in fetch threads,
+    whose git commands are run on the loop by the builder's
+    AsyncCommandRunner. Parsing moves to the worker pool when there is one. Parsed scheme repos wait in a
+    queue of at most concurrency repos for a single render thread, which
+    takes them in list order, so results come out the same as a sequential
+    build's.
+    """
+
+    def __init__(self, builder):
+        self.builder = builder
+        self.concurrency = builder.module.params["concurrency"]
+        self.loop = None
+        self.slots = None
+        self.fetches = []
+        self.fetch_executor = None
+        self.render_executor = None
+
+    def update(self):
+        self._run(self._update)
+
+    def build(self):
+        self._run(self._build)
+
+    def _run(self, stages):
+        self.loop = asyncio.new_event_loop()
+        # Older Pythons only watch for subprocesses exiting on the current loop
+        asyncio.set_event_loop(self.loop)
+        self.fetch_executor = concurrent.futures.ThreadPoolExecutor(self.concurrency)
+        self.render_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.builder.commands.start(self.loop)
+        try:
+            self.loop.run_until_complete(self._stages(stages))
+        except DeferredFailure as failure:
+            self.builder.module.fail_json(**failure.result)
+        finally:
+            self.builder.commands.finish()
+            asyncio.set_event_loop(None)
+            self.loop.close()
+
+    async def _stages(self, stages):
+        # Made here, so it belongs to the running loop on every Python version
+        self.slots = asyncio.Semaphore(self.concurrency)
+        try:
+            await stages()
+        finally:
+            # Threads still waiting on a git command are let go, and waited on
+            # while the loop they report back to is still running
+            self.builder.commands.stop()
+            for executor in [self.fetch_executor, self.render_executor]:
+                await self.loop.run_in_executor(None, executor.shutdown)
+
+    async def _update(self):
+        # The lists are pulled first, since they say which repos to pull
+        await self._gather(
+            self._in_thread(base16_source_repo.update_lists)
+            for base16_source_repo in self.builder.source_repos
+        )
+        await self._gather(
+            self._in_thread(source_repo.clone_or_pull)
+            for base16_source_repo in self.builder.source_repos
+            for source_repo in base16_source_repo.source_repos()
+        )
+
+    async def _build(self):
+        templates_repo = self.builder.templates_repo
+        template_repos = []
+        if templates_repo is not None:
+            template_repos = [
+                (template_repo, self._start_fetch(template_repo))
+                for template_repo in templates_repo.source_repos()
+                if template_repo.parse_job() is not None
+            ]
+
+        parsed = asyncio.Queue(maxsize=self.concurrency)
+        producer = asyncio.ensure_future(self._produce(parsed))
+        try:
+            if templates_repo is not None:
+                # Every scheme is rendered with every template, so template
+                # repos have all been parsed before anything is rendered
+                templates_repo.records = {}
+                for (template_repo, fetched) in template_repos:
+                    templates_repo.records[template_repo.name] = await fetched
+
+            while True:
+                (scheme_repo, fetched) = await parsed.get()
+                if scheme_repo is None:
+                    break
+
+                for scheme in scheme_repo.sources(await fetched):
+                    await self.loop.run_in_executor(
+                        self.render_executor, self.builder.build_scheme, scheme
+                    )
+        finally:
+            await self._cancel([producer] + self.fetches)
+
+    async def _produce(self, parsed):
+        for scheme_repo in self.builder.schemes_repo.source_repos():
+            if scheme_repo.parse_job() is None:
+                continue
+
+            # Blocks once concurrency parsed repos are waiting to be rendered
+            await parsed.put((scheme_repo, self._start_fetch(scheme_repo)))
+
+        await parsed.put((None, None))
+
+    def _start_fetch(self, source_repo):
+        fetched = asyncio.ensure_future(self._fetch(source_repo))
+        self.fetches.append(fetched)
+        return fetched
+
+    async def _fetch(self, source_repo):
+        """Clones a scheme or template repo if it's missing, and parses it"""
+        await self._in_thread(source_repo.clone_if_missing)
+        (parse, parse_args) = source_repo.parse_job()
+        if self.builder.pool is None:
+            records = await self._in_thread(parse, *parse_args)
+        else:
+            records = await self._in_pool(parse, parse_args)
+
+        self.builder.metrics.inc("source_parses_total", type=source_repo.source_type)
+        self.builder.metrics.cache_lookup("parsed_sources", False)
+        return records
+
+    async def _gather(self, coroutines):
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            await self._cancel(tasks)
+
+    async def _cancel(self, tasks):
+        """Cancels any of the tasks still running after a stage fails"""
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _in_thread(self, function, *args):
+        # Only concurrency calls are handed to the executor at a time, so
+        # nothing is left queued in it if a stage fails
+        async with self.slots:
+            return await self.loop.run_in_executor(self.fetch_executor, function, *args)
+
+    def _in_pool(self, function, args):
+        result = self.loop.create_future()
 
-        return self.name in module_template_arg
+        def settle(settle_result, value):
+            if not result.done():
+                settle_result(value)
+
+        def settle_threadsafe(settle_result, value):
+            # Parses abandoned by a failed stage can finish after the loop's
+            # closed
+            try:
+                self.loop.call_soon_threadsafe(settle, settle_result, value)
+            except RuntimeError:
+                pass
+
+        self.builder.pool.apply_async(
+            function,
+            args,
+            callback=lambda value: settle_threadsafe(result.set_result, value),
+            error_callback=lambda err: settle_threadsafe(result.set_exception, err),
+        )
+        return result
+
+
+# Remotes probed at once when planning a check mode run
+PLAN_PROBES = 8
 
 
 class Base16Builder(object):
     def __init__(self, module):
         self.module = module
+        self.commands = CommandRunner(module)
+        self.orchestrator = None
+        if module.params["concurrency"] is not None:
+            self.commands = AsyncCommandRunner(module)
+            self.orchestrator = BuildOrchestrator(self)
+
+        if module.params["archive_url"]:
+            self.git_backend = ArchiveBackend(
+                module, self.commands, module.params["archive_url"]
+            )
+        else:
+            self.git_backend = GIT_BACKENDS[module.params["git_backend"]](
+                module, self.commands
+            )
 
         self.schemes_repo = Base16SourceRepo(self, SchemeRepo)
-        self.templates_repo = Base16SourceRepo(self, TemplateRepo)
+        # An empty template list only builds scheme variables, so templates
+        # are never listed, cloned or looked at in the cache
+        if module.params["template"] == []:
+            self.templates_repo = None
+            self.source_repos = [self.schemes_repo]
+        else:
+            self.templates_repo = Base16SourceRepo(self, TemplateRepo)
+            self.source_repos = [self.schemes_repo, self.templates_repo]
+        self.metrics = RunMetrics(module)
+        self.compiled_templates = CompiledTemplateStore(module, self.metrics)
+        self.scheme_index = SchemeIndex(self)
+        self.output_manifest = OutputManifest(module)
+        self.revision_lock = RevisionLock(self)
+        self.artifact = None
+        if (
+            module.params["artifact_path"]
+            and module.params["artifact_mode"] == "create"
+        ):
+            self.artifact = OutputArtifact(self)
+        self.revisions = {}
+        self.pool = None
 
         self.result = dict(changed=False, schemes=dict())
 
-    def run(self):
-        if PYSTACHE_ERR:
+    def prune(self):
+        pruned = []
+        cached_repo_paths = []
+        for base16_source_repo in self.source_repos:
+            pruned += base16_source_repo.prune()
+            cached_repo_paths += base16_source_repo.cached_repo_paths()
+
+        for repo_path in cached_repo_paths:
+            if not self.module.check_mode and os.path.exists(
+                os.path.join(repo_path, ".git")
+            ):
+                self.git_backend.gc(repo_path)
+
+        max_cache_size = self.module.params["max_cache_size"]
+        if max_cache_size is not None:
+            cache_size = disk_usage(
+                os.path.join(self.module.params["cache_dir"], "base16-builder-ansible")
+            )
+            # Evict the least recently used scheme and template repos until
+            # the cache fits. The source lists are always kept.
+            for repo_path in sorted(cached_repo_paths, key=cached_repo_last_used):
+                if cache_size <= max_cache_size * 1024 * 1024:
+                    break
+
+                cache_size -= disk_usage(repo_path)
+                pruned.append(repo_path)
+                remove_cached_repo(self.module, repo_path)
+
+        if self.templates_repo is not None:
+            self.compiled_templates.prune()
+        self.scheme_index.prune(
+            set(
+                os.path.basename(repo_path)
+                for repo_path in self.schemes_repo.cached_repo_paths()
+            )
+        )
+
+        self.result["pruned"] = pruned
+        if pruned:
+            self.result["changed"] = True
+
+    @contextmanager
+    def timed(self, repo_path, operation):
+        """
+        Adds the time spent cloning, pulling or checking out a repo to its
+        duration, and to the run's metrics
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            durations = self.result.setdefault("durations", {})
+            durations[repo_path] = round(durations.get(repo_path, 0) + duration, 3)
+            self.metrics.inc(
+                "git_operations_total", operation=operation, repo=repo_path
+            )
+            self.metrics.inc(
+                "git_operation_seconds_total",
+                duration,
+                operation=operation,
+                repo=repo_path,
+            )
+            self.metrics.observe(
+                "git_operation_duration_seconds", duration, operation=operation
+            )
+
+    @contextmanager
+    def worker_pool(self):
+        """
+        Starts the pool that parses schemes and template configs when workers
+        isn't 1. It's forked before any fetch threads start.
+        """
+        if self.module.params["workers"] == 1:
+            yield
+            return
+
+        self.pool = multiprocessing.get_context("fork").Pool(
+            self.module.params["workers"] or None
+        )
+        try:
+            yield
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def query(self):
+        query = self.module.params["query"]
+        unknown_keys = sorted(set(query.keys()) - set(SCHEME_QUERY_KEYS))
+        if unknown_keys:
             self.module.fail_json(
-                msg="Failed to import pystache. Type `pip install pystache` - {}".format(
-                    PYSTACHE_ERR
+                msg="Unknown query keys {}. Queries can use {}".format(
+                    ", ".join(unknown_keys), ", ".join(SCHEME_QUERY_KEYS)
                 ),
                 **self.result
             )
 
-        if self.module.params["update"]:
-            self.schemes_repo.update()
-            self.templates_repo.update()
+        family_names = []
+        for scheme_repo in self.schemes_repo.source_repos():
+            if scheme_repo.index():
+                family_names.append(scheme_repo.name)
 
-        if not self.module.params["build"]:
-            self.module.exit_json(**self.result)
+        self.scheme_index.save()
+        self.result["matches"] = self.scheme_index.query(query, family_names)
 
-        for scheme in self.schemes_repo.sources():
-            scheme_result = {}
-            self.result["schemes"][scheme.slug()] = scheme_result
+    def build(self):
+        if self.orchestrator is not None:
+            self.orchestrator.build()
+        else:
+            for scheme in self.schemes_repo.sources():
+                self.build_scheme(scheme)
 
-            scheme_result["scheme-variables"] = scheme.base16_variables()
+        if not self.result["schemes"]:
+            failure_msg = "Failed to build any schemes."
+            if self.module.params["scheme"]:
+                failure_msg = '{} Scheme name "{}" was passed, but didn\'t match any known schemes'.format(
+                    failure_msg, self.module.params["scheme"]
+                )
 
-            for template in self.templates_repo.sources():
-                build_result = template.build(scheme)
-                if not scheme_result.get(template.family):
-                    scheme_result[template.family] = {}
+            self.module.fail_json(msg=failure_msg, **self.result)
 
-                template_family_result = scheme_result[template.family]
+        if self.module.params["delta"]:
+            self.delta(self.output_manifest.load_previous())
+        self.output_manifest.save()
+        if self.artifact is not None:
+            self.artifact.write()
 
-                if not template_family_result.get(build_result["output_dir"]):
-                    template_family_result[build_result["output_dir"]] = {}
+    def build_scheme(self, scheme):
+        scheme_result = {}
+        self.result["schemes"][scheme.slug()] = scheme_result
 
-                template_result = template_family_result[build_result["output_dir"]]
-                template_result[build_result["output_file_name"]] = build_result[
-                    "output"
-                ]
+        # Derived variables are computed once per scheme, not per template
+        variables = scheme.base16_variables(self.module.params["palette_variables"])
+        scheme_result["scheme-variables"] = variables.materialize()
+        self.output_manifest.add_scheme(
+            scheme.slug(), scheme_result["scheme-variables"]
+        )
+        self.metrics.inc("schemes_total")
+        if self.artifact is not None:
+            self.artifact.add_scheme(scheme)
+        if self.templates_repo is None:
+            return
 
-            if len(scheme_result) == 1 and self.module.params["template"]:
-                failure_msg = "Failed to build any templates."
-                if self.module.params["template"]:
-                    failure_msg = '{} Template names {} were passed, but didn\'t match any known templates'.format(
-                        failure_msg, self.module.params["template"]
-                    )
+        for template in self.templates_repo.sources():
+            render_start = time.monotonic()
+            build_result = template.build(scheme, variables)
+            self.metrics.observe(
+                "render_duration_seconds", time.monotonic() - render_start
+            )
+            self.metrics.inc("template_renders_total", template=template.family)
+            self.metrics.inc(
+                "rendered_bytes_total", len(build_result["output"].encode("utf-8"))
+            )
+            if self.artifact is not None:
+                self.artifact.add(scheme, template, build_result)
+            self.output_manifest.add(
+                output_key(
+                    scheme.slug(),
+                    template.family,
+                    build_result["output_dir"],
+                    build_result["output_file_name"],
+                ),
+                build_result["output"],
+                [
+                    self.revision(os.path.dirname(scheme.path)),
+                    self.revision(os.path.dirname(os.path.dirname(template.path))),
+                ],
+            )
+            if not scheme_result.get(template.family):
+                scheme_result[template.family] = {}
+
+            template_family_result = scheme_result[template.family]
+
+            if not template_family_result.get(build_result["output_dir"]):
+                template_family_result[build_result["output_dir"]] = {}
+
+            template_result = template_family_result[build_result["output_dir"]]
+            template_result[build_result["output_file_name"]] = build_result["output"]
+
+        if len(scheme_result) == 1 and self.module.params["template"]:
+            failure_msg = "Failed to build any templates."
+            if self.module.params["template"]:
+                failure_msg = '{} Template names {} were passed, but didn\'t match any known templates'.format(
+                    failure_msg, self.module.params["template"]
+                )
+
+            # Schemes are built in the orchestrator's render thread with
+            # concurrency, so this can't exit the module itself
+            self.commands.fail(msg=failure_msg, **self.result)
+
+    def delta(self, previous):
+        """
+        Trims the built schemes down to the outputs that are new or changed
+        since the last build with the same output args, and lists the ones it
+        no longer builds in removed. A scheme is kept, with its variables,
+        when any of its outputs or its variables changed.
+        """
+        outputs = self.output_manifest.outputs
+        schemes = collections.OrderedDict()
+        for (scheme_slug, scheme_result) in self.result["schemes"].items():
+            variables = scheme_result["scheme-variables"]
+            scheme_delta = {"scheme-variables": variables}
+            for (template_family, template_family_result) in scheme_result.items():
+                if template_family == "scheme-variables":
+                    continue
 
-                self.module.fail_json(msg=failure_msg, **self.result)
+                for (output_dir, template_result) in template_family_result.items():
+                    for (file_name, output) in template_result.items():
+                        key = output_key(
+                            scheme_slug, template_family, output_dir, file_name
+                        )
+                        built = previous["outputs"].get(key, {})
+                        if built.get("hash") == outputs[key]["hash"]:
+                            continue
+
+                        scheme_delta.setdefault(template_family, {}).setdefault(
+                            output_dir, {}
+                        )[file_name] = output
+
+            if (
+                len(scheme_delta) > 1
+                or previous["schemes"].get(scheme_slug)
+                != self.output_manifest.schemes[scheme_slug]
+            ):
+                schemes[scheme_slug] = scheme_delta
+
+        self.result["schemes"] = schemes
+        self.result["removed"] = [
+            output_path(key)
+            for key in sorted(set(previous["outputs"].keys()) - set(outputs.keys()))
+        ]
+        if schemes or self.result["removed"]:
+            self.result["changed"] = True
+
+    def consume_artifact(self):
+        OutputArtifact(self).extract()
 
         if not self.result["schemes"]:
-            failure_msg = "Failed to build any schemes."
+            failure_msg = "Failed to find any schemes in artifact {}.".format(
+                self.module.params["artifact_path"]
+            )
+            if self.module.params["scheme"]:
+                failure_msg = '{} Scheme name "{}" was passed, but didn\'t match any schemes in it'.format(
+                    failure_msg, self.module.params["scheme"]
+                )
+
+            self.module.fail_json(msg=failure_msg, **self.result)
+
+        if self.module.params["template"] and all(
+            len(scheme_result) == 1 for scheme_result in self.result["schemes"].values()
+        ):
+            self.module.fail_json(
+                msg="Failed to find any templates in artifact {}. Template names {} were passed, but didn't match any templates in it".format(
+                    self.module.params["artifact_path"], self.module.params["template"]
+                ),
+                **self.result
+            )
+
+    def export(self):
+        """
+        Writes the variables of every selected scheme to export_path, instead
+        of returning them. A scheme slug in more than one family is exported
+        once, as the last family has it, the same as in a build's result.
+        """
+        schemes = collections.OrderedDict()
+        for scheme in self.schemes_repo.sources():
+            schemes[scheme.slug()] = scheme
+            self.metrics.inc("schemes_total")
+
+        if not schemes:
+            failure_msg = "Failed to export any schemes."
             if self.module.params["scheme"]:
                 failure_msg = '{} Scheme name "{}" was passed, but didn\'t match any known schemes'.format(
                     failure_msg, self.module.params["scheme"]
@@ -635,10 +3994,236 @@ class Base16Builder(object):
 
             self.module.fail_json(msg=failure_msg, **self.result)
 
+        export_path = self.module.params["export_path"]
+        export = export_schemes(
+            schemes.values(),
+            self.module.params["export_format"],
+            self.module.params["palette_variables"],
+        )
+        self.result["export"] = dict(
+            path=export_path,
+            format=self.module.params["export_format"],
+            schemes=len(schemes),
+        )
+
+        if os.path.exists(export_path):
+            with open(export_path, "rb") as export_file:
+                if export_file.read() == export:
+                    return
+
+        self.result["changed"] = True
+        write_file(export_path, export)
+
+    def revision(self, repo_path):
+        if repo_path not in self.revisions:
+            self.revisions[repo_path] = repo_revision(repo_path)
+
+        return self.revisions[repo_path]
+
+    def plan(self):
+        """
+        Works out what a run would change, without cloning, pulling or
+        rendering anything. Cached repos are compared against their remotes,
+        and the outputs of cached repos against the manifest of the last build
+        with the same args.
+        """
+        plan = dict(clone=[], pull=[], create=[], modify=[])
+        probed_repos = []
+
+        def plan_repo(git_repo):
+            if git_repo.local_repo:
+                return
+            if not git_repo._repo_at_path():
+                plan["clone"].append(git_repo.path)
+            elif self.module.params["update"]:
+                probed_repos.append(git_repo)
+
+        cached_repos = {}
+        for base16_source_repo in self.source_repos:
+            for list_repo in base16_source_repo.list_repos:
+                plan_repo(list_repo)
+
+            cached_repos[base16_source_repo.source_type] = []
+            for source_repo in base16_source_repo.planned_source_repos():
+                plan_repo(source_repo.git_repo)
+                if os.path.isdir(source_repo.git_repo.path):
+                    cached_repos[base16_source_repo.source_type].append(source_repo)
+
+        # Remotes are probed concurrently, since each is a network round trip
+        with concurrent.futures.ThreadPoolExecutor(PLAN_PROBES) as executor:
+            pulls_needed = executor.map(
+                lambda git_repo: git_repo.git_backend.pull_needed(
+                    git_repo.url, git_repo.path
+                ),
+                probed_repos,
+            )
+            for (git_repo, pull_needed) in zip(probed_repos, pulls_needed):
+                # Repos that can't be probed might change when pulled
+                if pull_needed is not False:
+                    plan["pull"].append(git_repo.path)
+
+        if self.module.params["build"]:
+            self._plan_outputs(plan, cached_repos)
+
+        for planned in plan.values():
+            planned.sort()
+
+        self.result["plan"] = plan
+        if any(plan.values()):
+            self.result["changed"] = True
+
+    def _plan_outputs(self, plan, cached_repos):
+        built_outputs = self.output_manifest.load()
+        pulled_paths = set(plan["pull"])
+        template_records = {}
+        for template_repo in cached_repos.get("templates", []):
+            (parse, parse_args) = template_repo.parse_job()
+            template_records[template_repo.name] = template_repo.selected(
+                parse(*parse_args)
+            )
+
+        for scheme_repo in cached_repos["schemes"]:
+            self.scheme_index.refresh(scheme_repo)
+            for template_repo in cached_repos.get("templates", []):
+                repo_paths = [scheme_repo.git_repo.path, template_repo.git_repo.path]
+                revisions = [self.revision(repo_path) for repo_path in repo_paths]
+                for scheme_slug in self.scheme_index.query({}, [scheme_repo.name]):
+                    for (_, template_config) in template_records[template_repo.name]:
+                        key = output_key(
+                            scheme_slug,
+                            template_repo.name,
+                            template_config["output"],
+                            output_file_name(scheme_slug, template_config),
+                        )
+                        if key not in built_outputs:
+                            plan["create"].append(key)
+                        elif built_outputs[key]["revisions"] != revisions or any(
+                            repo_path in pulled_paths for repo_path in repo_paths
+                        ):
+                            plan["modify"].append(key)
+
+    def run(self):
+        if PYSTACHE_ERR:
+            self.module.fail_json(
+                msg="Failed to import pystache. Type `pip install pystache` - {}".format(
+                    PYSTACHE_ERR
+                ),
+                **self.result
+            )
+
+        if self.module.params["git_backend"] == "dulwich" and DULWICH_ERR:
+            self.module.fail_json(
+                msg="Failed to import dulwich. Type `pip install dulwich` - {}".format(
+                    DULWICH_ERR
+                ),
+                **self.result
+            )
+
+        if self.module.params["lockfile"] and self.module.params["archive_url"]:
+            self.module.fail_json(
+                msg="lockfile can't be used with archive_url, since archives aren't git checkouts that can be pinned to a commit",
+                **self.result
+            )
+
+        # 0 starts one worker per CPU core
+        if self.module.params["workers"] < 0:
+            self.module.fail_json(
+                msg="workers must be at least 0, got {}".format(
+                    self.module.params["workers"]
+                ),
+                **self.result
+            )
+
+        if (
+            self.module.params["concurrency"] is not None
+            and self.module.params["concurrency"] < 1
+        ):
+            self.module.fail_json(
+                msg="concurrency must be at least 1, got {}".format(
+                    self.module.params["concurrency"]
+                ),
+                **self.result
+            )
+
+        # Hosts consuming an artifact never touch the cache
+        if (
+            self.module.params["delta"]
+            and self.module.params["artifact_path"]
+            and self.module.params["artifact_mode"] == "consume"
+        ):
+            self.module.fail_json(
+                msg="delta can't be used when consuming an artifact, since hosts consuming one keep no manifest of what they returned before",
+                **self.result
+            )
+
+        if (
+            self.module.params["artifact_path"]
+            and self.module.params["artifact_mode"] == "consume"
+        ):
+            with self.metrics.phase("artifact"):
+                self.consume_artifact()
+            self.result["schemes"] = encode_schemes(
+                self.result["schemes"], self.module.params["result_format"]
+            )
+            self.exit()
+
+        if self.module.check_mode and self.module.params["query"] is None:
+            with self.metrics.phase("plan"):
+                self.plan()
+            if self.module.params["prune"]:
+                self.prune()
+
+            self.exit()
+
+        if self.module.params["update"]:
+            with self.metrics.phase("update"):
+                if self.orchestrator is not None:
+                    self.orchestrator.update()
+                else:
+                    for base16_source_repo in self.source_repos:
+                        base16_source_repo.update()
+                self.scheme_index.save()
+                self.revision_lock.save()
+
+        if self.module.params["prune"]:
+            with self.metrics.phase("prune"):
+                self.prune()
+
+        if self.module.params["query"] is not None:
+            with self.metrics.phase("query"):
+                self.query()
+            self.exit()
+
+        if not self.module.params["build"]:
+            self.exit()
+
+        if self.module.params["export_path"] is not None:
+            with self.metrics.phase("export"), self.worker_pool():
+                self.export()
+            self.exit()
+
+        with self.metrics.phase("build"), self.worker_pool():
+            self.build()
+
+        # The first build with a new lockfile records the revisions it used
+        if self.module.params["lockfile"] and not os.path.exists(
+            self.module.params["lockfile"]
+        ):
+            self.revision_lock.save()
+
+        self.result["schemes"] = encode_schemes(
+            self.result["schemes"], self.module.params["result_format"]
+        )
+        self.exit()
+
+    def exit(self):
+        if self.module.params["metrics_path"]:
+            self.metrics.write()
+
         self.module.exit_json(**self.result)
 
 
-def main():
+def argument_spec():
     if "XDG_CACHE_DIR" in os.environ.keys():
         default_cache_dir = os.environ["XDG_CACHE_DIR"]
     elif os.path.exists(os.path.join(os.path.expanduser("~"), ".cache")):
@@ -646,28 +4231,172 @@ def main():
     else:
         default_cache_dir = tempfile.gettempdir()
 
-    module = AnsibleModule(
-        argument_spec=dict(
-            update=dict(type="bool", required=False, default=False),
-            build=dict(type="bool", required=False, default=True),
-            scheme=dict(type="str", required=False),
-            scheme_family=dict(type="str", required=False),
-            template=dict(type="list", required=False),
-            cache_dir=dict(type="str", required=False, default=default_cache_dir),
-            schemes_source=dict(
-                type="str",
-                required=False,
-                default="https://github.com/chriskempson/base16-schemes-source",
-            ),
-            templates_source=dict(
-                type="str",
-                required=False,
-                default="https://github.com/chriskempson/base16-templates-source",
-            ),
+    return dict(
+        update=dict(type="bool", required=False, default=False),
+        build=dict(type="bool", required=False, default=True),
+        scheme=dict(type="str", required=False),
+        scheme_family=dict(type="str", required=False),
+        template=dict(type="list", required=False),
+        cache_dir=dict(type="str", required=False, default=default_cache_dir),
+        schemes_source=dict(
+            type="list",
+            required=False,
+            default=["https://github.com/chriskempson/base16-schemes-source"],
+        ),
+        templates_source=dict(
+            type="list",
+            required=False,
+            default=["https://github.com/chriskempson/base16-templates-source"],
         ),
-        supports_check_mode=True,
+        result_format=dict(
+            type="str",
+            required=False,
+            default="plain",
+            choices=["plain", "compressed", "deduplicated"],
+        ),
+        workers=dict(type="int", required=False, default=1),
+        concurrency=dict(type="int", required=False),
+        delta=dict(type="bool", required=False, default=False),
+        query=dict(type="dict", required=False),
+        palette_variables=dict(type="bool", required=False, default=False),
+        export_path=dict(type="path", required=False),
+        export_format=dict(
+            type="str",
+            required=False,
+            default="jsonl",
+            choices=["jsonl", "csv", "packed"],
+        ),
+        artifact_path=dict(type="path", required=False),
+        artifact_mode=dict(
+            type="str",
+            required=False,
+            default="consume",
+            choices=["create", "consume"],
+        ),
+        metrics_path=dict(type="path", required=False),
+        metrics_format=dict(
+            type="str",
+            required=False,
+            default="prometheus",
+            choices=["prometheus", "json"],
+        ),
+        build_on_controller=dict(type="bool", required=False, default=False),
+        git_backend=dict(
+            type="str",
+            required=False,
+            default="subprocess",
+            choices=["subprocess", "dulwich"],
+        ),
+        archive_url=dict(type="str", required=False),
+        lockfile=dict(type="path", required=False),
+        git_timeout=dict(type="int", required=False),
+        git_retries=dict(type="int", required=False, default=0),
+        stale_on_timeout=dict(type="bool", required=False, default=False),
+        prune=dict(type="bool", required=False, default=False),
+        max_cache_size=dict(type="int", required=False),
     )
 
+
+class ControllerModuleExit(Exception):
+    """Raised by ControllerModule when Base16Builder exits or fails"""
+
+    def __init__(self, result):
+        super(ControllerModuleExit, self).__init__(result.get("msg"))
+        self.result = result
+
+
+class ControllerModule(object):
+    """
+    Stands in for AnsibleModule so Base16Builder can run inside controller
+    side plugins, where there's no module process to exit. Exiting or failing
+    raises ControllerModuleExit carrying the module result instead.
+    """
+
+    def __init__(self, args, check_mode=False):
+        self.check_mode = check_mode
+        self.params = {}
+        # Misspelled args are rejected like AnsibleModule does, instead of being
+        # dropped
+        unsupported = sorted(set(args) - set(argument_spec()))
+        if unsupported:
+            self.fail_json(
+                msg="Unsupported parameters for (base16_builder) module: {}. Supported parameters include: {}".format(
+                    ", ".join(unsupported), ", ".join(sorted(argument_spec()))
+                )
+            )
+
+        for (name, spec) in argument_spec().items():
+            value = args.get(name)
+            if value is None:
+                value = spec.get("default")
+            elif spec["type"] == "bool":
+                value = boolean(value)
+            elif spec["type"] == "int":
+                value = int(value)
+            elif spec["type"] == "path":
+                value = os.path.expanduser(os.path.expandvars(value))
+            elif spec["type"] == "list" and not isinstance(value, list):
+                value = str(value).split(",")
+
+            if "choices" in spec and value not in spec["choices"]:
+                self.fail_json(
+                    msg="value of {} must be one of: {}, got: {}".format(
+                        name, ", ".join(spec["choices"]), value
+                    )
+                )
+
+            self.params[name] = value
+
+    def get_bin_path(self, arg, required=False):
+        bin_path = shutil.which(arg)
+        if bin_path is None and required:
+            self.fail_json(msg="Failed to find required executable {}".format(arg))
+
+        return bin_path
+
+    def run_command(self, args, check_rc=False, cwd=None):
+        process = subprocess.Popen(
+            args,
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        (stdout, stderr) = process.communicate()
+        (stdout, stderr) = (
+            stdout.decode("utf-8", "replace"),
+            stderr.decode("utf-8", "replace"),
+        )
+        if process.returncode != 0 and check_rc:
+            self.fail_json(
+                cmd=args,
+                rc=process.returncode,
+                stdout=stdout,
+                stderr=stderr,
+                msg=stderr.rstrip(),
+            )
+
+        return (process.returncode, stdout, stderr)
+
+    def exit_json(self, **result):
+        raise ControllerModuleExit(result)
+
+    def fail_json(self, **result):
+        result["failed"] = True
+        raise ControllerModuleExit(result)
+
+
+def run_on_controller(args, check_mode=False):
+    """Runs Base16Builder outside of a module process and returns its result"""
+    try:
+        Base16Builder(ControllerModule(args, check_mode)).run()
+    except ControllerModuleExit as module_exit:
+        return module_exit.result
+
+
+def main():
+    module = AnsibleModule(argument_spec=argument_spec(), supports_check_mode=True)
+
     return Base16Builder(module).run()
 
 
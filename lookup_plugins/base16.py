@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = """
+lookup: base16
+short_description: Looks up a single Base16 color scheme or rendered template
+description:
+  - Returns the variables of each named color scheme, or with the template option, that scheme rendered with a single template
+  - Builds on the controller with the same classes as the base16_builder module, cloning any missing sources into the controller's cache dir
+  - Results are memoized in the controller's cache dir for the rest of the playbook run, so repeating the same lookup across hosts, tasks and templates doesn't parse or render anything again
+options:
+  _terms:
+    description: Names of color schemes
+    required: true
+  scheme_family:
+    description: Name of the scheme family (repo), if it isn't part of the scheme name
+  template:
+    description: Name of a template repo to render the scheme with
+  template_file:
+    description: Name of the template entry in the template repo's config.yaml to render
+    default: default
+  schemes_source:
+    description: Git repo URL or local directory path used to find schemes, or an ordered list of them
+  templates_source:
+    description: Git repo URL or local directory path used to find templates, or an ordered list of them
+  cache_dir:
+    description: Parent directory to store cloned scheme, template and source data
+  palette_variables:
+    description: Also return, or render templates with, each base's nearest xterm-256 and ANSI 16 colors, relative luminance and contrast ratio with base00
+    type: bool
+    default: false
+  lockfile:
+    description: Path to a lockfile written by the base16_builder module's update. Sources are checked out at the commits it pins.
+"""
+
+EXAMPLES = """
+- debug:
+    msg: "Background color is #{{ lookup('base16', 'tomorrow-night')['base00-hex'] }}"
+
+- copy:
+    content: "{{ lookup('base16', 'tomorrow-night', template='i3', template_file='colors') }}"
+    dest: ~/.config/i3/colors
+"""
+
+import importlib.util
+import os
+import sys
+
+from ansible.errors import AnsibleError
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.lookup import LookupBase
+
+SOURCE_OPTIONS = ["schemes_source", "templates_source", "cache_dir", "lockfile"]
+
+
+def load_action_plugin():
+    """
+    Loads this role's base16_builder action plugin, which loads the
+    base16_builder module and memoizes results on the controller
+    """
+    module_name = "base16_builder_ansible_action"
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            module_name,
+            os.path.join(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                "action_plugins",
+                "base16_builder.py",
+            ),
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[module_name] = module
+
+    return sys.modules[module_name]
+
+
+def load_base16_builder():
+    """Loads the base16_builder module the same way the action plugin does"""
+    return load_action_plugin().load_base16_builder()
+
+
+def _builder(base16_builder, args):
+    try:
+        return base16_builder.Base16Builder(base16_builder.ControllerModule(args))
+    except base16_builder.ControllerModuleExit as module_exit:
+        raise AnsibleError(module_exit.result["msg"])
+
+
+def _sources(base16_builder, source_repo):
+    try:
+        for source in source_repo.sources():
+            yield source
+    except base16_builder.ControllerModuleExit as module_exit:
+        raise AnsibleError(module_exit.result["msg"])
+
+
+def find_scheme(base16_builder, source_args, scheme, scheme_family=None):
+    builder = _builder(
+        base16_builder, dict(source_args, scheme=scheme, scheme_family=scheme_family)
+    )
+    for found_scheme in _sources(base16_builder, builder.schemes_repo):
+        if found_scheme.slug() == scheme:
+            return found_scheme
+
+    raise AnsibleError('No Base16 scheme named "{}" was found'.format(scheme))
+
+
+def find_template(base16_builder, source_args, template, template_file):
+    builder = _builder(
+        base16_builder,
+        dict(source_args, template=["{}:{}".format(template, template_file)]),
+    )
+    for found_template in _sources(base16_builder, builder.templates_repo):
+        return found_template
+
+    raise AnsibleError(
+        'No Base16 template file "{}" was found in template "{}"'.format(
+            template_file, template
+        )
+    )
+
+
+def look_up(base16_builder, source_args, term, options):
+    scheme = find_scheme(
+        base16_builder, source_args, term, options.get("scheme_family")
+    )
+    palette = boolean(options.get("palette_variables", False))
+    if not options.get("template"):
+        return scheme.base16_variables(palette).materialize()
+
+    template = find_template(
+        base16_builder,
+        source_args,
+        options["template"],
+        options.get("template_file", "default"),
+    )
+    return template.render(scheme.base16_variables(palette))
+
+
+class LookupModule(LookupBase):
+    def run(self, terms, variables=None, **kwargs):
+        action_plugin = load_action_plugin()
+        base16_builder = action_plugin.load_base16_builder()
+        source_args = dict(
+            (option, kwargs[option]) for option in SOURCE_OPTIONS if option in kwargs
+        )
+        # Ansible evaluates lookups in a worker forked for each host and task,
+        # so results are memoized on disk for the rest of the playbook run
+        memo_dir = os.path.join(
+            os.path.expanduser(
+                source_args.get("cache_dir")
+                or base16_builder.argument_spec()["cache_dir"]["default"]
+            ),
+            "base16-builder-ansible",
+            "controller-lookups",
+        )
+
+        results = []
+        for term in terms:
+            results.append(
+                action_plugin.memoized(
+                    base16_builder,
+                    memo_dir,
+                    [term, kwargs],
+                    action_plugin.playbook_run_id(),
+                    lambda: look_up(base16_builder, source_args, term, kwargs),
+                )
+            )
+
+        return results
@@ -1,16 +1,32 @@
+import fcntl
+import functools
+import http.server
 import json
-from unittest.mock import ANY, call, patch
+import multiprocessing
+from unittest.mock import ANY, MagicMock, call, patch
 import os
 import re
 import shutil
+import subprocess
+import tarfile
 import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
 from ansible.module_utils import basic
 from ansible.module_utils._text import to_bytes
+import yaml
 
 
+from action_plugins import base16_builder as base16_builder_action
+from filter_plugins import base16 as base16_filters
 from library import base16_builder
+from lookup_plugins import base16 as base16_lookup
+
+# Kept for tests that patch run_in_session to hang some of the commands
+run_in_session = base16_builder.run_in_session
 
 
 def set_module_args(args):
@@ -51,6 +67,26 @@ TEMPLATE_NAME = re.compile(r".*base16-(.*)$")
 # TODO: Tests on failed git commands
 
 
+def make_git_repo(path, source_dir=None, files=None):
+    """Creates a real git repo to clone from, for tests that run actual git"""
+    if source_dir:
+        shutil.copytree(source_dir, path)
+    elif not os.path.exists(path):
+        os.makedirs(path)
+
+    for (file_name, contents) in (files or {}).items():
+        with open(os.path.join(path, file_name), "w") as new_file:
+            new_file.write(contents)
+
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+    if not os.path.exists(os.path.join(path, ".git")):
+        subprocess.check_call(git + ["init", "-q"], cwd=path)
+    subprocess.check_call(git + ["add", "-A"], cwd=path)
+    subprocess.check_call(git + ["commit", "-q", "-m", "Test commit"], cwd=path)
+
+    return "file://{}".format(path)
+
+
 def fake_run_command(command, **kwargs):
     if command and "git" in command[0] and command[1] == "clone":
         if "schemes-source" in command[2]:
@@ -94,12 +130,69 @@ def fake_run_command(command, **kwargs):
         with open(os.path.join(command[3], ".git", "config"), "w") as git_config:
             git_config.write("url = {}".format(command[2]))
 
-    elif command and git in command[0] and command[1] == "pull":
-        return
+        return (0, "", "")
+    elif command and "git" in command[0] and command[1] in ["pull", "gc"]:
+        return (0, "", "")
+    elif command and "git" in command[0] and command[1] == "ls-remote":
+        return (0, "0123456789abcdef0123456789abcdef01234567\tHEAD\n", "")
     else:
         raise ValueError("Unexpected command: {}".format(" ".join(command)))
 
 
+def fake_run_in_session(command, cwd=None, timeout=None):
+    return fake_run_command(command, cwd=cwd)
+
+
+async def fake_run_in_session_async(command, cwd=None, timeout=None):
+    return fake_run_command(command, cwd=cwd)
+
+
+def make_archive_mirror(mirror_dir, archive_format):
+    """
+    Archives the scheme fixtures the way GitHub would, named after the last
+    part of the repo URLs in the fixture lists
+    """
+    fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+    os.makedirs(mirror_dir)
+    for (name, fixture_dir) in [
+        ("base16-schemes-source", os.path.join("sources", "schemes")),
+        ("base16-tomorrow-scheme", os.path.join("schemes", "tomorrow")),
+    ]:
+        archive_path = os.path.join(mirror_dir, "{}.{}".format(name, archive_format))
+        if archive_format == "zip":
+            with zipfile.ZipFile(archive_path, "w") as archive:
+                for file_name in os.listdir(os.path.join(fixtures_dir, fixture_dir)):
+                    archive.write(
+                        os.path.join(fixtures_dir, fixture_dir, file_name),
+                        os.path.join("{}-main".format(name), file_name),
+                    )
+        else:
+            with tarfile.open(archive_path, "w:gz") as archive:
+                archive.add(
+                    os.path.join(fixtures_dir, fixture_dir),
+                    arcname="{}-main".format(name),
+                )
+
+
+class CountingRequestHandler(http.server.SimpleHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_response(self, code, message=None):
+        CountingRequestHandler.requests.append((self.path, code))
+        super(CountingRequestHandler, self).send_response(code, message)
+
+
+try:
+    import dulwich  # noqa: F401
+
+    HAS_DULWICH = True
+except ImportError:
+    HAS_DULWICH = False
+
+
 class TestBase16Builder(unittest.TestCase):
     def delete_test_cache_dir(self):
         if os.path.exists(self.test_cache_dir):
@@ -469,6 +562,174 @@ class TestBase16Builder(unittest.TestCase):
         self.assertEqual(list(result_args["schemes"].keys()), ["tomorrow-night"])
         self.assertEqual(result_args["changed"], True)
 
+    @patch.object(base16_builder.time, "sleep")
+    @patch.object(basic.AnsibleModule, "run_command")
+    def test_module_retries_failed_git_commands_with_backoff(
+        self, mock_run_command, mock_sleep
+    ):
+        failed_pulls = []
+
+        def flaky_run_command(command, **kwargs):
+            # Every repo's first two pulls fail
+            if command[1] == "pull" and failed_pulls.count(kwargs["cwd"]) < 2:
+                failed_pulls.append(kwargs["cwd"])
+                return (1, "", "Connection reset by peer")
+
+            return fake_run_command(command, **kwargs)
+
+        mock_run_command.side_effect = flaky_run_command
+        args = {
+            "scheme": "tomorrow-night",
+            "template": "i3",
+            "cache_dir": self.test_cache_dir,
+        }
+        set_module_args(args)
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        set_module_args(dict(args, update=True, git_retries=2))
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        result_args = result.exception.args[0]
+
+        self.assertEqual(list(result_args["schemes"].keys()), ["tomorrow-night"])
+        pulled_paths = sorted(set(failed_pulls))
+        self.assertEqual(len(failed_pulls), 2 * len(pulled_paths))
+        self.assertEqual(sorted(result_args["durations"].keys()), pulled_paths)
+        self.assertEqual(
+            mock_sleep.call_args_list, [call(1), call(2)] * len(pulled_paths)
+        )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    @patch.object(base16_builder, "run_in_session")
+    def test_module_keeps_stale_repos_when_pulls_time_out(
+        self, mock_run_in_session, mock_run_command
+    ):
+        tomorrow_path = os.path.join(
+            self.test_cache_dir, "base16-builder-ansible", "schemes", "tomorrow"
+        )
+
+        def hanging_run_in_session(command, cwd=None, timeout=None):
+            if command[1] != "pull" or cwd != tomorrow_path:
+                return fake_run_command(command, cwd=cwd)
+
+            return run_in_session(["sleep", "30"], timeout=timeout)
+
+        mock_run_in_session.side_effect = hanging_run_in_session
+        args = {
+            "scheme": "tomorrow-night",
+            "template": "i3",
+            "cache_dir": self.test_cache_dir,
+        }
+        set_module_args(args)
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        set_module_args(dict(args, update=True, git_timeout=1, stale_on_timeout=True))
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        result_args = result.exception.args[0]
+
+        self.assertEqual(list(result_args["schemes"].keys()), ["tomorrow-night"])
+        self.assertEqual(result_args["stale"], [tomorrow_path])
+        self.assertGreaterEqual(result_args["durations"][tomorrow_path], 1)
+
+        set_module_args(dict(args, update=True, git_timeout=1))
+        with self.assertRaises(AnsibleFailJson) as result:
+            base16_builder.main()
+        self.assertIn("timed out after 1 seconds", result.exception.args[0]["msg"])
+
+    @unittest.skipUnless(shutil.which("git"), "Requires git")
+    @patch.object(base16_builder.time, "sleep")
+    def test_module_retries_clones_that_time_out_from_scratch(self, mock_sleep):
+        remotes_dir = os.path.join(self.test_cache_dir, "remotes")
+        tomorrow_url = make_git_repo(
+            os.path.join(remotes_dir, "tomorrow"),
+            source_dir=os.path.join(
+                os.path.dirname(__file__), "fixtures", "schemes", "tomorrow"
+            ),
+        )
+        args = {
+            "scheme_family": "tomorrow",
+            "template": [],
+            "schemes_source": make_git_repo(
+                os.path.join(remotes_dir, "schemes-source"),
+                files={"list.yaml": "tomorrow: {}\n".format(tomorrow_url)},
+            ),
+            "git_timeout": 1,
+            "git_retries": 1,
+        }
+        timed_out_clones = []
+        fail_retries = False
+
+        def run_in_session_timing_out_first_clones(command, cwd=None, timeout=None):
+            if command[1] == "clone" and command[3] not in timed_out_clones:
+                timed_out_clones.append(command[3])
+                # Killed clones leave a partial checkout behind
+                os.makedirs(os.path.join(command[3], ".git"))
+                return run_in_session(["sleep", "30"], timeout=timeout)
+            if command[1] == "clone" and fail_retries:
+                return (128, "", "fatal: unable to access remote")
+
+            return run_in_session(command, cwd, timeout)
+
+        set_module_args(dict(args, cache_dir=os.path.join(self.test_cache_dir, "a")))
+        with patch.object(
+            base16_builder,
+            "run_in_session",
+            side_effect=run_in_session_timing_out_first_clones,
+        ), self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+
+        self.assertEqual(
+            sorted(result.exception.args[0]["schemes"].keys()),
+            ["tomorrow", "tomorrow-night"],
+        )
+        # The source list and the scheme repo were both cloned again
+        self.assertEqual(len(timed_out_clones), 2)
+        # Waiting on a command with a timeout also sleeps, for far less
+        self.assertEqual(
+            [sleep for sleep in mock_sleep.call_args_list if sleep[0][0] >= 1],
+            [call(1), call(1)],
+        )
+
+        # A timeout is reported even when the retry fails some other way
+        fail_retries = True
+        set_module_args(dict(args, cache_dir=os.path.join(self.test_cache_dir, "b")))
+        with patch.object(
+            base16_builder,
+            "run_in_session",
+            side_effect=run_in_session_timing_out_first_clones,
+        ), self.assertRaises(AnsibleFailJson) as result:
+            base16_builder.main()
+
+        self.assertIn("timed out after 1 seconds", result.exception.args[0]["msg"])
+
+    def test_timed_out_commands_are_killed_with_the_processes_they_started(self):
+        start = time.monotonic()
+        # The backgrounded sleep outlives sh, and holds its output open
+        self.assertEqual(
+            run_in_session(["sh", "-c", "sleep 30 & wait"], timeout=1), (None, "", "")
+        )
+        self.assertLess(time.monotonic() - start, 10)
+
+        start = time.monotonic()
+        loop = base16_builder.asyncio.new_event_loop()
+        base16_builder.asyncio.set_event_loop(loop)
+        try:
+            self.assertEqual(
+                loop.run_until_complete(
+                    base16_builder.run_in_session_async(
+                        ["sh", "-c", "sleep 30 & wait"], timeout=1
+                    )
+                ),
+                (None, "", ""),
+            )
+        finally:
+            base16_builder.asyncio.set_event_loop(None)
+            loop.close()
+        self.assertLess(time.monotonic() - start, 10)
+
     @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
     def test_module_update_can_use_template_and_scheme(self, mock_run_command):
         set_module_args(
@@ -648,3 +909,1725 @@ class TestBase16Builder(unittest.TestCase):
             result.exception.args[0]["msg"],
             'Failed to build any templates. Template names [\'not-a-real-template\'] were passed, but didn\'t match any known templates',
         )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_locks_cached_repos(self, mock_run_command):
+        set_module_args(
+            {
+                "scheme": "tomorrow-night",
+                "template": "i3",
+                "cache_dir": self.test_cache_dir,
+            }
+        )
+
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        cache_dir = os.path.join(self.test_cache_dir, "base16-builder-ansible")
+        for lock_path in [
+            os.path.join(cache_dir, "sources", ".schemes.lock"),
+            os.path.join(cache_dir, "sources", ".templates.lock"),
+            os.path.join(cache_dir, "schemes", ".tomorrow.lock"),
+            os.path.join(cache_dir, "templates", ".i3.lock"),
+        ]:
+            self.assertTrue(os.path.exists(lock_path), lock_path)
+
+        # Check mode neither creates lock files nor marks repos as used
+        scheme_lock_path = os.path.join(cache_dir, "schemes", ".tomorrow.lock")
+        os.utime(scheme_lock_path, (0, 0))
+        template_lock_path = os.path.join(cache_dir, "templates", ".i3.lock")
+        os.remove(template_lock_path)
+        set_module_args(
+            {
+                "scheme": "tomorrow-night",
+                "template": "i3",
+                "cache_dir": self.test_cache_dir,
+                "_ansible_check_mode": True,
+            }
+        )
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        self.assertEqual(os.path.getmtime(scheme_lock_path), 0)
+        self.assertFalse(os.path.exists(template_lock_path))
+
+    def test_repo_lock_lets_readers_share_but_excludes_updaters(self):
+        repo_path = os.path.join(self.test_cache_dir, "repo")
+        os.makedirs(repo_path)
+        lock = base16_builder.RepoLock(repo_path)
+
+        with lock.shared():
+            with open(lock.path) as other_lock_file:
+                fcntl.flock(other_lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                fcntl.flock(other_lock_file, fcntl.LOCK_UN)
+
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(other_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        with lock.exclusive():
+            with open(lock.path) as other_lock_file:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(other_lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+
+    def test_scheme_variables_are_derived_from_packed_colors(self):
+        scheme_path = os.path.join(self.test_cache_dir, "upper-case.yaml")
+        os.makedirs(self.test_cache_dir)
+        with open(scheme_path, "w") as scheme_file:
+            scheme_file.write('scheme: "Upper Case"\nauthor: "test"\n')
+            for base in range(14):
+                scheme_file.write('base{:02X}: "{}"\n'.format(base, "0A0B0C"))
+            scheme_file.write('base0E: "aB12cD"\n')
+            scheme_file.write('base0F: "0a0b0c"\n')
+
+        scheme = base16_builder.Scheme(scheme_path)
+        variables = scheme.base16_variables()
+
+        self.assertEqual(len(scheme.colors), 48)
+        self.assertFalse(hasattr(scheme, "__dict__"))
+        self.assertEqual(len(variables.materialize()), 180)
+        self.assertEqual(dict(variables), variables.materialize())
+        self.assertEqual(variables["base00-hex"], "0A0B0C")
+        self.assertEqual(variables["base00-hex-bgr"], "0C0B0A")
+        self.assertEqual(variables["base00-hex-g"], "0B")
+        self.assertEqual(variables["base00-rgb-b"], "12")
+        self.assertEqual(variables["base00-dec-r"], str(10 / 255))
+        self.assertEqual(variables["base0F-hex"], "0a0b0c")
+        # Mixed case values are rendered exactly as they were written
+        self.assertEqual(variables["base0E-hex"], "aB12cD")
+        self.assertEqual(variables["base0E-hex-r"], "aB")
+        self.assertEqual(variables["base0E-hex-b"], "cD")
+        self.assertEqual(variables["base0E-hex-bgr"], "cD12aB")
+        self.assertEqual(
+            base16_builder.decode_scheme_export(
+                base16_builder.export_schemes([scheme], "packed")
+            ),
+            [variables.materialize()],
+        )
+        self.assertEqual(variables["scheme-slug-underscored"], "upper_case")
+        self.assertNotIn("base10-hex", variables)
+        with self.assertRaises(KeyError):
+            variables["base10-hex"]
+
+    def test_palette_variables_approximate_each_base_for_terminals(self):
+        scheme = base16_builder.Scheme(
+            os.path.join(
+                os.path.dirname(__file__),
+                "fixtures",
+                "schemes",
+                "tomorrow",
+                "tomorrow-night.yaml",
+            )
+        )
+        variables = scheme.base16_variables(palette=True)
+
+        self.assertNotIn("base00-xterm256", scheme.base16_variables())
+        self.assertEqual(len(variables.materialize()), 180 + 64)
+        self.assertEqual(dict(variables), variables.materialize())
+        # 1d1f21 is nearest gray 28 and c5c8c6 gray 198
+        self.assertEqual(variables["base00-xterm256"], "234")
+        self.assertEqual(variables["base00-ansi16"], "0")
+        self.assertEqual(variables["base05-xterm256"], "251")
+        self.assertEqual(variables["base05-ansi16"], "7")
+        self.assertEqual(variables["base00-contrast"], "1.00")
+        self.assertEqual(
+            variables["base05-luminance"],
+            "{:.4f}".format(base16_builder.relative_luminance(scheme.colors, 5)),
+        )
+        self.assertEqual(
+            variables["base05-contrast"],
+            "{:.2f}".format(
+                (base16_builder.relative_luminance(scheme.colors, 5) + 0.05)
+                / (base16_builder.relative_luminance(scheme.colors, 0) + 0.05)
+            ),
+        )
+
+        set_module_args(
+            {
+                "scheme": "tomorrow-night",
+                "template": [],
+                "palette_variables": True,
+                "cache_dir": self.test_cache_dir,
+            }
+        )
+        with patch.object(
+            basic.AnsibleModule, "run_command", side_effect=fake_run_command
+        ):
+            with self.assertRaises(AnsibleExitJson) as result:
+                base16_builder.main()
+        self.assertEqual(
+            result.exception.args[0]["schemes"]["tomorrow-night"]["scheme-variables"],
+            variables.materialize(),
+        )
+
+    def test_flat_templates_render_the_same_as_pystache(self):
+        fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+        schemes = []
+        for scheme_dir in os.listdir(os.path.join(fixtures_dir, "schemes")):
+            for scheme_file in os.listdir(
+                os.path.join(fixtures_dir, "schemes", scheme_dir)
+            ):
+                if scheme_file.endswith(".yaml"):
+                    schemes.append(
+                        base16_builder.Scheme(
+                            os.path.join(
+                                fixtures_dir, "schemes", scheme_dir, scheme_file
+                            )
+                        )
+                    )
+
+        flat_templates = 0
+        for template_family in os.listdir(os.path.join(fixtures_dir, "templates")):
+            templates_dir = os.path.join(
+                fixtures_dir, "templates", template_family, "templates"
+            )
+            for template_file in os.listdir(templates_dir):
+                if not template_file.endswith(".mustache"):
+                    continue
+
+                template = base16_builder.Template(
+                    template_family, os.path.join(templates_dir, template_file), {}
+                )
+                if template.flat_segments() is not None:
+                    flat_templates += 1
+
+                for scheme in schemes:
+                    self.assertEqual(
+                        template.render(scheme.base16_variables()),
+                        template.renderer.render_path(
+                            template.path, scheme.base16_variables().materialize()
+                        ),
+                    )
+
+        self.assertTrue(flat_templates > 1)
+
+    def test_templates_using_other_mustache_features_are_not_flat(self):
+        self.assertEqual(
+            base16_builder.compile_flat_template("a {{b}} {{{c}}} {{& d}}"),
+            ["a ", ("b", True), " ", ("c", False), " ", ("d", False), ""],
+        )
+        for source in [
+            "{{#base00-hex}}x{{/base00-hex}}",
+            "{{> partial}}",
+            "{{! comment }}",
+            "{{=<% %>=}}",
+            "{{scheme.name}}",
+        ]:
+            self.assertIsNone(base16_builder.compile_flat_template(source), source)
+
+        self.assertEqual(
+            base16_builder.render_flat_template(
+                ["<", ("a", True), "|", ("a", False), "|", ("missing", True), ">"],
+                {"a": "Tom & <Jerry>"},
+            ),
+            "<Tom &amp; &lt;Jerry&gt;|Tom & <Jerry>|>",
+        )
+
+    def test_partials_are_inlined_the_same_as_pystache(self):
+        templates_dir = os.path.join(self.test_cache_dir, "templates")
+        os.makedirs(templates_dir)
+        for (name, source) in [
+            ("standalone", "a\n  {{> partial }}\nb {{> partial}} c\n"),
+            ("crlf", "{{>partial}}\r\n\t{{> partial }}"),
+            ("trailing-space", "  {{> partial }} \n{{> nested}}"),
+            ("missing", "a\n  {{> not-a-partial }}\nb {{> not-a-partial}}"),
+            ("partial", "<{{base00-hex}}>\n  {{{scheme-name}}}\n"),
+            ("nested", "x\n    {{> partial}}\n"),
+            ("recursive", "{{scheme-slug}}\n{{> recursive}}"),
+        ]:
+            with open(
+                os.path.join(templates_dir, "{}.mustache".format(name)), "w", newline=""
+            ) as template_file:
+                template_file.write(source)
+
+        scheme = base16_builder.Scheme(
+            os.path.join(
+                os.path.dirname(__file__),
+                "fixtures",
+                "schemes",
+                "tomorrow",
+                "tomorrow.yaml",
+            )
+        )
+        for name in ["standalone", "crlf", "trailing-space", "missing", "nested"]:
+            template = base16_builder.Template(
+                "test", os.path.join(templates_dir, "{}.mustache".format(name)), {}
+            )
+            self.assertIsNotNone(template.flat_segments(), name)
+            self.assertEqual(
+                template.render(scheme.base16_variables()),
+                template.renderer.render_path(
+                    template.path, scheme.base16_variables().materialize()
+                ),
+                name,
+            )
+
+        (segments, input_paths, _) = base16_builder.compile_template_file(
+            os.path.join(templates_dir, "recursive.mustache")
+        )
+        self.assertIsNone(segments)
+        self.assertEqual(
+            input_paths, [os.path.join(templates_dir, "recursive.mustache")]
+        )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_builds_from_templates_compiled_at_update(self, mock_run_command):
+        args = {
+            "scheme": "tomorrow-night",
+            "template": "i3",
+            "cache_dir": self.test_cache_dir,
+        }
+        set_module_args(dict(args, update=True))
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        built = result.exception.args[0]["schemes"]
+
+        compiled_dir = os.path.join(
+            self.test_cache_dir, "base16-builder-ansible", "compiled-templates"
+        )
+        with open(os.path.join(compiled_dir, "i3.json")) as index_file:
+            index = json.load(index_file)
+        self.assertEqual(
+            sorted(index["templates"].keys()),
+            [
+                "bar-colors.mustache",
+                "client-properties.mustache",
+                "colors.mustache",
+                "default.mustache",
+            ],
+        )
+
+        # Builds load the compiled templates without reading any template
+        # sources
+        set_module_args(args)
+        with patch.object(
+            base16_builder, "read_template_source", side_effect=AssertionError
+        ), self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertEqual(result.exception.args[0]["schemes"], built)
+
+        # Editing a partial recompiles the templates that include it
+        partial_path = os.path.join(
+            self.test_cache_dir,
+            "base16-builder-ansible",
+            "templates",
+            "i3",
+            "templates",
+            "colors.mustache",
+        )
+        with open(partial_path, "a") as partial_file:
+            partial_file.write("# edited\n")
+
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        themes = result.exception.args[0]["schemes"]["tomorrow-night"]["i3"]["themes"]
+        self.assertIn("# edited", themes["base16-tomorrow-night.config"])
+
+        set_module_args(dict(args, build=False, prune=True))
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+        with open(os.path.join(compiled_dir, "i3.json")) as index_file:
+            index = json.load(index_file)
+        referenced = set(entry["hash"] for entry in index["templates"].values())
+        self.assertEqual(
+            set(
+                os.path.splitext(file_name)[0]
+                for file_name in os.listdir(os.path.join(compiled_dir, "objects"))
+            ),
+            referenced,
+        )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_queries_the_scheme_index_without_building(self, mock_run_command):
+        for (query, expected_matches) in [
+            (
+                {"dark": True},
+                [
+                    "local-scheme",
+                    "local-scheme-night",
+                    "material",
+                    "material-darker",
+                    "material-palenight",
+                    "tomorrow-night",
+                ],
+            ),
+            ({"author": "*kempson*", "dark": "no"}, ["tomorrow"]),
+            ({"min_luminance": 0.9}, ["material-lighter", "tomorrow"]),
+            ({"family": "material*", "name": "*dark*"}, ["material-darker"]),
+        ]:
+            set_module_args({"query": query, "cache_dir": self.test_cache_dir})
+            with patch.object(
+                base16_builder, "Template", side_effect=AssertionError
+            ), self.assertRaises(AnsibleExitJson) as result:
+                base16_builder.main()
+
+            self.assertEqual(result.exception.args[0]["matches"], expected_matches)
+            self.assertNotIn("tomorrow", result.exception.args[0]["schemes"])
+
+        # Unchanged repos aren't reindexed, even when they're updated
+        set_module_args(
+            {"query": {"dark": True}, "update": True, "cache_dir": self.test_cache_dir}
+        )
+        with patch.object(
+            base16_builder, "parse_scheme", side_effect=base16_builder.parse_scheme
+        ) as mock_parse_scheme, self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+        self.assertEqual(mock_parse_scheme.call_count, 0)
+
+        tomorrow_path = os.path.join(
+            self.test_cache_dir, "base16-builder-ansible", "schemes", "tomorrow"
+        )
+        shutil.copy(
+            os.path.join(tomorrow_path, "tomorrow-night.yaml"),
+            os.path.join(tomorrow_path, "tomorrow-night-copy.yaml"),
+        )
+        with patch.object(
+            base16_builder, "parse_scheme", side_effect=base16_builder.parse_scheme
+        ) as mock_parse_scheme, self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertEqual(mock_parse_scheme.call_count, 3)
+        self.assertIn("tomorrow-night-copy", result.exception.args[0]["matches"])
+
+        set_module_args({"query": {"colour": "red"}, "cache_dir": self.test_cache_dir})
+        with self.assertRaises(AnsibleFailJson):
+            base16_builder.main()
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_merges_multiple_source_lists(self, mock_run_command):
+        extra_list_dir = os.path.join(self.test_cache_dir, "extra-schemes-source")
+        os.makedirs(extra_list_dir)
+        with open(os.path.join(extra_list_dir, "list.yaml"), "w") as list_file:
+            list_file.write(
+                "tomorrow: {}\nmaterial-copy: {}\n".format(
+                    os.path.join(
+                        os.path.dirname(__file__), "fixtures", "schemes", "local-scheme"
+                    ),
+                    "https://github.com/ntpeters/base16-materialtheme-scheme",
+                )
+            )
+
+        set_module_args(
+            {
+                "schemes_source": [
+                    "https://github.com/chriskempson/base16-schemes-source",
+                    extra_list_dir,
+                ],
+                "template": "i3:colors",
+                "cache_dir": self.test_cache_dir,
+            }
+        )
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+
+        # The later list's tomorrow family replaces the master list's, and the
+        # materialtheme repo it lists again under another name isn't cloned twice
+        self.assertEqual(
+            sorted(result.exception.args[0]["schemes"].keys()),
+            [
+                "local-scheme",
+                "local-scheme-night",
+                "material",
+                "material-darker",
+                "material-lighter",
+                "material-palenight",
+            ],
+        )
+        cloned_urls = [
+            call[0][0][2]
+            for call in mock_run_command.call_args_list
+            if call[0][0][1] == "clone"
+        ]
+        self.assertEqual(
+            cloned_urls.count(
+                "https://github.com/ntpeters/base16-materialtheme-scheme"
+            ),
+            1,
+        )
+        self.assertNotIn(
+            "https://github.com/chriskempson/base16-tomorrow-scheme", cloned_urls
+        )
+
+        # Lists that are no longer sources are pruned
+        stale_list_dir = os.path.join(
+            self.test_cache_dir,
+            "base16-builder-ansible",
+            "sources",
+            "schemes-0123456789ab",
+        )
+        os.makedirs(stale_list_dir)
+        set_module_args(
+            {"build": False, "prune": True, "cache_dir": self.test_cache_dir}
+        )
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertIn(stale_list_dir, result.exception.args[0]["pruned"])
+        self.assertFalse(os.path.exists(stale_list_dir))
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_check_mode_plans_changes_without_cloning_or_rendering(
+        self, mock_run_command
+    ):
+        args = {
+            "scheme": "tomorrow-night",
+            "template": "i3",
+            "cache_dir": self.test_cache_dir,
+        }
+        sources_dir = os.path.join(
+            self.test_cache_dir, "base16-builder-ansible", "sources"
+        )
+
+        set_module_args(dict(args, _ansible_check_mode=True))
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertEqual(
+            result.exception.args[0]["plan"],
+            {
+                "clone": [
+                    os.path.join(sources_dir, "schemes"),
+                    os.path.join(sources_dir, "templates"),
+                ],
+                "pull": [],
+                "create": [],
+                "modify": [],
+            },
+        )
+        self.assertTrue(result.exception.args[0]["changed"])
+        self.assertFalse(os.path.exists(self.test_cache_dir))
+
+        set_module_args(args)
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        # Nothing would change after a build with the same args
+        set_module_args(dict(args, _ansible_check_mode=True))
+        with patch.object(
+            base16_builder, "Template", side_effect=AssertionError
+        ), self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertEqual(
+            result.exception.args[0]["plan"],
+            {"clone": [], "pull": [], "create": [], "modify": []},
+        )
+        self.assertFalse(result.exception.args[0]["changed"])
+
+        # Every output built from a repo whose remote moved on would change
+        set_module_args(dict(args, update=True, _ansible_check_mode=True))
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        plan = result.exception.args[0]["plan"]
+        self.assertEqual(len(plan["pull"]), 4)
+        self.assertEqual(
+            plan["modify"],
+            [
+                "tomorrow-night/i3/bar-colors/base16-tomorrow-night.config",
+                "tomorrow-night/i3/client-properties/base16-tomorrow-night.config",
+                "tomorrow-night/i3/colors/base16-tomorrow-night.config",
+                "tomorrow-night/i3/themes/base16-tomorrow-night.config",
+            ],
+        )
+
+        # Outputs that no build with the same args has built would be created
+        schemes_dir = os.path.join(
+            self.test_cache_dir, "base16-builder-ansible", "schemes", "tomorrow"
+        )
+        shutil.copy(
+            os.path.join(schemes_dir, "tomorrow-night.yaml"),
+            os.path.join(schemes_dir, "tomorrow-night-copy.yaml"),
+        )
+        set_module_args(dict(args, template="i3:colors", _ansible_check_mode=True))
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertEqual(
+            result.exception.args[0]["plan"]["create"],
+            [
+                "tomorrow-night-copy/i3/colors/base16-tomorrow-night-copy.config",
+                "tomorrow-night/i3/colors/base16-tomorrow-night.config",
+            ],
+        )
+        self.assertFalse(
+            any(call[0][0][1] == "pull" for call in mock_run_command.call_args_list)
+        )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_builds_only_scheme_variables_for_an_empty_template_list(
+        self, mock_run_command
+    ):
+        set_module_args(
+            {
+                "scheme": "tomorrow-night",
+                "template": [],
+                "update": True,
+                "prune": True,
+                "cache_dir": self.test_cache_dir,
+            }
+        )
+        with patch.object(
+            base16_builder, "TemplateRepo", side_effect=AssertionError
+        ), self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+
+        self.assertEqual(
+            result.exception.args[0]["schemes"]["tomorrow-night"].keys(),
+            {"scheme-variables"},
+        )
+        self.assertEqual(
+            result.exception.args[0]["schemes"]["tomorrow-night"]["scheme-variables"][
+                "base00-hex"
+            ],
+            "1d1f21",
+        )
+        self.assertFalse(
+            any(
+                "templates" in call[0][0][2]
+                for call in mock_run_command.call_args_list
+            )
+        )
+        self.assertEqual(
+            sorted(
+                os.listdir(os.path.join(self.test_cache_dir, "base16-builder-ansible"))
+            ),
+            ["manifests", "scheme-index.json", "schemes", "sources"],
+        )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_exports_every_schemes_variables_to_one_file(self, mock_run_command):
+        args = {"template": [], "cache_dir": self.test_cache_dir}
+        set_module_args(args)
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        built_schemes = result.exception.args[0]["schemes"]
+
+        for export_format in ["jsonl", "csv", "packed"]:
+            with self.subTest(export_format=export_format):
+                export_path = os.path.join(
+                    self.test_cache_dir, "export", "schemes.{}".format(export_format)
+                )
+                set_module_args(
+                    dict(
+                        args,
+                        export_path=export_path,
+                        export_format=export_format,
+                        palette_variables=export_format == "packed",
+                    )
+                )
+                with self.assertRaises(AnsibleExitJson) as result:
+                    base16_builder.main()
+                result_args = result.exception.args[0]
+
+                self.assertTrue(result_args["changed"])
+                self.assertEqual(result_args["schemes"], {})
+                self.assertEqual(result_args["export"]["schemes"], len(built_schemes))
+
+                exported = base16_builder.read_scheme_export(export_path)
+                self.assertEqual(
+                    [variables["scheme-slug"] for variables in exported],
+                    list(built_schemes.keys()),
+                )
+                for variables in exported:
+                    built_variables = built_schemes[variables["scheme-slug"]][
+                        "scheme-variables"
+                    ]
+                    if export_format == "packed":
+                        self.assertIn("base0D-xterm256", variables)
+                        variables = dict(
+                            (name, value)
+                            for (name, value) in variables.items()
+                            if name in built_variables
+                        )
+                    self.assertEqual(variables, built_variables)
+
+                with self.assertRaises(AnsibleExitJson) as result:
+                    base16_builder.main()
+                self.assertFalse(result.exception.args[0]["changed"])
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_builds_an_artifact_that_hosts_extract_outputs_from(
+        self, mock_run_command
+    ):
+        args = {"template": ["i3", "shell"], "cache_dir": self.test_cache_dir}
+        set_module_args(
+            dict(
+                args,
+                # Only the {hash} placeholder is replaced, other braces are kept
+                artifact_path=os.path.join(
+                    self.test_cache_dir, "artifacts-{0}", "base16-{hash}.zip"
+                ),
+                artifact_mode="create",
+            )
+        )
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        result_args = result.exception.args[0]
+        built_schemes = result_args["schemes"]
+        artifact = result_args["artifact"]
+
+        self.assertTrue(result_args["changed"])
+        self.assertEqual(
+            artifact["path"],
+            os.path.join(
+                self.test_cache_dir,
+                "artifacts-{0}",
+                "base16-" + artifact["hash"][:16] + ".zip",
+            ),
+        )
+        with zipfile.ZipFile(artifact["path"]) as archive:
+            self.assertIn(
+                "tomorrow-night/i3/themes/base16-tomorrow-night.config",
+                archive.namelist(),
+            )
+            self.assertEqual(
+                set(entry.date_time for entry in archive.infolist()),
+                {(1980, 1, 1, 0, 0, 0)},
+            )
+
+        # Building the same outputs again leaves the artifact alone
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertFalse(result.exception.args[0]["changed"])
+        self.assertEqual(result.exception.args[0]["artifact"], artifact)
+
+        mock_run_command.reset_mock()
+        for (consume_args, expected_schemes) in [
+            ({}, built_schemes),
+            (
+                {"scheme": "tomorrow-night", "template": ["i3"]},
+                {
+                    "tomorrow-night": {
+                        "scheme-variables": built_schemes["tomorrow-night"][
+                            "scheme-variables"
+                        ],
+                        "i3": built_schemes["tomorrow-night"]["i3"],
+                    }
+                },
+            ),
+        ]:
+            set_module_args(
+                dict(
+                    args,
+                    cache_dir=os.path.join(self.test_cache_dir, "host"),
+                    artifact_path=artifact["path"],
+                    **consume_args
+                )
+            )
+            with self.assertRaises(AnsibleExitJson) as result:
+                base16_builder.main()
+            result_args = result.exception.args[0]
+
+            self.assertFalse(result_args["changed"])
+            self.assertEqual(result_args["schemes"], expected_schemes)
+            self.assertEqual(result_args["artifact"]["hash"], artifact["hash"])
+
+        mock_run_command.assert_not_called()
+        self.assertFalse(os.path.exists(os.path.join(self.test_cache_dir, "host")))
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_writes_metrics_that_add_up_across_runs(self, mock_run_command):
+        metrics_path = os.path.join(self.test_cache_dir, "metrics", "base16.prom")
+        args = {
+            "scheme": "tomorrow-night",
+            "template": "i3",
+            "cache_dir": self.test_cache_dir,
+            "metrics_path": metrics_path,
+        }
+        for _ in range(2):
+            set_module_args(args)
+            with self.assertRaises(AnsibleExitJson) as result:
+                base16_builder.main()
+        outputs = [
+            output
+            for output_files in result.exception.args[0]["schemes"]["tomorrow-night"][
+                "i3"
+            ].values()
+            for output in output_files.values()
+        ]
+
+        with open(metrics_path) as metrics_file:
+            metrics = metrics_file.read().splitlines()
+
+        self.assertIn("# TYPE base16_builder_schemes_total counter", metrics)
+        self.assertIn("base16_builder_schemes_total 2", metrics)
+        self.assertIn(
+            'base16_builder_template_renders_total{{template="i3"}} {}'.format(
+                2 * len(outputs)
+            ),
+            metrics,
+        )
+        self.assertIn(
+            "base16_builder_rendered_bytes_total {}".format(
+                2 * sum(len(output.encode("utf-8")) for output in outputs)
+            ),
+            metrics,
+        )
+        self.assertIn(
+            'base16_builder_render_duration_seconds_bucket{{le="+Inf"}} {}'.format(
+                2 * len(outputs)
+            ),
+            metrics,
+        )
+        self.assertIn(
+            'base16_builder_git_operations_total{{operation="clone",repo="{}"}} 1'.format(
+                os.path.join(
+                    self.test_cache_dir, "base16-builder-ansible", "schemes", "tomorrow"
+                )
+            ),
+            metrics,
+        )
+        # Templates were compiled when they were cloned by the first run
+        self.assertIn(
+            'base16_builder_cache_lookups_total{{cache="compiled_templates",result="hit"}} {}'.format(
+                2 * len(outputs)
+            ),
+            metrics,
+        )
+        self.assertEqual(
+            len(
+                [
+                    line
+                    for line in metrics
+                    if line.startswith("base16_builder_phase_duration_seconds")
+                ]
+            ),
+            1,
+        )
+
+        set_module_args(dict(args, metrics_format="json"))
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        with open(metrics_path) as metrics_file:
+            metrics = json.load(metrics_file)
+
+        self.assertEqual(metrics["run"]["schemes_total"], [{"labels": {}, "value": 1}])
+        self.assertEqual(
+            metrics["totals"]["schemes_total"], [{"labels": {}, "value": 3}]
+        )
+        self.assertEqual(
+            metrics["totals"]["render_duration_seconds"][0]["buckets"]["+Inf"],
+            3 * len(outputs),
+        )
+        self.assertEqual(
+            [sample["labels"] for sample in metrics["run"]["phase_duration_seconds"]],
+            [{"phase": "build"}],
+        )
+
+    def test_concurrent_runs_sharing_a_cache_add_up_their_metrics(self):
+        module = base16_builder.ControllerModule(
+            {
+                "cache_dir": self.test_cache_dir,
+                "metrics_path": os.path.join(self.test_cache_dir, "base16.prom"),
+            }
+        )
+
+        def write_metrics():
+            for _ in range(20):
+                metrics = base16_builder.RunMetrics(module)
+                metrics.inc("schemes_total")
+                metrics.write()
+
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=write_metrics) for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        with open(os.path.join(self.test_cache_dir, "base16.prom")) as metrics_file:
+            self.assertIn("base16_builder_schemes_total 80", metrics_file.read())
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_returns_only_outputs_changed_since_the_last_build_in_delta_mode(
+        self, mock_run_command
+    ):
+        set_module_args({"cache_dir": self.test_cache_dir, "scheme": "tomorrow-night"})
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        schemes = result.exception.args[0]["schemes"]
+
+        set_module_args(
+            {
+                "cache_dir": self.test_cache_dir,
+                "scheme": "tomorrow-night",
+                "delta": True,
+            }
+        )
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertEqual(result.exception.args[0]["schemes"], {})
+        self.assertEqual(result.exception.args[0]["removed"], [])
+        self.assertFalse(result.exception.args[0]["changed"])
+
+        # Pretend the i3 colors output was different, and that another output
+        # was built last time
+        manifests_dir = os.path.join(
+            self.test_cache_dir, "base16-builder-ansible", "manifests"
+        )
+        self.assertEqual(len(os.listdir(manifests_dir)), 1)
+        manifest_path = os.path.join(manifests_dir, os.listdir(manifests_dir)[0])
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        i3_key = "tomorrow-night/i3/colors/base16-tomorrow-night.config"
+        manifest["outputs"][i3_key]["hash"] = "0" * 64
+        manifest["outputs"]["tomorrow-night/old/nested/dir/base16-tomorrow-night"] = {
+            "hash": "0" * 64,
+            "revisions": [],
+        }
+        with open(manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertTrue(result.exception.args[0]["changed"])
+        self.assertEqual(
+            result.exception.args[0]["schemes"],
+            {
+                "tomorrow-night": {
+                    "scheme-variables": schemes["tomorrow-night"]["scheme-variables"],
+                    "i3": {
+                        "colors": {
+                            "base16-tomorrow-night.config": schemes["tomorrow-night"][
+                                "i3"
+                            ]["colors"]["base16-tomorrow-night.config"]
+                        }
+                    },
+                }
+            },
+        )
+        self.assertEqual(
+            result.exception.args[0]["removed"],
+            [
+                {
+                    "scheme": "tomorrow-night",
+                    "template": "old",
+                    "output_dir": "nested/dir",
+                    "file_name": "base16-tomorrow-night",
+                }
+            ],
+        )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_can_return_encoded_schemes_that_the_filter_expands(
+        self, mock_run_command
+    ):
+        set_module_args({"cache_dir": self.test_cache_dir})
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        plain_schemes = result.exception.args[0]["schemes"]
+        self.assertIs(base16_filters.base16_expand(plain_schemes), plain_schemes)
+
+        for result_format in ["compressed", "deduplicated"]:
+            set_module_args(
+                {"cache_dir": self.test_cache_dir, "result_format": result_format}
+            )
+            with self.assertRaises(AnsibleExitJson) as result:
+                base16_builder.main()
+            encoded_schemes = result.exception.args[0]["schemes"]
+
+            self.assertTrue(
+                len(json.dumps(encoded_schemes)) < len(json.dumps(plain_schemes)),
+                result_format,
+            )
+            self.assertEqual(
+                base16_filters.base16_expand(encoded_schemes), plain_schemes
+            )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_builds_the_same_schemes_when_parsing_in_workers(
+        self, mock_run_command
+    ):
+        set_module_args({"cache_dir": self.test_cache_dir})
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        schemes = result.exception.args[0]["schemes"]
+
+        for args in [
+            {"workers": 2},
+            {"workers": 0},
+            {"workers": 2, "scheme": "tomorrow-night", "template": "i3:colors"},
+        ]:
+            self.delete_test_cache_dir()
+            set_module_args(dict(args, cache_dir=self.test_cache_dir))
+            with patch.object(
+                base16_builder.multiprocessing,
+                "get_context",
+                wraps=base16_builder.multiprocessing.get_context,
+            ) as mock_get_context, patch.object(
+                base16_builder, "open_yaml", side_effect=base16_builder.open_yaml
+            ) as mock_open_yaml, self.assertRaises(
+                AnsibleExitJson
+            ) as result:
+                base16_builder.main()
+
+            mock_get_context.assert_called_once_with("fork")
+            # Only the source lists are parsed in the module's own process
+            self.assertEqual(mock_open_yaml.call_count, 2)
+            if "scheme" in args:
+                self.assertEqual(
+                    result.exception.args[0]["schemes"]["tomorrow-night"]["i3"],
+                    {"colors": schemes["tomorrow-night"]["i3"]["colors"]},
+                )
+            else:
+                self.assertEqual(result.exception.args[0]["schemes"], schemes)
+
+        set_module_args({"cache_dir": self.test_cache_dir, "workers": -1})
+        with self.assertRaises(AnsibleFailJson) as result:
+            base16_builder.main()
+        self.assertEqual(
+            result.exception.args[0]["msg"], "workers must be at least 0, got -1"
+        )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_workers_only_parse_one_worker_per_repo_ahead_of_rendering(
+        self, mock_run_command
+    ):
+        clone_if_missing = base16_builder.SchemeRepo.clone_if_missing
+        render = base16_builder.Template.build
+        scheme_repos_cloned = []
+        scheme_repos_cloned_before_rendering = []
+
+        def counting_clone_if_missing(scheme_repo):
+            scheme_repos_cloned.append(scheme_repo.name)
+            return clone_if_missing(scheme_repo)
+
+        def counting_render(template, *args):
+            if not scheme_repos_cloned_before_rendering:
+                scheme_repos_cloned_before_rendering.extend(scheme_repos_cloned)
+            return render(template, *args)
+
+        set_module_args(
+            {"cache_dir": self.test_cache_dir, "template": "i3", "workers": 2}
+        )
+        with patch.object(
+            base16_builder.SchemeRepo,
+            "clone_if_missing",
+            autospec=True,
+            side_effect=counting_clone_if_missing,
+        ), patch.object(
+            base16_builder.Template,
+            "build",
+            autospec=True,
+            side_effect=counting_render,
+        ), self.assertRaises(
+            AnsibleExitJson
+        ):
+            base16_builder.main()
+
+        # The third scheme repo waits until the first has been rendered
+        self.assertEqual(len(scheme_repos_cloned), 3)
+        self.assertEqual(scheme_repos_cloned_before_rendering, scheme_repos_cloned[:2])
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    @patch.object(base16_builder, "run_in_session", side_effect=fake_run_in_session)
+    @patch.object(
+        base16_builder, "run_in_session_async", side_effect=fake_run_in_session_async
+    )
+    def test_module_builds_the_same_schemes_when_orchestrated_concurrently(
+        self, mock_run_in_session_async, mock_run_in_session, mock_run_command
+    ):
+        set_module_args({"cache_dir": self.test_cache_dir})
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        schemes = result.exception.args[0]["schemes"]
+
+        for args in [
+            {"concurrency": 1},
+            {"concurrency": 4, "update": True},
+            {"concurrency": 2, "workers": 2},
+            {"concurrency": 3, "scheme": "tomorrow-night", "template": "i3:colors"},
+        ]:
+            self.delete_test_cache_dir()
+            mock_run_command.reset_mock()
+            mock_run_in_session_async.reset_mock()
+            set_module_args(dict(args, cache_dir=self.test_cache_dir))
+            with patch.object(
+                base16_builder.asyncio,
+                "new_event_loop",
+                wraps=base16_builder.asyncio.new_event_loop,
+            ) as mock_new_event_loop, self.assertRaises(AnsibleExitJson) as result:
+                base16_builder.main()
+
+            self.assertEqual(
+                mock_new_event_loop.call_count, 2 if args.get("update") else 1
+            )
+            # Fetch threads run git on the loop, never through the module
+            self.assertFalse(mock_run_command.called)
+            self.assertTrue(mock_run_in_session_async.called)
+            if "scheme" in args:
+                self.assertEqual(
+                    result.exception.args[0]["schemes"]["tomorrow-night"]["i3"],
+                    {"colors": schemes["tomorrow-night"]["i3"]["colors"]},
+                )
+            else:
+                self.assertEqual(result.exception.args[0]["schemes"], schemes)
+                # Schemes are rendered in the same order as a sequential build
+                self.assertEqual(
+                    list(result.exception.args[0]["schemes"].keys()),
+                    list(schemes.keys()),
+                )
+
+        for args in [{"scheme": "fake"}, {"template": "fake"}]:
+            set_module_args(dict(args, cache_dir=self.test_cache_dir, concurrency=2))
+            with self.assertRaises(AnsibleFailJson) as result:
+                base16_builder.main()
+            self.assertIn("fake", result.exception.args[0]["msg"])
+
+        set_module_args({"cache_dir": self.test_cache_dir, "concurrency": 0})
+        with self.assertRaises(AnsibleFailJson) as result:
+            base16_builder.main()
+        self.assertEqual(
+            result.exception.args[0]["msg"], "concurrency must be at least 1, got 0"
+        )
+
+    def test_orchestrated_fetch_failures_are_reported_once_from_the_main_thread(
+        self,
+    ):
+        remotes_dir = os.path.join(self.test_cache_dir, "remotes")
+        missing_urls = [
+            os.path.join(remotes_dir, "missing-{}".format(i)) for i in range(4)
+        ]
+        set_module_args(
+            {
+                "cache_dir": os.path.join(self.test_cache_dir, "a"),
+                "template": [],
+                "concurrency": 4,
+                "schemes_source": make_git_repo(
+                    os.path.join(remotes_dir, "schemes-source"),
+                    files={
+                        "list.yaml": "".join(
+                            "missing-{}: {}\n".format(i, url)
+                            for (i, url) in enumerate(missing_urls)
+                        )
+                    },
+                ),
+            }
+        )
+        failing_threads = []
+
+        def recording_fail_json(**kwargs):
+            failing_threads.append(threading.current_thread())
+            fail_json(**kwargs)
+
+        with patch.object(
+            basic.AnsibleModule, "fail_json", side_effect=recording_fail_json
+        ), self.assertRaises(AnsibleFailJson) as result:
+            base16_builder.main()
+
+        self.assertEqual(failing_threads, [threading.main_thread()])
+        (git, command, url, path) = result.exception.args[0]["cmd"]
+        self.assertEqual(command, "clone")
+        self.assertIn(url, missing_urls)
+        self.assertEqual(os.path.basename(path), os.path.basename(url))
+        self.assertNotEqual(result.exception.args[0]["rc"], 0)
+
+    def test_action_runs_the_module_on_hosts_like_the_normal_action(self):
+        for (async_val, wrap_async) in [(0, False), (30, True)]:
+            task = MagicMock(args={"scheme": "tomorrow-night"}, async_val=async_val)
+            connection = MagicMock(has_native_async=False)
+            connection._shell.tmpdir = "/tmp/ansible-tmp-base16"
+            action = base16_builder_action.ActionModule(
+                task, connection, MagicMock(), None, None, None
+            )
+            with patch.object(
+                action, "_execute_module", return_value={"changed": True}
+            ) as mock_execute_module, patch.object(
+                action, "_remove_tmp_path"
+            ) as mock_remove_tmp_path, patch.object(
+                base16_builder_action, "memoized_build"
+            ) as mock_memoized_build:
+                result = action.run(task_vars={})
+
+            self.assertTrue(result["changed"])
+            mock_execute_module.assert_called_once_with(
+                task_vars={}, wrap_async=wrap_async
+            )
+            mock_memoized_build.assert_not_called()
+            # Async jobs clean up their own tmp dir once they've finished
+            if wrap_async:
+                mock_remove_tmp_path.assert_not_called()
+            else:
+                mock_remove_tmp_path.assert_called_once_with("/tmp/ansible-tmp-base16")
+
+        task = MagicMock(args={"build_on_controller": "yes"}, async_val=30)
+        action = base16_builder_action.ActionModule(
+            task, MagicMock(has_native_async=False), MagicMock(), None, None, None
+        )
+        with patch.object(
+            base16_builder_action, "memoized_build"
+        ) as mock_memoized_build:
+            result = action.run(task_vars={})
+        mock_memoized_build.assert_not_called()
+        self.assertTrue(result["failed"])
+
+    def test_controller_builds_are_memoized_for_the_run(self):
+        controller_builder = base16_builder_action.load_base16_builder()
+        args = {"scheme": "tomorrow-night", "template": "i3", "cache_dir": "/ignored"}
+
+        with patch.dict(
+            os.environ, {"XDG_CACHE_DIR": self.test_cache_dir}
+        ), patch.object(
+            controller_builder.ControllerModule,
+            "run_command",
+            side_effect=fake_run_command,
+        ) as mock_run_command:
+            first_result = base16_builder_action.memoized_build(
+                controller_builder, args, False, str(os.getpid())
+            )
+            self.assertTrue(mock_run_command.called)
+            self.assertFalse(os.path.exists("/ignored"))
+            self.assertIn(
+                "base16-tomorrow-night.config",
+                first_result["schemes"]["tomorrow-night"]["i3"]["colors"],
+            )
+
+            mock_run_command.reset_mock()
+            second_result = base16_builder_action.memoized_build(
+                controller_builder, args, False, str(os.getpid())
+            )
+            self.assertFalse(mock_run_command.called)
+            self.assertEqual(first_result, second_result)
+
+    def test_controller_builds_reject_args_naming_files_on_the_host(self):
+        controller_builder = base16_builder_action.load_base16_builder()
+        for (args, host_path) in [
+            ({"metrics_path": "/srv/base16.prom"}, "metrics_path"),
+            ({"export_path": "/srv/schemes.csv"}, "export_path"),
+            ({"lockfile": "/srv/base16.lock"}, "lockfile"),
+            (
+                {"artifact_path": "/srv/base16.zip", "artifact_mode": "create"},
+                "artifact_path",
+            ),
+        ]:
+            with patch.object(
+                controller_builder, "run_on_controller"
+            ) as mock_run_on_controller:
+                result = base16_builder_action.memoized_build(
+                    controller_builder, args, False, str(os.getpid())
+                )
+
+            mock_run_on_controller.assert_not_called()
+            self.assertTrue(result["failed"])
+            self.assertTrue(result["msg"].startswith(host_path + " can't be used"))
+
+    def test_controller_module_coerces_and_validates_args(self):
+        module = base16_builder.ControllerModule(
+            {"template": "i3,shell", "update": "yes", "concurrency": "2"}
+        )
+        self.assertEqual(module.params["template"], ["i3", "shell"])
+        self.assertEqual(module.params["update"], True)
+        self.assertEqual(module.params["concurrency"], 2)
+        self.assertEqual(module.params["build"], True)
+
+        with self.assertRaises(base16_builder.ControllerModuleExit) as module_exit:
+            base16_builder.ControllerModule({"result_format": "gzip"})
+        self.assertTrue(module_exit.exception.result["failed"])
+
+        with self.assertRaises(base16_builder.ControllerModuleExit) as module_exit:
+            base16_builder.ControllerModule({"schme": "x", "templat": "y"})
+        self.assertTrue(
+            module_exit.exception.result["msg"].startswith(
+                "Unsupported parameters for (base16_builder) module: schme, templat."
+            )
+        )
+
+    def test_lookup_returns_scheme_variables_and_renders_templates_once(self):
+        controller_builder = base16_lookup.load_base16_builder()
+        lookup = base16_lookup.LookupModule()
+        # Lookups templated in the main ansible-playbook process are memoized
+        # for its run, rather than for the shell it was started from
+        self.assertEqual(
+            base16_lookup.load_action_plugin().playbook_run_id(), str(os.getpid())
+        )
+
+        with patch.object(
+            controller_builder.ControllerModule,
+            "run_command",
+            side_effect=fake_run_command,
+        ), patch.object(
+            controller_builder.Template,
+            "render",
+            autospec=True,
+            side_effect=controller_builder.Template.render,
+        ) as mock_render:
+            [scheme_variables] = lookup.run(
+                ["tomorrow-night"], {}, cache_dir=self.test_cache_dir
+            )
+            self.assertEqual(scheme_variables["base00-hex"], "1d1f21")
+
+            for _ in range(2):
+                [rendered] = lookup.run(
+                    ["tomorrow-night"],
+                    {},
+                    template="i3",
+                    template_file="colors",
+                    cache_dir=self.test_cache_dir,
+                )
+                with open(
+                    os.path.join(
+                        os.path.dirname(__file__),
+                        "fixtures",
+                        "templates",
+                        "i3",
+                        "colors",
+                        "base16-tomorrow-night.config",
+                    )
+                ) as f:
+                    self.assertEqual(rendered, f.read())
+
+            self.assertEqual(mock_render.call_count, 1)
+
+            # Ansible forks a worker for each host and task, and they share
+            # what the main process and each other looked up
+            lookup_args = dict(
+                template="i3", template_file="default", cache_dir=self.test_cache_dir
+            )
+            lookup_process = multiprocessing.get_context("fork").Process(
+                target=lookup.run, args=(["tomorrow-night"], {}), kwargs=lookup_args
+            )
+            lookup_process.start()
+            lookup_process.join()
+            self.assertEqual(lookup_process.exitcode, 0)
+            [rendered] = lookup.run(["tomorrow-night"], {}, **lookup_args)
+            self.assertIn("set $base00 #1d1f21", rendered)
+            self.assertEqual(mock_render.call_count, 1)
+
+            [scheme_variables] = lookup.run(
+                ["tomorrow-night"],
+                {},
+                palette_variables="no",
+                cache_dir=self.test_cache_dir,
+            )
+            self.assertNotIn("base00-xterm256", scheme_variables)
+
+        with self.assertRaises(base16_lookup.AnsibleError):
+            lookup.run(["not-a-real-scheme"], {}, cache_dir=self.test_cache_dir)
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_builds_only_selected_template_files(self, mock_run_command):
+        for (template_arg, expected_output_dirs) in [
+            (["i3:colors"], ["colors"]),
+            (["i3:*colors"], ["bar-colors", "colors"]),
+            (["i*:client-*", "i3:default"], ["client-properties", "themes"]),
+            (["i3"], ["bar-colors", "client-properties", "colors", "themes"]),
+        ]:
+            set_module_args(
+                {
+                    "scheme": "tomorrow-night",
+                    "template": template_arg,
+                    "cache_dir": self.test_cache_dir,
+                }
+            )
+            with patch.object(
+                base16_builder, "Template", wraps=base16_builder.Template
+            ) as mock_template, self.assertRaises(AnsibleExitJson) as result:
+                base16_builder.main()
+
+            scheme_result = result.exception.args[0]["schemes"]["tomorrow-night"]
+            self.assertEqual(sorted(scheme_result.keys()), ["i3", "scheme-variables"])
+            self.assertEqual(sorted(scheme_result["i3"].keys()), expected_output_dirs)
+            self.assertEqual(mock_template.call_count, len(expected_output_dirs))
+
+        set_module_args(
+            {
+                "scheme": "tomorrow-night",
+                "template": "i3:not-a-real-file",
+                "cache_dir": self.test_cache_dir,
+            }
+        )
+        with self.assertRaises(AnsibleFailJson):
+            base16_builder.main()
+
+    @unittest.skipUnless(
+        HAS_DULWICH and shutil.which("git"), "Requires dulwich and git"
+    )
+    def test_module_clones_and_pulls_with_the_dulwich_backend(self):
+        remotes_dir = os.path.join(self.test_cache_dir, "remotes")
+        fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+        tomorrow_url = make_git_repo(
+            os.path.join(remotes_dir, "tomorrow"),
+            source_dir=os.path.join(fixtures_dir, "schemes", "tomorrow"),
+        )
+        schemes_source_url = make_git_repo(
+            os.path.join(remotes_dir, "schemes-source"),
+            files={"list.yaml": "tomorrow: {}\n".format(tomorrow_url)},
+        )
+        args = {
+            "scheme": "tomorrow",
+            "template": "local-template",
+            "schemes_source": schemes_source_url,
+            "templates_source": make_git_repo(
+                os.path.join(remotes_dir, "templates-source"),
+                files={
+                    "list.yaml": "local-template: {}\n".format(
+                        os.path.join(fixtures_dir, "templates", "local-template")
+                    )
+                },
+            ),
+            "cache_dir": os.path.join(self.test_cache_dir, "cache"),
+            "git_backend": "dulwich",
+        }
+
+        set_module_args(args)
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertEqual(
+            sorted(result.exception.args[0]["schemes"].keys()),
+            ["tomorrow", "tomorrow-night"],
+        )
+
+        with open(
+            os.path.join(fixtures_dir, "schemes", "tomorrow", "tomorrow.yaml")
+        ) as scheme_file:
+            make_git_repo(
+                os.path.join(remotes_dir, "tomorrow"),
+                files={"tomorrow-copy.yaml": scheme_file.read()},
+            )
+
+        set_module_args(dict(args, update=True))
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertEqual(
+            sorted(result.exception.args[0]["schemes"].keys()),
+            ["tomorrow", "tomorrow-copy", "tomorrow-night"],
+        )
+
+    @unittest.skipUnless(
+        HAS_DULWICH and shutil.which("git"), "Requires dulwich and git"
+    )
+    def test_dulwich_backend_fetches_pinned_commits_over_http(self):
+        from dulwich.repo import Repo
+        from dulwich.server import DictBackend
+        from dulwich.web import make_wsgi_chain
+        from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+        tomorrow_path = os.path.join(self.test_cache_dir, "remotes", "tomorrow")
+        make_git_repo(
+            tomorrow_path, source_dir=os.path.join(fixtures_dir, "schemes", "tomorrow")
+        )
+        server = make_server(
+            "127.0.0.1",
+            0,
+            make_wsgi_chain(DictBackend({"/tomorrow": Repo(tomorrow_path)})),
+            handler_class=QuietHandler,
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        tomorrow_url = "http://127.0.0.1:{}/tomorrow".format(server.server_port)
+
+        lockfile_path = os.path.join(self.test_cache_dir, "base16.lock")
+        args = {
+            "scheme_family": "tomorrow",
+            "template": [],
+            "schemes_source": make_git_repo(
+                os.path.join(self.test_cache_dir, "remotes", "schemes-source"),
+                files={"list.yaml": "tomorrow: {}\n".format(tomorrow_url)},
+            ),
+            "git_backend": "dulwich",
+            "lockfile": lockfile_path,
+        }
+        first_host_args = dict(
+            args, cache_dir=os.path.join(self.test_cache_dir, "first-host")
+        )
+
+        set_module_args(dict(first_host_args, update=True))
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        with open(
+            os.path.join(fixtures_dir, "schemes", "tomorrow", "tomorrow.yaml")
+        ) as scheme_file:
+            scheme_yaml = scheme_file.read()
+        make_git_repo(tomorrow_path, files={"tomorrow-copy.yaml": scheme_yaml})
+
+        set_module_args(
+            dict(
+                args,
+                cache_dir=os.path.join(self.test_cache_dir, "second-host"),
+                update=True,
+            )
+        )
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        # The first host fetches the newly pinned commit over HTTP
+        set_module_args(first_host_args)
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+        self.assertEqual(
+            sorted(result.exception.args[0]["schemes"].keys()),
+            ["tomorrow", "tomorrow-copy", "tomorrow-night"],
+        )
+
+    @unittest.skipUnless(shutil.which("git"), "Requires git")
+    def test_module_builds_the_revisions_pinned_by_a_lockfile(self):
+        fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+        with open(
+            os.path.join(fixtures_dir, "schemes", "tomorrow", "tomorrow.yaml")
+        ) as scheme_file:
+            scheme_yaml = scheme_file.read()
+
+        git_backends = ["subprocess"] + (["dulwich"] if HAS_DULWICH else [])
+        for git_backend in git_backends:
+            with self.subTest(git_backend=git_backend):
+                test_dir = os.path.join(self.test_cache_dir, git_backend)
+                remotes_dir = os.path.join(test_dir, "remotes")
+                tomorrow_path = os.path.join(remotes_dir, "tomorrow")
+                tomorrow_url = make_git_repo(
+                    tomorrow_path,
+                    source_dir=os.path.join(fixtures_dir, "schemes", "tomorrow"),
+                )
+                lockfile_path = os.path.join(test_dir, "base16.lock")
+                args = {
+                    "scheme_family": "tomorrow",
+                    "template": "local-template",
+                    "schemes_source": make_git_repo(
+                        os.path.join(remotes_dir, "schemes-source"),
+                        files={"list.yaml": "tomorrow: {}\n".format(tomorrow_url)},
+                    ),
+                    "templates_source": make_git_repo(
+                        os.path.join(remotes_dir, "templates-source"),
+                        files={
+                            "list.yaml": "local-template: {}\n".format(
+                                os.path.join(
+                                    fixtures_dir, "templates", "local-template"
+                                )
+                            )
+                        },
+                    ),
+                    "git_backend": git_backend,
+                    "lockfile": lockfile_path,
+                }
+                first_host_args = dict(
+                    args, cache_dir=os.path.join(test_dir, "first-host")
+                )
+                second_host_args = dict(
+                    args, cache_dir=os.path.join(test_dir, "second-host")
+                )
+
+                def built_schemes(module_args):
+                    set_module_args(module_args)
+                    with self.assertRaises(AnsibleExitJson) as result:
+                        base16_builder.main()
+
+                    return sorted(result.exception.args[0]["schemes"].keys())
+
+                def locked_revision():
+                    with open(lockfile_path) as lockfile:
+                        return yaml.safe_load(lockfile)["schemes"]["repos"][
+                            tomorrow_url
+                        ]
+
+                def remote_revision():
+                    revision = subprocess.check_output(
+                        ["git", "rev-parse", "HEAD"], cwd=tomorrow_path
+                    )
+                    return revision.decode("ascii").strip()
+
+                self.assertEqual(
+                    built_schemes(dict(first_host_args, update=True)),
+                    ["tomorrow", "tomorrow-night"],
+                )
+                pinned_revision = remote_revision()
+                self.assertEqual(locked_revision(), pinned_revision)
+
+                make_git_repo(tomorrow_path, files={"tomorrow-copy.yaml": scheme_yaml})
+
+                # A new host clones the latest commits, but builds the pinned one
+                self.assertEqual(
+                    built_schemes(second_host_args), ["tomorrow", "tomorrow-night"]
+                )
+                self.assertEqual(locked_revision(), pinned_revision)
+
+                # Updating moves the lock to the latest commits...
+                self.assertEqual(
+                    built_schemes(dict(second_host_args, update=True)),
+                    ["tomorrow", "tomorrow-copy", "tomorrow-night"],
+                )
+                self.assertEqual(locked_revision(), remote_revision())
+
+                # ...which hosts fetch without being updated themselves
+                self.assertEqual(
+                    built_schemes(first_host_args),
+                    ["tomorrow", "tomorrow-copy", "tomorrow-night"],
+                )
+
+                # Updating without templates keeps the templates' pins
+                with open(lockfile_path) as lockfile:
+                    locked_templates = yaml.safe_load(lockfile)["templates"]
+                self.assertEqual(
+                    built_schemes(dict(second_host_args, update=True, template=[])),
+                    ["tomorrow", "tomorrow-copy", "tomorrow-night"],
+                )
+                with open(lockfile_path) as lockfile:
+                    self.assertEqual(
+                        yaml.safe_load(lockfile)["templates"], locked_templates
+                    )
+
+    def test_module_can_fetch_repo_archives_over_http(self):
+        mirror_dir = os.path.join(self.test_cache_dir, "mirror")
+        make_archive_mirror(mirror_dir, "tar.gz")
+        CountingRequestHandler.requests = []
+        server = http.server.HTTPServer(
+            ("127.0.0.1", 0),
+            functools.partial(CountingRequestHandler, directory=mirror_dir),
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        args = {
+            "scheme": "tomorrow-night",
+            "template": "local-template",
+            "templates_source": os.path.join(
+                os.path.dirname(__file__), "fixtures", "sources", "templates"
+            ),
+            "archive_url": "http://127.0.0.1:{}/{{name}}.tar.gz".format(
+                server.server_port
+            ),
+            "cache_dir": os.path.join(self.test_cache_dir, "cache"),
+        }
+
+        with patch.object(basic.AnsibleModule, "run_command") as mock_run_command:
+            set_module_args(args)
+            with self.assertRaises(AnsibleExitJson) as result:
+                base16_builder.main()
+            self.assertIn(
+                "base16-tomorrow-night.test",
+                result.exception.args[0]["schemes"]["tomorrow-night"][
+                    "local-template"
+                ]["themes"],
+            )
+            self.assertEqual(
+                sorted(CountingRequestHandler.requests),
+                [
+                    ("/base16-schemes-source.tar.gz", 200),
+                    ("/base16-tomorrow-scheme.tar.gz", 200),
+                ],
+            )
+
+            # Building again uses the unpacked archives, and updating only
+            # downloads archives that changed
+            set_module_args(dict(args, update=True))
+            with self.assertRaises(AnsibleExitJson) as result:
+                base16_builder.main()
+            self.assertIn("tomorrow-night", result.exception.args[0]["schemes"])
+            self.assertEqual(
+                sorted(CountingRequestHandler.requests[2:]),
+                [
+                    ("/base16-schemes-source.tar.gz", 304),
+                    ("/base16-tomorrow-scheme.tar.gz", 304),
+                ],
+            )
+
+        self.assertFalse(mock_run_command.called)
+        self.assertFalse(
+            os.path.exists(
+                os.path.join(
+                    self.test_cache_dir,
+                    "cache",
+                    "base16-builder-ansible",
+                    "schemes",
+                    "tomorrow",
+                    ".git",
+                )
+            )
+        )
+
+    @patch.object(basic.AnsibleModule, "run_command")
+    def test_module_can_fetch_repo_archives_from_a_local_mirror(
+        self, mock_run_command
+    ):
+        mirror_dir = os.path.join(self.test_cache_dir, "mirror")
+        make_archive_mirror(mirror_dir, "zip")
+        set_module_args(
+            {
+                "scheme": "tomorrow-night",
+                "template": "local-template",
+                "templates_source": os.path.join(
+                    os.path.dirname(__file__), "fixtures", "sources", "templates"
+                ),
+                "archive_url": os.path.join(mirror_dir, "{name}.zip"),
+                "cache_dir": os.path.join(self.test_cache_dir, "cache"),
+            }
+        )
+
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+
+        self.assertEqual(
+            list(result.exception.args[0]["schemes"].keys()), ["tomorrow-night"]
+        )
+        self.assertFalse(mock_run_command.called)
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_prunes_repos_missing_from_the_source_lists(
+        self, mock_run_command
+    ):
+        set_module_args({"cache_dir": self.test_cache_dir})
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        schemes_cache_dir = os.path.join(
+            self.test_cache_dir, "base16-builder-ansible", "schemes"
+        )
+        orphaned_repo = os.path.join(schemes_cache_dir, "dropped-family")
+        os.makedirs(os.path.join(orphaned_repo, ".git"))
+        with open(os.path.join(schemes_cache_dir, ".dropped-family.lock"), "w"):
+            pass
+
+        set_module_args(
+            {"cache_dir": self.test_cache_dir, "prune": True, "build": False}
+        )
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+
+        self.assertEqual(result.exception.args[0]["pruned"], [orphaned_repo])
+        self.assertTrue(result.exception.args[0]["changed"])
+        self.assertEqual(
+            sorted(os.listdir(schemes_cache_dir)),
+            [".materialtheme.lock", ".tomorrow.lock", "materialtheme", "tomorrow"],
+        )
+        self.assertIn(
+            call(
+                [ANY, "gc", "--auto", "--quiet"],
+                cwd=os.path.join(schemes_cache_dir, "tomorrow"),
+            ),
+            mock_run_command.mock_calls,
+        )
+
+    @patch.object(basic.AnsibleModule, "run_command", side_effect=fake_run_command)
+    def test_module_evicts_least_recently_used_repos_over_the_max_cache_size(
+        self, mock_run_command
+    ):
+        set_module_args({"cache_dir": self.test_cache_dir})
+        with self.assertRaises(AnsibleExitJson):
+            base16_builder.main()
+
+        cache_dir = os.path.join(self.test_cache_dir, "base16-builder-ansible")
+        last_used_repos = [
+            os.path.join(cache_dir, "templates", "i3"),
+            os.path.join(cache_dir, "schemes", "tomorrow"),
+            os.path.join(cache_dir, "schemes", "materialtheme"),
+        ]
+        for (last_used, repo_path) in enumerate(last_used_repos):
+            lock_path = base16_builder.RepoLock(repo_path).path
+            os.utime(lock_path, (last_used, last_used))
+
+        set_module_args(
+            {
+                "cache_dir": self.test_cache_dir,
+                "prune": True,
+                "max_cache_size": 0,
+                "build": False,
+            }
+        )
+        with self.assertRaises(AnsibleExitJson) as result:
+            base16_builder.main()
+
+        self.assertEqual(result.exception.args[0]["pruned"], last_used_repos)
+        for repo_path in last_used_repos:
+            self.assertFalse(os.path.exists(repo_path))
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, "sources", "schemes")))